@@ -259,8 +259,13 @@ static PyObject *_gadget2_getPosVel(PyObject *self,PyObject *args){
 	int fd = PyObject_AsFileDescriptor(file_obj);
 	if(fd==-1) INITERROR ;
 
-	//Read in the positions of the partcles
-	if(getPosVelFD(fd,offset,particle_data,NumPart)==-1){
+	//Read in the positions of the partcles (without holding the GIL, so that other threads can run during the read)
+	int err;
+	Py_BEGIN_ALLOW_THREADS
+	err = getPosVelFD(fd,offset,particle_data,NumPart);
+	Py_END_ALLOW_THREADS
+
+	if(err==-1){
 
 		Py_DECREF(particle_data_array);
 		PyErr_SetString(PyExc_IOError,"End of file reached, the information requested is not available!");
@@ -273,8 +278,13 @@ static PyObject *_gadget2_getPosVel(PyObject *self,PyObject *args){
 	FILE *fp = PyFile_AsFile(file_obj); 
 	PyFile_IncUseCount((PyFileObject *)file_obj);
 
-	//Read in the positions of the partcles
-	if(getPosVel(fp,offset,particle_data,NumPart)==-1){
+	//Read in the positions of the partcles (without holding the GIL, so that other threads can run during the read)
+	int err;
+	Py_BEGIN_ALLOW_THREADS
+	err = getPosVel(fp,offset,particle_data,NumPart);
+	Py_END_ALLOW_THREADS
+
+	if(err==-1){
 
 		PyFile_DecUseCount((PyFileObject *)file_obj);
 		Py_DECREF(particle_data_array);
@@ -323,8 +333,13 @@ static PyObject *_gadget2_getID(PyObject *self,PyObject *args){
 	int fd = PyObject_AsFileDescriptor(file_obj);
 	if(fd==-1) INITERROR;
 
-	//Read in the IDs of the particles
-	if(getIDFD(fd,offset,id_data,NumPart)==-1){
+	//Read in the IDs of the particles (without holding the GIL, so that other threads can run during the read)
+	int err;
+	Py_BEGIN_ALLOW_THREADS
+	err = getIDFD(fd,offset,id_data,NumPart);
+	Py_END_ALLOW_THREADS
+
+	if(err==-1){
 
 		Py_DECREF(id_data_array);
 		PyErr_SetString(PyExc_IOError,"End of file reached, the information requested is not available!");
@@ -337,8 +352,13 @@ static PyObject *_gadget2_getID(PyObject *self,PyObject *args){
 	FILE *fp = PyFile_AsFile(file_obj); 
 	PyFile_IncUseCount((PyFileObject *)file_obj);
 
-	//Read in the IDs of the particles
-	if(getID(fp,offset,id_data,NumPart)==-1){
+	//Read in the IDs of the particles (without holding the GIL, so that other threads can run during the read)
+	int err;
+	Py_BEGIN_ALLOW_THREADS
+	err = getID(fp,offset,id_data,NumPart);
+	Py_END_ALLOW_THREADS
+
+	if(err==-1){
 
 
 		PyFile_DecUseCount((PyFileObject *)file_obj);
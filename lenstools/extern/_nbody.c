@@ -6,6 +6,8 @@ The module is called _nbody and it defines the methods below (see docstrings)
 */
 
 #include <stdio.h>
+#include <stdlib.h>
+#include <pthread.h>
 
 #include <Python.h>
 #include <numpy/arrayobject.h>
@@ -19,9 +21,12 @@ static struct module_state _state;
 
 //Python module docstrings
 static char module_docstring[] = "This module provides a python interface for operations on Nbody simulation snapshots";
-static char grid3d_docstring[] = "Put the snapshot particles on a regularly spaced grid";
-static char grid3d_nfw_docstring[] = "Put the snapshot particles on a regularly spaced grid, but give each particle a NFW profile";
+static char grid3d_docstring[] = "Put the snapshot particles on a regularly spaced grid (if a float32 grid is passed as sixth argument, the particles are added to it); the optional seventh, eighth and ninth arguments are the order of the mass assignment scheme (1=NGP,2=CIC,3=TSC), a bit mask of the periodic directions and a direction along which the nearest grid point assignment is used regardless (-1 for none)";
+static char grid3d_nfw_docstring[] = "Put the snapshot particles on a regularly spaced grid, but give each particle a NFW profile (if a float32 grid is passed as sixth argument, the particles are added to it); the profile is looked up in a table and only the cells in reach of each particle are visited. The optional seventh to tenth arguments are the same as in grid3d, plus a flag that, if the grid is a single cell thick along the ninth argument direction, averages the profiles along that direction over the cell (projected painting)";
 static char adaptive_docstring[] = "Put the snapshot particles on a regularly spaced grid using adaptive smoothing";
+static char set_num_threads_docstring[] = "Set the number of threads used to grid the particles (the GIL is released during the gridding)";
+static char get_num_threads_docstring[] = "Get the number of threads used to grid the particles";
+static char grid2d_slabs_docstring[] = "Put the snapshot particles on a set of slabs projected along their normals, sweeping the particles only once (the particles are added to the float32 planes passed as fifth argument); the optional sixth and seventh arguments are the order of the mass assignment scheme (1=NGP,2=CIC,3=TSC) and a flag for periodic transverse directions";
 
 //Useful
 static PyObject *_apply_kernel2d(PyObject *args,double(*kernel)(double,double,double,double));
@@ -31,6 +36,9 @@ static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,do
 static PyObject * _nbody_grid3d(PyObject *self,PyObject *args);
 static PyObject *_nbody_grid3d_nfw(PyObject *self,PyObject *args);
 static PyObject * _nbody_adaptive(PyObject *self,PyObject *args);
+static PyObject * _nbody_grid2d_slabs(PyObject *self,PyObject *args);
+static PyObject * _nbody_set_num_threads(PyObject *self,PyObject *args);
+static PyObject * _nbody_get_num_threads(PyObject *self,PyObject *args);
 
 //_nbody method definitions
 static PyMethodDef module_methods[] = {
@@ -38,6 +46,9 @@ static PyMethodDef module_methods[] = {
 	{"grid3d",_nbody_grid3d,METH_VARARGS,grid3d_docstring},
 	{"grid3d_nfw",_nbody_grid3d_nfw,METH_VARARGS,grid3d_nfw_docstring},
 	{"adaptive",_nbody_adaptive,METH_VARARGS,adaptive_docstring},
+	{"grid2d_slabs",_nbody_grid2d_slabs,METH_VARARGS,grid2d_slabs_docstring},
+	{"set_num_threads",_nbody_set_num_threads,METH_VARARGS,set_num_threads_docstring},
+	{"get_num_threads",_nbody_get_num_threads,METH_NOARGS,get_num_threads_docstring},
 	{NULL,NULL,0,NULL}
 
 } ;
@@ -104,6 +115,180 @@ init_nbody(void)
 /////////////////////////////////////////////////////////////
 /////////////////////////////////////////////////////////////
 
+//Number of threads used in the gridding procedures
+static int num_threads = 1;
+
+//Grids the particles in [first,last) on the grid provided; args holds the parameters of the gridding procedure
+typedef void (*gridRange)(void *args,int first,int last,void *grid);
+
+//A chunk of particles gridded by a single thread
+typedef struct {
+
+	gridRange grid_range;
+	void *args;
+	int first,last;
+	void *grid;
+	int launched;
+
+} gridTask;
+
+static void *gridTaskRun(void *task){
+
+	gridTask *t = (gridTask *)task;
+	t->grid_range(t->args,t->first,t->last,t->grid);
+	return NULL;
+
+}
+
+//Split the particles between num_threads threads: each thread grids its particles on a private copy of the grid (the first one on the grid itself), and the copies are summed at the end. The grid has size elements, either float or double. Must be called without the GIL; returns -1 if the private grids cannot be allocated
+static int gridThreaded(gridRange grid_range,void *args,int Npart,void *grid,size_t size,int is_double){
+
+	int t,nthreads = (Npart < num_threads) ? Npart : num_threads;
+	size_t i,elsize = is_double ? sizeof(double) : sizeof(float);
+
+	//Nothing to parallelize
+	if(nthreads<=1){
+		grid_range(args,0,Npart,grid);
+		return 0;
+	}
+
+	gridTask *tasks = (gridTask *)malloc(nthreads*sizeof(gridTask));
+	pthread_t *threads = (pthread_t *)malloc(nthreads*sizeof(pthread_t));
+	if(tasks==NULL || threads==NULL){
+		free(tasks);
+		free(threads);
+		return -1;
+	}
+
+	//Assign a chunk of particles and a grid to each thread
+	for(t=0;t<nthreads;t++){
+
+		tasks[t].grid_range = grid_range;
+		tasks[t].args = args;
+		tasks[t].first = (int)(((long long)Npart*t)/nthreads);
+		tasks[t].last = (int)(((long long)Npart*(t+1))/nthreads);
+		tasks[t].grid = (t==0) ? grid : calloc(size,elsize);
+		tasks[t].launched = 0;
+
+		if(tasks[t].grid==NULL){
+			while(--t>0) free(tasks[t].grid);
+			free(tasks);
+			free(threads);
+			return -1;
+		}
+
+	}
+
+	//Launch the threads (the first chunk is gridded by the calling thread), fall back on the calling thread if a thread cannot be created
+	for(t=1;t<nthreads;t++){
+		if(pthread_create(threads+t,NULL,gridTaskRun,tasks+t)) gridTaskRun(tasks+t);
+		else tasks[t].launched = 1;
+	}
+
+	gridTaskRun(tasks);
+
+	//Wait for the threads and reduce the private grids
+	for(t=1;t<nthreads;t++){
+
+		if(tasks[t].launched) pthread_join(threads[t],NULL);
+
+		if(is_double){
+			for(i=0;i<size;i++) ((double *)grid)[i] += ((double *)tasks[t].grid)[i];
+		} else{
+			for(i=0;i<size;i++) ((float *)grid)[i] += ((float *)tasks[t].grid)[i];
+		}
+
+		free(tasks[t].grid);
+
+	}
+
+	free(tasks);
+	free(threads);
+	return 0;
+
+}
+
+//Parameters of the gridding procedures
+typedef struct {
+
+	float *positions,*weights;
+	double *radius,*concentration;
+	double left[3],size[3];
+	int n[3],order,periodic,ngp_axis;
+	double *slabs;
+	int Nslabs;
+	double (*kernel)(double,double,double,double);
+	double *table,table_step;
+	int table_size,project;
+
+} grid3dArgs;
+
+typedef struct {
+
+	float *positions,*weights;
+	double *rp,*concentration,*binning0,*binning1,center;
+	int direction0,direction1,normal,size0,size1,projectAll;
+	double (*kernel)(double,double,double,double);
+
+} adaptiveArgs;
+
+#define SHIFT(a,n) ((a) ? (a)+(n) : NULL)
+
+static void grid3dRange(void *args,int first,int last,void *grid){
+	grid3dArgs *a = (grid3dArgs *)args;
+	grid3d(a->positions+3*first,SHIFT(a->weights,first),SHIFT(a->radius,first),SHIFT(a->concentration,first),last-first,a->left[0],a->left[1],a->left[2],a->size[0],a->size[1],a->size[2],a->n[0],a->n[1],a->n[2],(float *)grid,a->kernel);
+}
+
+static void grid3dNFWRange(void *args,int first,int last,void *grid){
+	grid3dArgs *a = (grid3dArgs *)args;
+	grid3dNFW(a->positions+3*first,SHIFT(a->weights,first),a->radius+first,a->concentration+first,last-first,a->left,a->size,a->n,a->project ? a->ngp_axis : -1,a->table,a->table_size,a->table_step,(float *)grid);
+}
+
+static void grid3dCloudRange(void *args,int first,int last,void *grid){
+	grid3dArgs *a = (grid3dArgs *)args;
+	grid3dCloud(a->positions+3*first,SHIFT(a->weights,first),last-first,a->left,a->size,a->n,a->order,a->periodic,a->ngp_axis,(float *)grid);
+}
+
+static void gridSlabsRange(void *args,int first,int last,void *grid){
+	grid3dArgs *a = (grid3dArgs *)args;
+	gridSlabs(a->positions+3*first,SHIFT(a->weights,first),last-first,a->left,a->size,a->n[0],a->slabs,a->Nslabs,a->order,a->periodic,(float *)grid);
+}
+
+static void adaptiveRange(void *args,int first,int last,void *grid){
+	adaptiveArgs *a = (adaptiveArgs *)args;
+	adaptiveSmoothing(last-first,a->positions+3*first,SHIFT(a->weights,first),a->rp+first,SHIFT(a->concentration,first),a->binning0,a->binning1,a->center,a->direction0,a->direction1,a->normal,a->size0,a->size1,a->projectAll,(double *)grid,a->kernel);
+}
+
+//set_num_threads() implementation
+static PyObject * _nbody_set_num_threads(PyObject *self,PyObject *args){
+
+	int n;
+
+	if(!PyArg_ParseTuple(args,"i",&n)){
+		return NULL;
+	}
+
+	if(n<1){
+		PyErr_SetString(PyExc_ValueError,"The number of threads must be at least 1!");
+		return NULL;
+	}
+
+	num_threads = n;
+	Py_RETURN_NONE;
+
+}
+
+//get_num_threads() implementation
+static PyObject * _nbody_get_num_threads(PyObject *self,PyObject *args){
+
+	return Py_BuildValue("i",num_threads);
+
+}
+
+/////////////////////////////////////////////////////////////
+/////////////////////////////////////////////////////////////
+/////////////////////////////////////////////////////////////
+
 //apply_kernel2d() implementation
 static PyObject *_apply_kernel2d(PyObject *args,double(*kernel)(double,double,double,double)){
 
@@ -214,7 +399,17 @@ static PyObject *_apply_kernel2d(PyObject *args,double(*kernel)(double,double,do
 	double *lensingPlane = (double *)PyArray_DATA(lensingPlane_array);
 
 	//Compute the adaptive smoothing using C backend
-	adaptiveSmoothing(NumPart,positions,weights,rp,concentration,binning0,binning1,center,direction0,direction1,normal,size0,size1,PyObject_IsTrue(projectAll),lensingPlane,kernel);
+	adaptiveArgs a = {positions,weights,rp,concentration,binning0,binning1,center,direction0,direction1,normal,size0,size1,PyObject_IsTrue(projectAll),kernel};
+	int err;
+
+	Py_BEGIN_ALLOW_THREADS
+	err = gridThreaded(adaptiveRange,&a,NumPart,lensingPlane,(size_t)size0*size1,1);
+	Py_END_ALLOW_THREADS
+
+	if(err){
+		Py_DECREF(lensingPlane_array);
+		lensingPlane_array = PyErr_NoMemory();
+	}
 
 	//Cleanup
 	Py_DECREF(positions_array);
@@ -234,12 +429,13 @@ static PyObject *_apply_kernel2d(PyObject *args,double(*kernel)(double,double,do
 static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,double,double)){
 
 
-	PyObject *positions_obj,*bins_obj,*weights_obj,*radius_obj,*concentration_obj;
+	PyObject *positions_obj,*bins_obj,*weights_obj,*radius_obj,*concentration_obj,*grid_obj=Py_None;
 	float *weights;
 	double *radius,*concentration;
+	int order=1,periodic=0,ngp_axis=-1,project=0;
 
 	//parse input tuple
-	if(!PyArg_ParseTuple(args,"OOOOO",&positions_obj,&bins_obj,&weights_obj,&radius_obj,&concentration_obj)){
+	if(!PyArg_ParseTuple(args,"OOOOO|Oiiii",&positions_obj,&bins_obj,&weights_obj,&radius_obj,&concentration_obj,&grid_obj,&order,&periodic,&ngp_axis,&project)){
 		return NULL;
 	}
 
@@ -349,11 +545,20 @@ static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,do
 	int ny = (int)PyArray_DIM(binsY_array,0) - 1;
 	int nz = (int)PyArray_DIM(binsZ_array,0) - 1;
 
-	//Allocate the new array for the grid
+	//Allocate the new array for the grid, or accumulate on the one provided (which must match the binning exactly, no copies are made)
 	PyObject *grid_array;
 		
 	npy_intp gridDims[] = {(npy_intp) nx,(npy_intp) ny,(npy_intp) nz};
-	grid_array = PyArray_ZEROS(3,gridDims,NPY_FLOAT32,0);
+
+	if(grid_obj==Py_None){
+		grid_array = PyArray_ZEROS(3,gridDims,NPY_FLOAT32,0);
+	} else if(PyArray_Check(grid_obj) && PyArray_TYPE((PyArrayObject *)grid_obj)==NPY_FLOAT32 && PyArray_ISCARRAY((PyArrayObject *)grid_obj) && PyArray_NDIM((PyArrayObject *)grid_obj)==3 && PyArray_DIM((PyArrayObject *)grid_obj,0)==nx && PyArray_DIM((PyArrayObject *)grid_obj,1)==ny && PyArray_DIM((PyArrayObject *)grid_obj,2)==nz){
+		grid_array = grid_obj;
+		Py_INCREF(grid_array);
+	} else{
+		PyErr_SetString(PyExc_ValueError,"The grid must be a writeable, C contiguous float32 array with shape matching the binning!");
+		grid_array = NULL;
+	}
 
 	if(grid_array==NULL){
 
@@ -373,8 +578,42 @@ static PyObject *_apply_kernel3d(PyObject *args,double(*kernel)(double,double,do
 	//Get a data pointer
 	float *grid_data = (float *)PyArray_DATA(grid_array);
 
-	//Snap the particles on the grid
-	grid3d(positions_data,weights,radius,concentration,NumPart,binsX_data[0],binsY_data[0],binsZ_data[0],binsX_data[1] - binsX_data[0],binsY_data[1] - binsY_data[0],binsZ_data[1] - binsZ_data[0],nx,ny,nz,grid_data,kernel);
+	//Snap the particles on the grid (the mass assignment scheme is used only if the particles do not have a profile)
+	grid3dArgs a = {positions_data,weights,radius,concentration,{binsX_data[0],binsY_data[0],binsZ_data[0]},{binsX_data[1] - binsX_data[0],binsY_data[1] - binsY_data[0],binsZ_data[1] - binsZ_data[0]},{nx,ny,nz},order,periodic,ngp_axis,NULL,0,kernel};
+	int err = 0;
+
+	//The NFW profile is tabulated up to the largest concentration
+	if(kernel==nfwKernel && radius!=NULL && concentration!=NULL){
+
+		double cmax = 0.0;
+		int n;
+		for(n=0;n<NumPart;n++) cmax = (concentration[n]>cmax) ? concentration[n] : cmax;
+
+		a.project = project;
+		if((a.table = nfwTable(cmax,&a.table_size,&a.table_step))==NULL) err = -1;
+
+	}
+
+	if(!err){
+
+		Py_BEGIN_ALLOW_THREADS
+		if(a.table!=NULL){
+			err = gridThreaded(grid3dNFWRange,&a,NumPart,grid_data,(size_t)nx*ny*nz,0);
+		} else if((kernel!=NULL && radius!=NULL) || (order==1 && periodic==0)){
+			err = gridThreaded(grid3dRange,&a,NumPart,grid_data,(size_t)nx*ny*nz,0);
+		} else{
+			err = gridThreaded(grid3dCloudRange,&a,NumPart,grid_data,(size_t)nx*ny*nz,0);
+		}
+		Py_END_ALLOW_THREADS
+
+	}
+
+	free(a.table);
+
+	if(err){
+		Py_DECREF(grid_array);
+		grid_array = PyErr_NoMemory();
+	}
 
 	//return the grid
 	Py_DECREF(positions_array);
@@ -411,4 +650,97 @@ static PyObject * _nbody_adaptive(PyObject *self,PyObject *args){
 
 	return _apply_kernel2d(args,quadraticKernel);
 
-}
\ No newline at end of file
+}
+
+
+//grid2d_slabs() implementation
+static PyObject * _nbody_grid2d_slabs(PyObject *self,PyObject *args){
+
+	PyObject *positions_obj,*weights_obj,*bins_obj,*slabs_obj,*grid_obj;
+	PyObject *weights_array=NULL;
+	float *weights=NULL;
+	int d,order=1,periodic=0;
+
+	//parse input tuple
+	if(!PyArg_ParseTuple(args,"OOOOO|ii",&positions_obj,&weights_obj,&bins_obj,&slabs_obj,&grid_obj,&order,&periodic)){
+		return NULL;
+	}
+
+	//interpret parsed objects as arrays
+	PyObject *positions_array = PyArray_FROM_OTF(positions_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+	PyObject *binsX_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,0),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *binsY_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,1),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *binsZ_array = PyArray_FROM_OTF(PyTuple_GET_ITEM(bins_obj,2),NPY_DOUBLE,NPY_IN_ARRAY);
+	PyObject *slabs_array = PyArray_FROM_OTF(slabs_obj,NPY_DOUBLE,NPY_IN_ARRAY);
+
+	if(weights_obj!=Py_None){
+		weights_array = PyArray_FROM_OTF(weights_obj,NPY_FLOAT32,NPY_IN_ARRAY);
+	}
+
+	//check if anything failed
+	if(positions_array==NULL || binsX_array==NULL || binsY_array==NULL || binsZ_array==NULL || slabs_array==NULL || (weights_obj!=Py_None && weights_array==NULL)){
+		
+		Py_XDECREF(positions_array);
+		Py_XDECREF(binsX_array);
+		Py_XDECREF(binsY_array);
+		Py_XDECREF(binsZ_array);
+		Py_XDECREF(slabs_array);
+		Py_XDECREF(weights_array);
+
+		return NULL;
+	}
+
+	if(weights_array) weights = (float *)PyArray_DATA(weights_array);
+
+	//Transverse binning, the same along all the directions
+	PyObject *bins_arrays[] = {binsX_array,binsY_array,binsZ_array};
+	double left[3],size[3];
+	int npix = (int)PyArray_DIM(binsX_array,0) - 1;
+	int Nslabs = (int)PyArray_DIM(slabs_array,0);
+	int NumPart = (int)PyArray_DIM(positions_array,0);
+
+	for(d=0;d<3;d++){
+		left[d] = ((double *)PyArray_DATA(bins_arrays[d]))[0];
+		size[d] = ((double *)PyArray_DATA(bins_arrays[d]))[1] - left[d];
+	}
+
+	//The planes are accumulated on the array provided, which must match the binning exactly (no copies are made)
+	if(!(PyArray_Check(grid_obj) && PyArray_TYPE((PyArrayObject *)grid_obj)==NPY_FLOAT32 && PyArray_ISCARRAY((PyArrayObject *)grid_obj) && PyArray_NDIM((PyArrayObject *)grid_obj)==3 && PyArray_DIM((PyArrayObject *)grid_obj,0)==Nslabs && PyArray_DIM((PyArrayObject *)grid_obj,1)==npix && PyArray_DIM((PyArrayObject *)grid_obj,2)==npix && PyArray_DIM(binsY_array,0)==npix+1 && PyArray_DIM(binsZ_array,0)==npix+1 && PyArray_DIM(slabs_array,1)==5)){
+
+		PyErr_SetString(PyExc_ValueError,"The planes must be a writeable, C contiguous float32 array with shape (number of slabs,npix,npix), with npix+1 bins along each direction!");
+
+		Py_DECREF(positions_array);
+		Py_DECREF(binsX_array);
+		Py_DECREF(binsY_array);
+		Py_DECREF(binsZ_array);
+		Py_DECREF(slabs_array);
+		Py_XDECREF(weights_array);
+
+		return NULL;
+
+	}
+
+	//Snap the particles on the slabs
+	grid3dArgs a = {(float *)PyArray_DATA(positions_array),weights,NULL,NULL,{left[0],left[1],left[2]},{size[0],size[1],size[2]},{npix,npix,npix},order,periodic,-1,(double *)PyArray_DATA(slabs_array),Nslabs,NULL};
+	int err;
+
+	Py_BEGIN_ALLOW_THREADS
+	err = gridThreaded(gridSlabsRange,&a,NumPart,PyArray_DATA((PyArrayObject *)grid_obj),(size_t)Nslabs*npix*npix,0);
+	Py_END_ALLOW_THREADS
+
+	//Release
+	Py_DECREF(positions_array);
+	Py_DECREF(binsX_array);
+	Py_DECREF(binsY_array);
+	Py_DECREF(binsZ_array);
+	Py_DECREF(slabs_array);
+	Py_XDECREF(weights_array);
+
+	if(err){
+		return PyErr_NoMemory();
+	}
+
+	Py_INCREF(grid_obj);
+	return grid_obj;
+
+}
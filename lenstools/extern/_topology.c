@@ -480,7 +480,10 @@ static PyObject *_topology_gradient(PyObject *self,PyObject *args){
 	}
 
 	/*Call the underlying C function that computes the gradient*/
+	/*The lookups only touch raw buffers: release the GIL so that several threads can share the same map*/
+	Py_BEGIN_ALLOW_THREADS
 	gradient_xy((double *)PyArray_DATA(map_array),(double *)PyArray_DATA(gradient_x_array),(double *)PyArray_DATA(gradient_y_array),Nside,Npoints,x_data,y_data);
+	Py_END_ALLOW_THREADS
 
 	/*Prepare a tuple container for the output*/
 	PyObject *gradient_output = PyTuple_New(2);
@@ -607,7 +610,9 @@ static PyObject *_topology_hessian(PyObject *self,PyObject *args){
 	}
 
 	/*Call the underlying C function that computes the hessian*/
+	Py_BEGIN_ALLOW_THREADS
 	hessian((double *)PyArray_DATA(map_array),(double *)PyArray_DATA(hessian_xx_array),(double *)PyArray_DATA(hessian_yy_array),(double *)PyArray_DATA(hessian_xy_array),Nside,Npoints,x_data,y_data);
+	Py_END_ALLOW_THREADS
 
 	/*Prepare a tuple container for the output*/
 	PyObject *hessian_output = PyTuple_New(3);
@@ -749,7 +754,9 @@ static PyObject *_topology_gradLaplacian(PyObject *self,PyObject *args){
 	}
 
 	/*Call the underlying C function that computes the gradient*/
+	Py_BEGIN_ALLOW_THREADS
 	gradLaplacian((double *)PyArray_DATA(map_array),(double *)PyArray_DATA(gradient_x_array),(double *)PyArray_DATA(gradient_y_array),Nside,Npoints,x_data,y_data);
+	Py_END_ALLOW_THREADS
 
 	/*Prepare a tuple container for the output*/
 	PyObject *gradient_output = PyTuple_New(2);
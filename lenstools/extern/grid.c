@@ -7,6 +7,9 @@
 #define WEIGHT_DEFAULT 1.0
 #define CONCENTRATION_DEFAULT 1.0
 #define NFW_CUT 0.1
+#define NFW_TABLE_STEP 1.0e-3
+#define NFW_TABLE_SIZE 65536
+#define NFW_PROJECTION_SAMPLES 16
 
 
 //NFW density profile
@@ -22,6 +25,134 @@ double nfwKernel(double dsquared,double w,double rv,double c){
 
 }
 
+//Tabulate the NFW profile shape 1/(x(1+x)^2) (with the same core cut as nfwKernel) for x=c*r/rv between 0 and xmax: the profile depends on the concentration only through x, so a single table serves all the halos. Returns NULL if the table cannot be allocated
+double *nfwTable(double xmax,int *size,double *step){
+
+	int n;
+	double x,*table;
+
+	*step = fmax(NFW_TABLE_STEP,xmax/NFW_TABLE_SIZE);
+	*size = (int)(xmax/(*step)) + 2;
+
+	if((table = (double *)malloc(sizeof(double)*(*size)))==NULL){
+		return NULL;
+	}
+
+	for(n=0;n<*size;n++){
+		x = fmax(n*(*step),NFW_CUT);
+		table[n] = 1.0/(x*(1.0+x)*(1.0+x));
+	}
+
+	return table;
+
+}
+
+//Linear interpolation of the tabulated NFW profile shape
+static inline double nfwLookup(double x,double *table,int size,double step){
+
+	double u = x/step;
+	int n = (int)u;
+
+	if(n>=size-1){
+		return table[size-1];
+	}
+
+	return table[n] + (u-n)*(table[n+1]-table[n]);
+
+}
+
+//Paint the NFW profiles of the halos on a 3d regularly spaced grid, looking up the profile in a table made with nfwTable. Only the cells in the bounding box of each halo are visited (halos whose box misses the grid are skipped), and the squared distances from the halo center are split in per-axis contributions. If the grid has a single cell along project_axis (>=0), the profile is averaged along that axis over the cell (projected painting of thin slabs) instead of being sampled at the cell center. Returns -1 if the work space cannot be allocated
+int grid3dNFW(float *positions,float *weights,double *radius,double *concentration,int Npart,double *left,double *size,int *n,int project_axis,double *table,int table_size,double table_step,float *grid){
+
+	int p,d,s,lo[3],hi[3],ii,jj,kk,nsamples;
+	double *offsets[3],rv2,scale,w,dxx,dxy,d2,zmin=0.0,zmax=0.0,dz,z,chord,profile;
+
+	//Per axis squared offsets of the cell centers from the halo center
+	if((offsets[0] = (double *)malloc(sizeof(double)*(n[0]+n[1]+n[2])))==NULL){
+		return -1;
+	}
+	offsets[1] = offsets[0] + n[0];
+	offsets[2] = offsets[1] + n[1];
+
+	//Projected painting only if the grid is a single cell thick
+	if(project_axis>=0 && n[project_axis]!=1){
+		project_axis = -1;
+	}
+
+	for(p=0;p<Npart;p++){
+
+		//Bounding box of the halo on the grid
+		for(d=0;d<3;d++){
+			lo[d] = max_int((int)floor((positions[3*p+d] - radius[p] - left[d])/size[d]),0);
+			hi[d] = min_int((int)floor((positions[3*p+d] + radius[p] - left[d])/size[d]) + 1,n[d]);
+		}
+
+		//Cull the halos that do not reach the grid
+		if(lo[0]>=hi[0] || lo[1]>=hi[1] || lo[2]>=hi[2]) continue;
+
+		for(d=0;d<3;d++){
+			for(s=lo[d];s<hi[d];s++){
+				offsets[d][s] = (d==project_axis) ? 0.0 : pow(left[d] + (s+0.5)*size[d] - positions[3*p+d],2);
+			}
+		}
+
+		rv2 = radius[p]*radius[p];
+		scale = concentration[p]/radius[p];
+		w = (weights==NULL) ? WEIGHT_DEFAULT : (double)weights[p];
+
+		//Extent of the slab along the projection axis, relative to the halo center
+		if(project_axis>=0){
+			zmin = left[project_axis] - positions[3*p+project_axis];
+			zmax = zmin + size[project_axis];
+		}
+
+		for(ii=lo[0];ii<hi[0];ii++){
+
+			dxx = offsets[0][ii];
+			if(dxx>=rv2) continue;
+
+			for(jj=lo[1];jj<hi[1];jj++){
+
+				dxy = dxx + offsets[1][jj];
+				if(dxy>=rv2) continue;
+
+				for(kk=lo[2];kk<hi[2];kk++){
+
+					d2 = dxy + offsets[2][kk];
+					if(d2>=rv2) continue;
+
+					if(project_axis<0){
+						profile = nfwLookup(scale*sqrt(d2),table,table_size,table_step);
+					} else{
+
+						//Average the profile over the part of the chord through the halo that lies in the slab (midpoint rule)
+						chord = sqrt(rv2 - d2);
+						dz = fmin(chord,zmax) - fmax(-chord,zmin);
+						if(dz<=0.0) continue;
+
+						nsamples = NFW_PROJECTION_SAMPLES;
+						profile = 0.0;
+						for(s=0;s<nsamples;s++){
+							z = fmax(-chord,zmin) + (s+0.5)*dz/nsamples;
+							profile += nfwLookup(scale*sqrt(d2 + z*z),table,table_size,table_step);
+						}
+						profile *= dz/(nsamples*size[project_axis]);
+
+					}
+
+					grid[(ii*n[1] + jj)*n[2] + kk] += (float)(w*profile);
+
+				}
+			}
+		}
+
+	}
+
+	free(offsets[0]);
+	return 0;
+
+}
+
 //Two dimensional pixelization of a galaxy catalog
 int grid2d(double *x,double *y,double *s,double *map,int Nobjects,int Npixel,double map_size){
 
@@ -171,6 +302,129 @@ int grid3d(float *positions,float *weights,double *radius,double *concentration,
 }
 
 
+//Cells covered by the cloud of a particle at u (in units of the cell size) along one axis, with the corresponding weights: order is 1 for nearest grid point, 2 for cloud in cell, 3 for triangular shaped cloud. Returns the number of cells on the grid
+static int cloudCells(double u,int order,int n,int periodic,int *cells,double *w){
+
+	int c,m,p=0;
+	double d;
+
+	switch(order){
+
+		case 1:
+			cells[0] = (int)floor(u); w[0] = 1.0;
+			m = 1;
+			break;
+
+		case 2:
+			d = u - 0.5;
+			c = (int)floor(d);
+			d -= c;
+			cells[0] = c; w[0] = 1.0 - d;
+			cells[1] = c+1; w[1] = d;
+			m = 2;
+			break;
+
+		case 3:
+			c = (int)floor(u);
+			d = u - c - 0.5;
+			cells[0] = c-1; w[0] = 0.5*(0.5-d)*(0.5-d);
+			cells[1] = c; w[1] = 0.75 - d*d;
+			cells[2] = c+1; w[2] = 0.5*(0.5+d)*(0.5+d);
+			m = 3;
+			break;
+
+		default:
+			return 0;
+	
+	}
+
+	//Wrap the cells out of the grid if the boundary conditions are periodic, discard them otherwise
+	for(c=0;c<m;c++){
+		
+		if(periodic){
+			cells[p] = ((cells[c] % n) + n) % n;
+			w[p++] = w[c];
+		} else if(cells[c]>=0 && cells[c]<n){
+			cells[p] = cells[c];
+			w[p++] = w[c];
+		}
+	
+	}
+
+	return p;
+
+}
+
+//Snap particles on a 3d regularly spaced grid with a mass assignment scheme of the given order; bit d of periodic is set if the boundary conditions are periodic along axis d, the particles are assigned to the nearest grid point along ngp_axis (if >=0)
+int grid3dCloud(float *positions,float *weights,int Npart,double *left,double *size,int *n,int order,int periodic,int ngp_axis,float *grid){
+
+	int p,d,a,b,c,ncells[3],cells[3][3];
+	double w[3][3],wp;
+
+	for(p=0;p<Npart;p++){
+
+		for(d=0;d<3;d++){
+			ncells[d] = cloudCells((positions[3*p + d] - left[d])/size[d],(d==ngp_axis) ? 1 : order,n[d],(periodic>>d) & 1,cells[d],w[d]);
+		}
+
+		wp = (weights==NULL) ? 1.0 : weights[p];
+
+		for(a=0;a<ncells[0];a++){
+			for(b=0;b<ncells[1];b++){
+				for(c=0;c<ncells[2];c++){
+					grid[(cells[0][a]*n[1] + cells[1][b])*n[2] + cells[2][c]] += (float)(wp*w[0][a]*w[1][b]*w[2][c]);
+				}
+			}
+		}
+
+	}
+
+	return 0;
+
+}
+
+//Snap particles on a set of slabs, each one projected along its normal: the particles are swept only once for all the slabs. The mass assignment scheme of the given order is applied in the transverse directions
+int gridSlabs(float *positions,float *weights,int Npart,double *left,double *size,int npix,double *slabs,int Nslabs,int order,int periodic,float *grid){
+
+	int n,s,normal,d0,d1,nk,a,b,ncells0,ncells1,cells0[3],cells1[3];
+	double k,wp,w0[3],w1[3];
+
+	for(n=0;n<Npart;n++){
+
+		wp = (weights==NULL) ? 1.0 : weights[n];
+
+		for(s=0;s<Nslabs;s++){
+
+			//Each slab is specified by (normal,lower edge,bin size,number of bins) along the normal, and a shift of the transverse grid in units of the pixel size
+			normal = (int)slabs[5*s];
+			nk = (int)slabs[5*s + 3];
+			k = (positions[3*n + normal] - slabs[5*s + 1])/slabs[5*s + 2];
+
+			//Skip the particle if it does not belong to the slab
+			if(!(k>=0 && k<nk)) continue;
+
+			//Transverse directions
+			d0 = (normal==0) ? 1 : 0;
+			d1 = (normal==2) ? 1 : 2;
+
+			//Put the particle in the pixels on the plane covered by its cloud
+			ncells0 = cloudCells((positions[3*n + d0] - left[d0])/size[d0] + slabs[5*s + 4],order,npix,periodic,cells0,w0);
+			ncells1 = cloudCells((positions[3*n + d1] - left[d1])/size[d1] + slabs[5*s + 4],order,npix,periodic,cells1,w1);
+
+			for(a=0;a<ncells0;a++){
+				for(b=0;b<ncells1;b++){
+					grid[s*npix*npix + cells0[a]*npix + cells1[b]] += (float)(wp*w0[a]*w1[b]);
+				}
+			}
+
+		}
+	}
+
+	return 0;
+
+}
+
+
 //adaptive smoothing
 int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,double *concentration,double *binning0, double *binning1,double center,int direction0,int direction1,int normal,int size0,int size1,int projectAll,double *lensingPlane,double(*kernel)(double,double,double,double)){
 
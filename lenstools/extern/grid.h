@@ -5,6 +5,8 @@
 
 int grid2d(double *x,double *y,double *s,double *map,int Nobjects,int Npixel,double map_size);
 int grid3d(float *positions,float *weights,double *radius,double *concentration,int Npart,double leftX,double leftY,double leftZ,double sizeX,double sizeY,double sizeZ,int nx,int ny,int nz,float *grid,double(*kernel)(double,double,double,double));
+int grid3dCloud(float *positions,float *weights,int Npart,double *left,double *size,int *n,int order,int periodic,int ngp_axis,float *grid);
+int gridSlabs(float *positions,float *weights,int Npart,double *left,double *size,int npix,double *slabs,int Nslabs,int order,int periodic,float *grid);
 int adaptiveSmoothing(int NumPart,float *positions,float *weights,double *rp,double *concentration,double *binning0, double *binning1,double center,int direction0,int direction1,int normal,int size0,int size1,int projectAll,double *lensingPlane,double(*kernel)(double,double,double,double));
 
 static inline double quadraticKernel(double dsquared,double w,double rv,double c){
@@ -12,6 +14,8 @@ static inline double quadraticKernel(double dsquared,double w,double rv,double c
 }
 
 double nfwKernel(double dsquared,double w,double rv,double c);
+double *nfwTable(double xmax,int *size,double *step);
+int grid3dNFW(float *positions,float *weights,double *radius,double *concentration,int Npart,double *left,double *size,int *n,int project_axis,double *table,int table_size,double table_step,float *grid);
 
 
 #endif
\ No newline at end of file
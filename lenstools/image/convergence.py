@@ -81,7 +81,7 @@ class Spin0(object):
 		self._masked = masked
 
 		#Extra keyword arguments
-		self._extra_attributes = kwargs.keys()
+		self._extra_attributes = list(kwargs.keys())
 		for key in kwargs:
 			setattr(self,key,kwargs[key])
 
@@ -58,7 +58,7 @@ class Spin1(object):
 			self.lmin = 2.0*np.pi/self.side_angle.to(rad).value
 			self.lmax = np.sqrt(2)*np.pi/self.resolution.to(rad).value
 
-		self._extra_attributes = kwargs.keys()
+		self._extra_attributes = list(kwargs.keys())
 		for key in kwargs:
 			setattr(self,key,kwargs[key])
 
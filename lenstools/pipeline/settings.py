@@ -162,6 +162,23 @@ class PlaneSettings(LTSettings):
 		self.smooth = 1
 		self.kind = "potential"
 
+		#Compact Fourier space storage (npz format only): multipole cut and lossless compression
+		self.lmax = None
+		self.compress = False
+
+		#If not None, the particles are read from the snapshot files chunk_size at a time when cutting the planes
+		self.chunk_size = None
+
+		#Mass assignment scheme (NGP,CIC,TSC) and interlacing of the planes
+		self.assignment = "NGP"
+		self.interlacing = False
+
+		#Number of threads used by each task to grid the particles
+		self.num_threads = 1
+
+		#Read the next snapshot in the background while the planes are cut out of the current one
+		self.prefetch_snapshots = False
+
 		#Allow for kwargs override
 		for key in kwargs:
 			setattr(self,key,kwargs[key])
@@ -238,6 +255,41 @@ class PlaneSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.lmax = options.getfloat(section,"lmax")
+		except (NoOptionError,ValueError):
+			pass
+
+		try:
+			settings.compress = options.getboolean(section,"compress")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.chunk_size = options.getint(section,"chunk_size")
+		except (NoOptionError,ValueError):
+			pass
+
+		try:
+			settings.assignment = options.get(section,"assignment")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.interlacing = options.getboolean(section,"interlacing")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.num_threads = options.getint(section,"num_threads")
+		except NoOptionError:
+			pass
+
+		try:
+			settings.prefetch_snapshots = options.getboolean(section,"prefetch_snapshots")
+		except NoOptionError:
+			pass
+
 		#Return to user
 		return settings
 
@@ -279,6 +331,9 @@ class PlaneLightConeSettings(LTSettings):
 		self.smooth = 1
 		self.kind = "potential"
 
+		#Number of threads used by each task to grid the particles
+		self.num_threads = 1
+
 		#On the fly raytracing
 		self.do_lensing = False
 		self.integration_type = "full"
@@ -343,6 +398,11 @@ class PlaneLightConeSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.num_threads = options.getint(section,"num_threads")
+		except NoOptionError:
+			pass
+
 		try:
 			settings.kind = options.get(section,"kind")
 		except NoOptionError:
@@ -404,6 +464,7 @@ class MapSettings(LTSettings):
 
 		#Which lensing quantities do we need?
 		self.tomographic_convergence = False
+		self.tomographic_redshifts = None
 		self.convergence = True
 		self.convergence_ks = False
 		self.shear = False
@@ -414,6 +475,18 @@ class MapSettings(LTSettings):
 		#Line of sight integration type
 		self.integration_type = "born"
 
+		#Save a time and memory profile of the lens crossings next to the maps
+		self.profile = False
+
+		#Checkpoint the ray state every few lenses, so that interrupted jobs can resume (0 disables checkpoints)
+		self.checkpoint_every = 0
+
+		#Hand out the realizations to the MPI tasks dynamically, instead of in contiguous ranges of the same size
+		self.dynamic_queue = False
+
+		#Share the lens planes read from disk among the MPI tasks on the same node
+		self.shared_planes = False
+
 	def _init_plane_set(self):
 
 		#Set of lens planes to be used during ray tracing
@@ -429,6 +502,9 @@ class MapSettings(LTSettings):
 		self.lens_map_realizations = 4
 		self.first_realization = 1
 
+		#Number of map realizations that share the same lens planes (each with an independent random roll)
+		self.maps_per_plane_set = 1
+
 	###############################################################################################################################################
 
 	@classmethod
@@ -489,6 +565,11 @@ class MapSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			self.tomographic_redshifts = [ float(z) for z in options.get(section,"tomographic_redshifts").split(",") ]
+		except NoOptionError:
+			pass
+
 		try:
 			self.convergence = options.getboolean(section,"convergence")
 		except NoOptionError:
@@ -526,6 +607,26 @@ class MapSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			self.profile = options.getboolean(section,"profile")
+		except NoOptionError:
+			pass
+
+		try:
+			self.checkpoint_every = options.getint(section,"checkpoint_every")
+		except NoOptionError:
+			pass
+
+		try:
+			self.dynamic_queue = options.getboolean(section,"dynamic_queue")
+		except NoOptionError:
+			pass
+
+		try:
+			self.shared_planes = options.getboolean(section,"shared_planes")
+		except NoOptionError:
+			pass
+
 	def _read_plane_set(self,options,section):
 		
 		self.plane_set = options.get(section,"plane_set")
@@ -546,6 +647,11 @@ class MapSettings(LTSettings):
 		except NoOptionError:
 			self.first_realization = 1
 
+		try:
+			self.maps_per_plane_set = options.getint(section,"maps_per_plane_set")
+		except NoOptionError:
+			self.maps_per_plane_set = 1
+
 
 
 ###########################################################
@@ -574,6 +680,7 @@ class TelescopicMapSettings(MapSettings):
 		self.mix_cut_points = ([0],)
 		self.mix_normals = ([0],)
 		self.lens_map_realizations = 4
+		self.maps_per_plane_set = 1
 
 	def _read_plane_set(self,options,section):
 		
@@ -595,6 +702,11 @@ class TelescopicMapSettings(MapSettings):
 		except NoOptionError:
 			self.first_realization = 1
 
+		try:
+			self.maps_per_plane_set = options.getint(section,"maps_per_plane_set")
+		except NoOptionError:
+			self.maps_per_plane_set = 1
+
 
 
 #####################################################
@@ -642,6 +754,9 @@ class CatalogSettings(LTSettings):
 		#Reduced shear
 		self.reduced_shear = False
 
+		#Hand out the realizations to the MPI tasks dynamically, instead of in contiguous ranges of the same size
+		self.dynamic_queue = False
+
 		#Allow for kwargs override
 		for key in kwargs:
 			setattr(self,key,kwargs[key])
@@ -707,6 +822,11 @@ class CatalogSettings(LTSettings):
 		except NoOptionError:
 			pass
 
+		try:
+			settings.dynamic_queue = options.getboolean(section,"dynamic_queue")
+		except NoOptionError:
+			pass
+
 		#Return to user
 		return settings
 
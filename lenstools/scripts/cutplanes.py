@@ -6,6 +6,12 @@ from __future__ import division
 
 import sys,os
 import json
+import threading
+
+try:
+	from queue import Queue
+except ImportError:
+	from Queue import Queue
 
 from lenstools.simulations.logs import logdriver,logstderr,peakMemory,peakMemoryAll
 
@@ -22,6 +28,7 @@ from lenstools.simulations.raytracing import RayTracer
 
 from lenstools.utils import MPIWhirlPool
 from lenstools import configuration
+from lenstools import extern as ext
 import glob
 import numpy as np
 from astropy.cosmology import z_at_value
@@ -29,6 +36,59 @@ from scipy.interpolate import interp1d
 #FFT engine
 fftengine = lenstools.simulations.nbody.fftengine
 
+################################################################
+################Background snapshot reading#####################
+################################################################
+
+def _prefetch(read,items,buffers=2):
+
+	"""
+	Iterate over read(item) for each item in items, calling read in a background thread so that the next items are read while the current one is processed; at most buffers items are read ahead of the one the caller is done with (the reading must not make MPI calls)
+
+	"""
+
+	slots = threading.Semaphore(buffers)
+	ready = Queue()
+	stop = threading.Event()
+
+	def reader():
+		for item in items:
+			slots.acquire()
+			if stop.is_set():
+				return
+			try:
+				ready.put((read(item),None))
+			except Exception as e:
+				ready.put((None,e))
+				return
+
+	thread = threading.Thread(target=reader)
+	thread.daemon = True
+	thread.start()
+
+	try:
+		for item in items:
+			result,error = ready.get()
+			if error is not None:
+				raise error
+			yield result
+			
+			#The caller is done with this item (it must have dropped its own references to it by now): free its slot for the next read
+			del result
+			slots.release()
+
+	finally:
+		stop.set()
+		slots.release()
+
+#Class used to open the snapshots: when the particles are streamed from the snapshot files in chunks, handlers that read all the positions in the constructor are replaced by their lazy counterpart
+def _snapshotReader(snapshot_handler,chunk_size):
+
+	if chunk_size is not None:
+		return snapshot_handler._lazyHandler()
+
+	return snapshot_handler
+
 ################################################################
 ################Constant time snapshots#########################
 ################################################################
@@ -124,16 +184,14 @@ def cnstTime(pool,batch,settings,batch_id,override):
 	thickness_resolution = settings.thickness_resolution
 	smooth = 1 ###settings.smooth
 	kind = settings.kind
+	assignment = getattr(settings,"assignment","NGP")
+	interlacing = getattr(settings,"interlacing",False)
 
-	#Place holder for the lensing density on the plane
-	density_projected = np.empty((plane_resolution,)*2,dtype=np.float32)
+	#Threads used by each task to grid the particles
+	ext._nbody.set_num_threads(getattr(settings,"num_threads",1))
 
-	#Open a RMA window on the density placeholder
-	if pool is not None:
-		pool.openWindow(density_projected)
-		
-		if pool.is_master():
-			logdriver.debug("Opened density window of type {0}".format(pool._window_type))
+	#Place holder for the lensing density on the planes (all the planes of a snapshot are cut at once, twice with interlacing)
+	density_projected = np.empty(((1+interlacing)*len(cut_points)*len(normals),)+(plane_resolution,)*2,dtype=np.float32)
 
 	#Pre--compute multipoles for solving Poisson equation
 	lx,ly = np.meshgrid(fftengine.fftfreq(plane_resolution),fftengine.rfftfreq(plane_resolution),indexing="ij")
@@ -149,6 +207,8 @@ def cnstTime(pool,batch,settings,batch_id,override):
 	"thickness_resolution" : thickness_resolution,
 	"smooth" : smooth,
 	"kind" : kind,
+	"assignment" : assignment,
+	"interlacing" : interlacing,
 	"density_placeholder" : density_projected,
 	"l_squared" : l_squared
 
@@ -160,15 +220,28 @@ def cnstTime(pool,batch,settings,batch_id,override):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
 
-	num_planes_total = len(snapshots)*len(cut_points)*len(normals)
-	nplane = 1 
-
-	#Cycle over each snapshot
+	#Skip the snapshots whose planes have all been cut already
+	snapshots_to_cut = list()
 	for n in snapshots:
 		print 'length of',save_path+'/snap%i_*'%(n), len(glob.glob(save_path+'/snap%i_*'%(n))), len(cut_points) * len(normals)
 		if len(glob.glob(save_path+'/snap%i_*'%(n))) == len(cut_points) * len(normals):
 			print 'skip snapshot', n
 			continue
+		snapshots_to_cut.append(n)
+
+	num_planes_total = len(snapshots)*len(cut_points)*len(normals)
+	nplane = 1 
+
+	#If not None, the particles are streamed from the snapshot file in chunks when cutting the planes
+	chunk_size = getattr(settings,"chunk_size",None)
+	snapshot_reader = _snapshotReader(snapshot_handler,chunk_size)
+
+	if (snapshot_reader is not snapshot_handler) and ((pool is None) or (pool.is_master())):
+		logdriver.info("Streaming the particles in chunks of {0}: opening the snapshots with {1} instead of {2}".format(chunk_size,snapshot_reader.__name__,snapshot_handler.__name__))
+
+	#Open a snapshot and read the particle positions
+	def readSnapshot(n):
+
 		#Log
 		if (pool is None) or (pool.is_master()):
 			logdriver.info("Waiting for input files from snapshot {0}...".format(n))
@@ -178,7 +251,7 @@ def cnstTime(pool,batch,settings,batch_id,override):
 		if pool is not None:
 			logdriver.info("Task {0} reading nbody snapshot from {1}".format(pool.comm.rank,snapshot_filename))
 
-		snap = snapshot_handler.open(snapshot_filename,pool=pool)
+		snap = snapshot_reader.open(snapshot_filename,pool=pool)
 
 		#Insert correct comoving distance and cosmology into header
 		if "comoving_distance" not in snap.header:
@@ -210,8 +283,8 @@ def cnstTime(pool,batch,settings,batch_id,override):
 		if pool is not None:
 			logdriver.debug("Task {0} read nbody snapshot from {1}".format(pool.comm.rank,snapshot_filename))
 
-		#Get the positions of the particles
-		if not hasattr(snap,"positions"):
+		#Get the positions of the particles (unless they are streamed from the snapshot file in chunks when cutting the planes)
+		if (chunk_size is None) and not hasattr(snap,"positions"):
 			snap.getPositions(first=snap._first,last=snap._last)
 
 		#Log memory usage
@@ -219,26 +292,48 @@ def cnstTime(pool,batch,settings,batch_id,override):
 			logstderr.debug("Read particle positions: peak memory usage {0:.3f} (task)".format(peakMemory()))
 
 		#Close the snapshot file
-		snap.close()
+		if chunk_size is None:
+			snap.close()
+
+		return n,snap,has_nu,ratio_interp
+
+	#Read the snapshots in order, in the background if prompted (at most two snapshots in memory at any time)
+	if getattr(settings,"prefetch_snapshots",False):
+		
+		if (pool is None) or (pool.is_master()):
+			logdriver.info("Reading the next snapshot in the background while the planes are cut")
+		
+		snapshot_buffer = _prefetch(readSnapshot,snapshots_to_cut)
+	
+	else:
+		snapshot_buffer = ( readSnapshot(n) for n in snapshots_to_cut )
+
+	#Cycle over each snapshot
+	for n,snap,has_nu,ratio_interp in snapshot_buffer:
 
 		#Update the summary info file
 		if (pool is None) or (pool.is_master()):
 			infofile.write("s={0},d={1},z={2}\n".format(n,snap.header["comoving_distance"],snap.header["redshift"]))
 
-		#Cut the lens planes
+		#Cut all the lens planes with a single pass over the particles
+		slabs = [ (normal,pos,thickness) for pos in cut_points for normal in normals ]
+
+		if pool is None or pool.is_master():
+			logdriver.info("Cutting {0} {1} planes at {2} with normals {3},thickness {4}, of size {5} x {5}".format(len(slabs),kind,cut_points,normals,thickness,snap.header["box_size"]))
+
+		############################
+		#####Do the cutting#########
+		############################
+
+		cut_planes = snap.cutPlanes(slabs,left_corner=np.zeros(3)*snap.Mpc_over_h,add_nu_density=has_nu,ratio_interp=ratio_interp,chunk_size=chunk_size,**kwargs)
+
+		#######################################################################################################################################
+
+		#Save the lens planes
 		for cut,pos in enumerate(cut_points):
 			for normal in normals:
 
-				if pool is None or pool.is_master():
-					logdriver.info("Cutting {0} plane at {1} with normal {2},thickness {3}, of size {4} x {4}".format(kind,pos,normal,thickness,snap.header["box_size"]))
-
-				############################
-				#####Do the cutting#########
-				############################
-				
-				plane,resolution,NumPart = snap.cutPlaneGaussianGrid(normal=normal,center=pos,thickness=thickness,left_corner=np.zeros(3)*snap.Mpc_over_h,add_nu_density=has_nu,ratio_interp=ratio_interp,**kwargs)
-				
-				#######################################################################################################################################
+				plane,resolution,NumPart = cut_planes.pop(0)
 
 				#Save the plane
 				plane_file = batch.syshandler.map(os.path.join(save_path,settings.name_format.format(n,kind,cut,normal,settings.format)))
@@ -255,7 +350,7 @@ def cnstTime(pool,batch,settings,batch_id,override):
 
 					#Save the result
 					logdriver.info("Saving plane to {0}".format(plane_file))
-					plane_wrap.save(plane_file)
+					plane_wrap.save(plane_file,lmax=getattr(settings,"lmax",None),compress=getattr(settings,"compress",False))
 					logdriver.debug("Saved plane to {0}".format(plane_file))
 
 
@@ -270,16 +365,17 @@ def cnstTime(pool,batch,settings,batch_id,override):
 				if pool is not None:
 					pool.comm.Barrier()
 
+		#Close the snapshot file, if the particles were streamed from it
+		if not snap.fp.closed:
+			snap.close()
+
+		#Drop the snapshot before asking for the next one, which releases its slot to the background reader (otherwise three snapshots could be in memory at once)
+		del snap,cut_planes
+
 	#Safety barrier sync
 	if pool is not None:
 		pool.comm.Barrier()
 
-		#Close the RMA window
-		pool.closeWindow()
-		
-		if pool.is_master():
-			logdriver.debug("Closed density window of type {0}".format(pool._window_type))
-
 	#Close the infofile
 	if (pool is None) or (pool.is_master()):
 		infofile.close()
@@ -387,6 +483,9 @@ def lightCone(pool,batch,settings,batch_id,override):
 	#Kind (density, potential or born)
 	kind = settings.kind
 
+	#Threads used by each task to grid the particles
+	ext._nbody.set_num_threads(getattr(settings,"num_threads",1))
+
 	#Place holder for the lensing density on the plane
 	density_projected = np.empty((plane_resolution,)*2,dtype=np.float32)
 
@@ -405,7 +504,7 @@ def lightCone(pool,batch,settings,batch_id,override):
 
 	#Open a RMA window on the density placeholder
 	if pool is not None:
-		pool.openWindow(density_projected)
+		pool.openWindow(density_projected,window_type="collective")
 		
 		if pool.is_master():
 			logdriver.debug("Opened density window of type {0}".format(pool._window_type))
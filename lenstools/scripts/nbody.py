@@ -68,6 +68,7 @@ def matterPowerSpectrum(pool,batch,settings,node_id,**kwargs):
 		logdriver.info("Bin size: {0}".format(((settings.kmax-settings.kmin)/settings.num_k_bins).to(model.Mpc_over_h**-1)))
 		logdriver.info("FFT grid size: {0}".format(settings.fft_grid_size))
 		logdriver.info("Number of bins: {0}".format(settings.num_k_bins))
+		logdriver.info("Distributed FFT: {0}".format(settings.distributed))
 
 		#Create dedicated ensemble directory
 		ensemble_dir = os.path.join(collection.home_subdir,settings.ensemble_name)
@@ -77,10 +78,14 @@ def matterPowerSpectrum(pool,batch,settings,node_id,**kwargs):
 	#Construct the array of bin edges
 	k_egdes  = np.linspace(settings.kmin,settings.kmax,settings.num_k_bins+1).to(model.Mpc_over_h**-1)
 
-	#Placeholder for the density MPI communications
-	density_placeholder = np.empty((settings.fft_grid_size,)*3,dtype=np.float32)
-	if pool is not None:
-		pool.openWindow(density_placeholder)
+	#Placeholder for the density MPI communications (with the distributed FFT each task holds only a slab of the density grid)
+	if settings.distributed:
+		density_placeholder = None
+	else:
+		density_placeholder = np.empty((settings.fft_grid_size,)*3,dtype=np.float32)
+	
+	if (pool is not None) and (density_placeholder is not None):
+		pool.openWindow(density_placeholder,window_type="collective")
 
 		if pool.is_master():
 			logdriver.debug("Opened density window of type {0}".format(pool._window_type))
@@ -112,7 +117,7 @@ def matterPowerSpectrum(pool,batch,settings,node_id,**kwargs):
 					sys.exit(1)
 
 			snap = fmt.open(realization.snapshotPath(n,sub=None),pool=pool)
-			k,power_ensemble[r],hits = snap.powerSpectrum(k_egdes,resolution=settings.fft_grid_size,return_num_modes=True,density_placeholder=density_placeholder)
+			k,power_ensemble[r],hits = snap.powerSpectrum(k_egdes,resolution=settings.fft_grid_size,return_num_modes=True,density_placeholder=density_placeholder,distributed=settings.distributed)
 			snap.close()
 
 			#Safety barrier sync
@@ -147,7 +152,7 @@ def matterPowerSpectrum(pool,batch,settings,node_id,**kwargs):
 	###########
 
 	#Close the RMA window
-	if pool is not None:
+	if (pool is not None) and (density_placeholder is not None):
 		pool.comm.Barrier()
 		pool.closeWindow()
 		
@@ -184,6 +189,9 @@ class PowerSpectrumSettings(object):
 		self.length_unit = u.Mpc
 		self.num_k_bins = 50
 
+		#Distribute the density grid in slabs between the tasks
+		self.distributed = False
+
 		#Allow for kwargs override
 		for key in kwargs.keys():
 			setattr(self,key,kwargs[key])
@@ -225,6 +233,11 @@ class PowerSpectrumSettings(object):
 		
 		settings.num_k_bins = options.getint(section,"num_k_bins")
 
+		try:
+			settings.distributed = options.getboolean(section,"distributed")
+		except NoOptionError:
+			pass
+
 		#Return to user
 		return settings
 
@@ -0,0 +1,35 @@
+from .. import configuration
+from ..simulations.logs import logdriver
+import sys
+import argparse
+import logging
+
+def main(args=None):
+
+	parser = argparse.ArgumentParser()
+	parser.add_argument("-v","--verbose",dest="verbose",action="store_true",default=False,help="turn output verbosity")
+	parser.add_argument("-n","--num-cells",dest="num_cells",action="store",type=int,default=64,help="number of cells along each axis of the grid used to sort the particles")
+	parser.add_argument("-c","--chunk-size",dest="chunk_size",action="store",type=int,default=None,help="sort the particles chunk_size at a time, instead of reading them all in memory")
+	parser.add_argument("filename",nargs="+",help="path to one or more N-body simulation snapshots to sort")
+
+	args = parser.parse_args(args)
+	
+	if args.filename is None:
+		parser.print_help()
+		sys.exit(0)
+
+	#Verbosity level
+	if args.verbose:
+		logging.basicConfig(level=logging.DEBUG)
+	else:
+		logging.basicConfig(level=logging.INFO)
+
+	#Write a spatially sorted copy of the positions next to each snapshot (the snapshots are opened lazily, so that only chunk_size particles at a time are in memory)
+	snapshot_handler = configuration.snapshot_handler._lazyHandler()
+	for filename in args.filename:
+		
+		snap = snapshot_handler.open(filename)
+		positions_file,index_file = snap.writeSortedSidecar(num_cells=args.num_cells,chunk_size=args.chunk_size)
+		snap.close()
+
+		logdriver.info("{0} --> {1},{2}".format(filename,positions_file,index_file))
@@ -10,7 +10,7 @@ import gc
 from operator import add
 from functools import reduce
 
-from lenstools.simulations.logs import logdriver,logstderr,peakMemory,peakMemoryAll
+from lenstools.simulations.logs import logdriver,logstderr,peakMemory,peakMemoryAll,Profiler
 
 from lenstools.utils.mpi import MPIWhirlPool
 
@@ -43,6 +43,45 @@ def _subdirectories(num_realizations,realizations_in_subdir):
 
 	return s
 
+#############################################################
+#########Assign realizations to the MPI tasks################
+#############################################################
+
+def _realizations(pool,first_realization,num_realizations,kind="map",step=1,dynamic=False,skip=None):
+
+	#Dynamic queue: the master hands out the realizations one batch at a time, skipping the ones already on disk
+	if (pool is not None) and dynamic:
+		if pool.is_master():
+			logdriver.info("Lensing {0} realizations from {1} to {2} will be handed out dynamically to {3} tasks".format(kind,first_realization+1,first_realization+num_realizations,pool.size+1))
+		return pool.workQueue(range(first_realization,first_realization+num_realizations,step),skip=skip),num_realizations
+
+	if pool is None:
+		logdriver.debug("Generating lensing {0} realizations from {1} to {2}".format(kind,first_realization+1,first_realization+num_realizations))
+		return range(first_realization,first_realization+num_realizations,step),num_realizations
+
+	#Static assignment of contiguous ranges
+	assert num_realizations%(pool.size+1)==0,"Perfect load-balancing enforced, the number of {0} realizations must be a multiple of the number of MPI tasks (or set dynamic_queue)!".format(kind)
+	realizations_per_task = num_realizations//(pool.size+1)
+	first = realizations_per_task*pool.rank + first_realization
+	last = realizations_per_task*(pool.rank+1) + first_realization
+	logdriver.debug("Task {0} will generate lensing {1} realizations from {2} to {3}".format(pool.rank,kind,first+1,last))
+
+	return range(first,last,step),realizations_per_task
+
+#Decide if the lens planes are shared among the tasks on each node: all the tasks on a node then load their lenses in step, which needs the static assignment of the realizations and no checkpoints (a resumed task would skip the lenses before its checkpoint)
+def _sharedPlanes(pool,settings,dynamic,checkpoint_every):
+
+	if (pool is None) or not(getattr(settings,"shared_planes",False)):
+		return False
+
+	assert not dynamic,"shared_planes is not compatible with dynamic_queue, the tasks on a node must load their lenses in step!"
+	assert checkpoint_every==0,"shared_planes is not compatible with checkpoint_every, the tasks on a node must load their lenses in step!"
+
+	if pool.is_master():
+		logdriver.info("The lens planes will be shared among the tasks on each node")
+
+	return True
+
 #####################################################################################
 #######Callback to call during raytracing to save the convergence at every step######
 #####################################################################################
@@ -163,17 +202,17 @@ def singleRedshift(pool,batch,settings,batch_id):
 	except AttributeError:
 		realization_offset = 0
 
-	if pool is None:
-		first_map_realization = 0 + realization_offset
-		last_map_realization = map_realizations + realization_offset
-		realizations_per_task = map_realizations
-		logdriver.debug("Generating lensing map realizations from {0} to {1}".format(first_map_realization+1,last_map_realization))
-	else:
-		assert map_realizations%(pool.size+1)==0,"Perfect load-balancing enforced, map_realizations must be a multiple of the number of MPI tasks!"
-		realizations_per_task = map_realizations//(pool.size+1)
-		first_map_realization = realizations_per_task*pool.rank + realization_offset
-		last_map_realization = realizations_per_task*(pool.rank+1) + realization_offset
-		logdriver.debug("Task {0} will generate lensing map realizations from {1} to {2}".format(pool.rank,first_map_realization+1,last_map_realization))
+	#Realizations whose convergence maps are already on disk (at each of the source redshifts, when tracing several in one pass) are skipped
+	def convergenceSaved(zs,r):
+		return os.path.isfile(batch.syshandler.map(os.path.join(save_path,"WLconv_z{0:.2f}_{1:04d}r.{2}".format(zs,r+1,settings.format))))
+
+	def skip(r):
+		if getattr(settings,"tomographic_redshifts",None) is not None:
+			return all([ convergenceSaved(zs,r) for zs in settings.tomographic_redshifts ])
+		return settings.convergence and convergenceSaved(source_redshift,r)
+
+	dynamic = getattr(settings,"dynamic_queue",False)
+	realizations,realizations_per_task = _realizations(pool,realization_offset,map_realizations,dynamic=dynamic,skip=skip)
 
 	#Planes will be read from this path
 	plane_path = os.path.join("{0}","ic{1}","{2}")
@@ -208,18 +247,26 @@ def singleRedshift(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
+	#Time and memory profile of the lens crossings (optional)
+	profiler = Profiler(enabled=getattr(settings,"profile",False))
+
+	#Checkpoint frequency (0 means no checkpoints)
+	checkpoint_every = getattr(settings,"checkpoint_every",0)
+
+	#Lens planes shared among the tasks on each node (optional)
+	shared_planes = _sharedPlanes(pool,settings,dynamic,checkpoint_every)
+
 	#We need one of these for cycles for each map random realization
-	for rloc,r in enumerate(range(first_map_realization,last_map_realization)):
-		######## JL skip this map if already exist
-		if settings.convergence:
-              		savename = batch.syshandler.map(os.path.join(save_path,"WLconv_z{0:.2f}_{1:04d}r.{2}".format(source_redshift,r+1,settings.format)))
-			if os.path.isfile(savename):
-				continue
+	for rloc,r in enumerate(realizations):
+		######## JL skip this map if already exist (with shared planes, only if all the tasks on the node skip it, since they load their lenses in step)
+		if (all(pool.node_comm.allgather(skip(r))) if shared_planes else skip(r)):
+			continue
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
 
 		#Instantiate the RayTracer
-		tracer = RayTracer()
+		profiler.tags["realization"] = r+1
+		tracer = RayTracer(profile=profiler,pool=pool if shared_planes else None)
 
 		#Force garbage collection
 		gc.collect()
@@ -297,15 +344,37 @@ def singleRedshift(pool,batch,settings,batch_id):
 		xx,yy = np.meshgrid(b,b)
 		pos = np.array([xx,yy]) * map_angle.unit
 
-		if settings.tomographic_convergence:
+		#The ray state is checkpointed next to the maps, an interrupted job resumes from the last checkpoint
+		if checkpoint_every>0:
+			checkpoint = batch.syshandler.map(os.path.join(save_path,"checkpoint_{0:04d}r.npz".format(r+1)))
+		else:
+			checkpoint = None
+
+		if getattr(settings,"tomographic_redshifts",None) is not None:
+
+			#Trace the rays once, collecting the convergence at each of the source redshifts
+			convergence = tracer.shoot(pos,z=list(settings.tomographic_redshifts),kind="convergence",checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1))
+
+			now = time.time()
+			logdriver.info("Tomographic ray tracing for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
+			last_timestamp = now
+
+			for zs,conv in zip(settings.tomographic_redshifts,convergence):
+				convMap = ConvergenceMap(data=np.mean(conv.reshape(resolution,4,resolution,4),axis=(1,3)),angle=map_angle,cosmology=map_batch.cosmology,redshift=zs)
+				savename = batch.syshandler.map(os.path.join(save_path,"WLconv_z{0:.2f}_{1:04d}r.{2}".format(zs,r+1,settings.format)))
+				logdriver.info("Saving convergence map to {0}".format(savename)) 
+				convMap.save(savename)
+				logdriver.debug("Saved convergence map to {0}".format(savename))
+
+		elif settings.tomographic_convergence:
 
 			#Trace the ray deflections and save the convergence at every step
-			tracer.shoot(pos,z=source_redshift,kind="jacobians",callback=convergence_callback,realization=r,angle=map_angle,map_batch=map_batch,settings=settings)
+			tracer.shoot(pos,z=source_redshift,kind="jacobians",callback=convergence_callback,checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1),realization=r,angle=map_angle,map_batch=map_batch,settings=settings)
 
 		else:
 
 			#Trace the ray deflections
-			jacobian = tracer.shoot(pos,z=source_redshift,kind="jacobians")
+			jacobian = tracer.shoot(pos,z=source_redshift,kind="jacobians",checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1))
 
 			now = time.time()
 			logdriver.info("Jacobian ray tracing for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
@@ -365,21 +434,36 @@ def singleRedshift(pool,batch,settings,batch_id):
 				logdriver.info("Saving omega map to {0}".format(savename))
 				omegaMap.save(savename)
 
+		#Free the node shared memory that holds the lens planes
+		if shared_planes:
+			tracer.closeSharedPlanes()
+
 		now = time.time()
 		
-		#Log peak memory usage to stdout
-		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
+		#Log peak memory usage to stdout (with the dynamic queue the tasks process different numbers of realizations, so there is no collective memory reduction)
+		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(None if dynamic else pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
-		#Log progress and peak memory usage to stderr
-		if (pool is None) or (pool.is_master()):
+		#Log progress and peak memory usage to stderr (with the dynamic queue, the master logs the progress on all the realizations as the tasks complete them)
+		if (pool is not None) and dynamic:
+			if pool.is_master():
+				logstderr.info("Peak memory usage: {0:.3f} (task)".format(peak_memory_task))
+		elif (pool is None) or (pool.is_master()):
 			logstderr.info("Progress: {0:.2f}%, peak memory usage: {1:.3f} (task), {2[0]:.3f} (all {2[1]} tasks)".format(100*(rloc+1.)/realizations_per_task,peak_memory_task,peak_memory_all))
 	
 	#Safety sync barrier
 	if pool is not None:
 		pool.comm.Barrier()
 
+	#Save the profile of all the tasks next to the maps
+	if profiler.enabled:
+		profile = profiler.gather(pool)
+		if (pool is None) or (pool.is_master()):
+			savename = batch.syshandler.map(os.path.join(save_path,"profile_raytracing_z{0:.2f}.csv".format(source_redshift)))
+			logdriver.info("Saving time and memory profile to {0}".format(savename))
+			profile.to_csv(savename,index=False)
+
 	if (pool is None) or (pool.is_master()):	
 		now = time.time()
 		logdriver.info("Total runtime {0:.3f}s".format(now-begin))
@@ -390,7 +474,9 @@ def singleRedshift(pool,batch,settings,batch_id):
 #######Save intermediate results of LOS integration######
 #########################################################
 
-def save_intermediate(add_on,tracer,k,ctype,map_batch=None,map_angle=None,realization=None):
+def save_intermediate(add_on,tracer,k,ctype,map_batch=None,map_angle=None,realization=None,batch=None):
+	if batch is not None:
+		realization = realization[batch]
 	savename = os.path.join(map_batch.storage,"{0}-lens{1}-{2:04d}r.fits".format(ctype,k,realization))
 	logdriver.info("Saving z={0:.3f} add-on to convergence to {1}".format(tracer.redshift[k],savename))
 	side = map_angle.to(u.rad).value*tracer.distance[k]
@@ -505,23 +591,39 @@ def losIntegrate(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logdriver.info("Line of sight integration type: {0}".format(settings.integration_type))
 
+	#Map realizations that share the same lens planes are integrated together, loading each plane once
+	maps_per_plane_set = getattr(settings,"maps_per_plane_set",1)
+	if (maps_per_plane_set>1) and (settings.integration_type=="omega2"):
+		if (pool is None) or (pool.is_master()):
+			logdriver.error("Integration type {0} does not support maps_per_plane_set>1".format(settings.integration_type))
+		sys.exit(1)
+
 	#Decide which map realizations this MPI task will take care of (if pool is None, all of them)
 	try:
 		realization_offset = settings.first_realization - 1
 	except AttributeError:
 		realization_offset = 0
 
-	if pool is None:
-		first_map_realization = 0 + realization_offset
-		last_map_realization = map_realizations + realization_offset
-		realizations_per_task = map_realizations
-		logdriver.debug("Generating lensing map realizations from {0} to {1}".format(first_map_realization+1,last_map_realization))
-	else:
-		assert map_realizations%(pool.size+1)==0,"Perfect load-balancing enforced, map_realizations must be a multiple of the number of MPI tasks!"
-		realizations_per_task = map_realizations//(pool.size+1)
-		first_map_realization = realizations_per_task*pool.rank + realization_offset
-		last_map_realization = realizations_per_task*(pool.rank+1) + realization_offset
-		logdriver.debug("Task {0} will generate lensing map realizations from {1} to {2}".format(pool.rank,first_map_realization+1,last_map_realization))
+	#Realizations in the batch that starts at r (the last batch may be incomplete)
+	last_realization = realization_offset + map_realizations
+	batchRealizations = lambda r:list(range(r,min(r+maps_per_plane_set,last_realization)))
+
+	#Batches of realizations whose maps are all on disk are skipped
+	def skip(r):
+		for rb in batchRealizations(r):
+			savename = batch.syshandler.map(os.path.join(save_path,"{0}_z{1:.2f}_{2:04d}r".format(settings.integration_type,source_redshift,rb+1)))
+			if settings.transpose_up_to>=0:
+				savename += "_t{0}".format(settings.transpose_up_to)
+			if not os.path.isfile(savename + ".{0}".format(settings.format)):
+				return False
+		return True
+
+	dynamic = getattr(settings,"dynamic_queue",False)
+	realizations,realizations_per_task = _realizations(pool,realization_offset,map_realizations,step=maps_per_plane_set,dynamic=dynamic,skip=skip)
+
+	#With the static assignment the batches must not cross the realizations of other tasks (the dynamic queue hands out whole batches)
+	if not dynamic:
+		assert realizations_per_task%maps_per_plane_set==0,"The number of map realizations per task must be a multiple of maps_per_plane_set!"
 
 	#Planes will be read from this path
 	plane_path = os.path.join("{0}","ic{1}","{2}")
@@ -556,17 +658,27 @@ def losIntegrate(pool,batch,settings,batch_id):
 	if (pool is None) or (pool.is_master()):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
-	#We need one of these for cycles for each map random realization
-	for rloc,r in enumerate(range(first_map_realization,last_map_realization)):
+	#Time and memory profile of the lens crossings (optional)
+	profiler = Profiler(enabled=getattr(settings,"profile",False))
 
-		#Set random seed to generate the realizations
-		np.random.seed(settings.seed + r)
+	#Checkpoint frequency (0 means no checkpoints, supported by the post Born integrations)
+	checkpoint_every = getattr(settings,"checkpoint_every",0)
+
+	#Lens planes shared among the tasks on each node (optional)
+	shared_planes = _sharedPlanes(pool,settings,dynamic,checkpoint_every)
+
+	#We need one of these for cycles for each map random realization (or for each batch of realizations that share the lens planes)
+	for rloc,r in enumerate(realizations):
+
+		#Realizations in the batch
+		batch_realizations = batchRealizations(r)
 
 		#Instantiate the RayTracer
+		profiler.tags["realization"] = r+1
 		if settings.lens_type=="PotentialPlane":
-			tracer = RayTracer()
+			tracer = RayTracer(profile=profiler,pool=pool if shared_planes else None)
 		elif settings.lens_type=="DensityPlane":
-			tracer = RayTracer(lens_type=DensityPlane)
+			tracer = RayTracer(lens_type=DensityPlane,profile=profiler,pool=pool if shared_planes else None)
 		else:
 			raise ValueError("Lens type {0} not recognized!".format(settings.lens_type))
 
@@ -581,59 +693,71 @@ def losIntegrate(pool,batch,settings,batch_id):
 		###############Add the lenses to the system##################
 		#############################################################
 
-		#Open the info file to read the lens specifications (assume the info file is the same for all nbody realizations)
-		infofile = open(info_filename,"r")
+		#Each realization in the batch draws its lenses (and then the rolls of the lenses) with its own generator, seeded as without batches, so that the maps do not depend on maps_per_plane_set
+		if maps_per_plane_set>1:
+			generators = [ np.random.RandomState(settings.seed + rb) for rb in batch_realizations ]
+			tracers = [ tracer ] + [ RayTracer(lens_type=tracer.lens_type,profile=profiler) for rb in batch_realizations[1:] ]
+		else:
+			np.random.seed(settings.seed + r)
+			generators = [ np.random ]
+			tracers = [ tracer ]
 
-		#Read the info file line by line, and decide if we should add the particular lens corresponding to that line or not
-		for s in range(num_snapshots):
+		for rb,generator,tracer_rb in zip(batch_realizations,generators,tracers):
 
-			#Read the line
-			line = infofile.readline().strip("\n")
+			#Open the info file to read the lens specifications (assume the info file is the same for all nbody realizations)
+			infofile = open(info_filename,"r")
 
-			#Stop if there is nothing more to read
-			if line=="":
-				break
+			#Read the info file line by line, and decide if we should add the particular lens corresponding to that line or not
+			for s in range(num_snapshots):
 
-			#Split the line in snapshot,distance,redshift
-			line = line.split(",")
+				#Read the line
+				line = infofile.readline().strip("\n")
 
-			snapshot_number = int(line[0].split("=")[1])
-		
-			distance,unit = line[1].split("=")[1].split(" ")
-			if unit=="Mpc/h":
-				distance = float(distance)*model.Mpc_over_h
-			else:
-				distance = float(distance)*getattr(u,"unit")
+				#Stop if there is nothing more to read
+				if line=="":
+					break
 
-			lens_redshift = float(line[2].split("=")[1])
+				#Split the line in snapshot,distance,redshift
+				line = line.split(",")
 
-			#Select the right collection
-			for n,z in enumerate(cut_redshifts):
-				if lens_redshift>=z:
-					c = n
+				snapshot_number = int(line[0].split("=")[1])
+			
+				distance,unit = line[1].split("=")[1].split(" ")
+				if unit=="Mpc/h":
+					distance = float(distance)*model.Mpc_over_h
+				else:
+					distance = float(distance)*getattr(u,"unit")
 
-			#Randomization of planes
-			nbody = np.random.randint(low=0,high=len(nbody_realizations[c]))
-			cut = np.random.randint(low=0,high=len(cut_points[c]))
-			normal = np.random.randint(low=0,high=len(normals[c]))
+				lens_redshift = float(line[2].split("=")[1])
 
-			#Log to user
-			logdriver.debug("Realization,snapshot=({0},{1}) --> NbodyIC,cut_point,normal=({2},{3},{4})".format(r,s,nbody_realizations[c][nbody],cut_points[c][cut],normals[c][normal]))
+				#Select the right collection
+				for n,z in enumerate(cut_redshifts):
+					if lens_redshift>=z:
+						c = n
 
-			#Add the lens to the system
-			logdriver.info("Adding lens at redshift {0}".format(lens_redshift))
-			plane_name = batch.syshandler.map(os.path.join(plane_path.format(collection[c].storage_subdir,nbody_realizations[c][nbody],plane_set[c]),settings.plane_name_format.format(snapshot_number,cut_points[c][cut],normals[c][normal],settings.plane_format)))
-			tracer.addLens((plane_name,distance,lens_redshift))
+				#Randomization of planes
+				nbody = generator.randint(low=0,high=len(nbody_realizations[c]))
+				cut = generator.randint(low=0,high=len(cut_points[c]))
+				normal = generator.randint(low=0,high=len(normals[c]))
 
-		#Close the infofile
-		infofile.close()
+				#Log to user
+				logdriver.debug("Realization,snapshot=({0},{1}) --> NbodyIC,cut_point,normal=({2},{3},{4})".format(rb,s,nbody_realizations[c][nbody],cut_points[c][cut],normals[c][normal]))
+
+				#Add the lens to the system
+				logdriver.info("Adding lens at redshift {0}".format(lens_redshift))
+				plane_name = batch.syshandler.map(os.path.join(plane_path.format(collection[c].storage_subdir,nbody_realizations[c][nbody],plane_set[c]),settings.plane_name_format.format(snapshot_number,cut_points[c][cut],normals[c][normal],settings.plane_format)))
+				tracer_rb.addLens((plane_name,distance,lens_redshift))
+
+			#Close the infofile
+			infofile.close()
 
 		now = time.time()
 		logdriver.info("Plane specification reading completed in {0:.3f}s".format(now-start))
 		last_timestamp = now
 
-		#Rearrange the lenses according to redshift and roll them randomly along the axes
-		tracer.reorderLenses()
+		#Rearrange the lenses according to redshift (they are rolled randomly along the axes when loaded)
+		for tracer_rb in tracers:
+			tracer_rb.reorderLenses()
 
 		now = time.time()
 		logdriver.info("Reordering completed in {0:.3f}s".format(now-last_timestamp))
@@ -644,6 +768,23 @@ def losIntegrate(pool,batch,settings,batch_id):
 		xx,yy = np.meshgrid(b,b)
 		pos = np.array([xx,yy]) * map_angle.unit
 
+		#Each realization in the batch crosses its own lenses, and rolls them with its own generator
+		if maps_per_plane_set>1:
+			pos = [pos] * len(batch_realizations)
+			rolls = generators
+			lenses = [ tracer_rb.lens for tracer_rb in tracers ]
+			realization = [ rb+1 for rb in batch_realizations ]
+		else:
+			rolls = None
+			lenses = None
+			realization = r+1
+
+		#The integration state is checkpointed next to the maps, an interrupted job resumes from the last checkpoint
+		if checkpoint_every>0:
+			checkpoint = batch.syshandler.map(os.path.join(save_path,"checkpoint_{0}_{1:04d}r.npz".format(settings.integration_type,r+1)))
+		else:
+			checkpoint = None
+
 		#Save intermediate results
 		if settings.tomographic_convergence:
 			callback = save_intermediate
@@ -652,35 +793,35 @@ def losIntegrate(pool,batch,settings,batch_id):
 
 		#Perform the line of sight integration (choose integration type)
 		if settings.integration_type=="born":
-			image = tracer.convergenceBorn(pos,z=source_redshift,save_intermediate=False)
+			image = tracer.convergenceBorn(pos,z=source_redshift,save_intermediate=False,rolls=rolls,lenses=lenses)
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="born-rt":
-			image = tracer.convergenceBorn(pos,z=source_redshift,real_trajectory=True,save_intermediate=False)
+			image = tracer.convergenceBorn(pos,z=source_redshift,real_trajectory=True,save_intermediate=False,rolls=rolls,lenses=lenses)
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn2":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,transpose_up_to=settings.transpose_up_to,callback=callback,rolls=rolls,lenses=lenses,checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1),map_batch=map_batch,map_angle=map_angle,realization=realization)
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn2-ll":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,rolls=rolls,lenses=lenses,checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1),map_batch=map_batch,map_angle=map_angle,realization=realization)
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn2-gp":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=False,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,rolls=rolls,lenses=lenses,checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1),map_batch=map_batch,map_angle=map_angle,realization=realization)
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn1+2":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,callback=callback,transpose_up_to=settings.transpose_up_to,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,callback=callback,transpose_up_to=settings.transpose_up_to,rolls=rolls,lenses=lenses,checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1),map_batch=map_batch,map_angle=map_angle,realization=realization)
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn1+2-gp":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_ll=False,transpose_up_to=settings.transpose_up_to,callback=callback,rolls=rolls,lenses=lenses,checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1),map_batch=map_batch,map_angle=map_angle,realization=realization)
 			img_type = ConvergenceMap
 
 		elif settings.integration_type=="postBorn1+2-ll":
-			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,map_batch=map_batch,map_angle=map_angle,realization=r+1)
+			image = tracer.convergencePostBorn2(pos,z=source_redshift,save_intermediate=False,include_first_order=True,include_gp=False,transpose_up_to=settings.transpose_up_to,callback=callback,rolls=rolls,lenses=lenses,checkpoint=checkpoint,checkpoint_every=max(checkpoint_every,1),map_batch=map_batch,map_angle=map_angle,realization=realization)
 			img_type = ConvergenceMap			
 
 		elif settings.integration_type=="omega2":
@@ -694,31 +835,51 @@ def losIntegrate(pool,batch,settings,batch_id):
 		logdriver.info("Line of sight integration for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		last_timestamp = now
 
-		#Save the image
-		savename = batch.syshandler.map(os.path.join(save_path,"{0}_z{1:.2f}_{2:04d}r".format(settings.integration_type,source_redshift,r+1)))
-		if settings.transpose_up_to>=0:
-			savename += "_t{0}".format(settings.transpose_up_to)
-		savename += ".{0}".format(settings.format)
+		if maps_per_plane_set==1:
+			image = [image]
+
+		#Save the images
+		for rb,image_rb in zip(batch_realizations,image):
+
+			savename = batch.syshandler.map(os.path.join(save_path,"{0}_z{1:.2f}_{2:04d}r".format(settings.integration_type,source_redshift,rb+1)))
+			if settings.transpose_up_to>=0:
+				savename += "_t{0}".format(settings.transpose_up_to)
+			savename += ".{0}".format(settings.format)
+
+			logdriver.info("Saving {0} map to {1}".format(settings.integration_type,savename))
+			img_type(data=image_rb,angle=map_angle,cosmology=map_batch.cosmology,redshift=source_redshift).save(savename)
+			logdriver.debug("Saving {0} map to {1}".format(settings.integration_type,savename)) 
 
-		logdriver.info("Saving {0} map to {1}".format(settings.integration_type,savename))
-		img_type(data=image,angle=map_angle,cosmology=map_batch.cosmology,redshift=source_redshift).save(savename)
-		logdriver.debug("Saving {0} map to {1}".format(settings.integration_type,savename)) 
+		#Free the node shared memory that holds the lens planes (the first tracer loads the lenses of the whole batch)
+		if shared_planes:
+			tracer.closeSharedPlanes()
 
 		now = time.time()
 		
-		#Log peak memory usage to stdout
-		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
+		#Log peak memory usage to stdout (with the dynamic queue the tasks process different numbers of realizations, so there is no collective memory reduction)
+		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(None if dynamic else pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
-		#Log progress and peak memory usage to stderr
-		if (pool is None) or (pool.is_master()):
-			logstderr.info("Progress: {0:.2f}%, peak memory usage: {1:.3f} (task), {2[0]:.3f} (all {2[1]} tasks)".format(100*(rloc+1.)/realizations_per_task,peak_memory_task,peak_memory_all))
+		#Log progress and peak memory usage to stderr (with the dynamic queue, the master logs the progress on all the realizations as the tasks complete them)
+		if (pool is not None) and dynamic:
+			if pool.is_master():
+				logstderr.info("Peak memory usage: {0:.3f} (task)".format(peak_memory_task))
+		elif (pool is None) or (pool.is_master()):
+			logstderr.info("Progress: {0:.2f}%, peak memory usage: {1:.3f} (task), {2[0]:.3f} (all {2[1]} tasks)".format(100*min((rloc+1.)*maps_per_plane_set/realizations_per_task,1.),peak_memory_task,peak_memory_all))
 	
 	#Safety sync barrier
 	if pool is not None:
 		pool.comm.Barrier()
 
+	#Save the profile of all the tasks next to the maps
+	if profiler.enabled:
+		profile = profiler.gather(pool)
+		if (pool is None) or (pool.is_master()):
+			savename = batch.syshandler.map(os.path.join(save_path,"profile_{0}_z{1:.2f}.csv".format(settings.integration_type,source_redshift)))
+			logdriver.info("Saving time and memory profile to {0}".format(savename))
+			profile.to_csv(savename,index=False)
+
 	if (pool is None) or (pool.is_master()):	
 		now = time.time()
 		logdriver.info("Total runtime {0:.3f}s".format(now-begin))
@@ -851,17 +1012,19 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 	except AttributeError:
 		realization_offset = 0
 
-	if pool is None:
-		first_realization = 0 + realization_offset
-		last_realization = catalog_realizations + realization_offset
-		realizations_per_task = catalog_realizations
-		logdriver.debug("Generating lensing catalog realizations from {0} to {1}".format(first_realization+1,last_realization))
-	else:
-		assert catalog_realizations%(pool.size+1)==0,"Perfect load-balancing enforced, catalog_realizations must be a multiple of the number of MPI tasks!"
-		realizations_per_task = catalog_realizations//(pool.size+1)
-		first_realization = realizations_per_task*pool.rank + realization_offset
-		last_realization = realizations_per_task*(pool.rank+1) + realization_offset
-		logdriver.debug("Task {0} will generate lensing catalog realizations from {1} to {2}".format(pool.rank,first_realization+1,last_realization))
+	#Realizations whose shear catalogs are all on disk are skipped
+	def skip(r):
+		shear_root = ("WLredshear_" if settings.reduced_shear else "WLshear_")
+		for galaxy_position_file in settings.input_files:
+			shear_catalog_name = shear_root+os.path.basename(galaxy_position_file.split(".")[0])+"_{0:04d}r.{1}".format(r+1,settings.format)
+			if len(catalog_subdirectory):
+				shear_catalog_name = os.path.join(catalog_subdirectory[r//realizations_in_subdir],shear_catalog_name)
+			if not os.path.isfile(batch.syshandler.map(os.path.join(catalog_save_path,shear_catalog_name))):
+				return False
+		return True
+
+	dynamic = getattr(settings,"dynamic_queue",False)
+	realizations,realizations_per_task = _realizations(pool,realization_offset,catalog_realizations,kind="catalog",dynamic=dynamic,skip=skip)
 
 
 	#Planes will be read from this path
@@ -882,7 +1045,7 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 		logstderr.info("Initial memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
 	#We need one of these for cycles for each map random realization
-	for rloc,r in enumerate(range(first_realization,last_realization)):
+	for rloc,r in enumerate(realizations):
 
 		#Set random seed to generate the realizations
 		np.random.seed(settings.seed + r)
@@ -994,13 +1157,16 @@ def simulatedCatalog(pool,batch,settings,batch_id):
 
 		now = time.time()
 
-		#Log peak memory usage to stdout
-		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(pool)
+		#Log peak memory usage to stdout (with the dynamic queue the tasks process different numbers of realizations, so there is no collective memory reduction)
+		peak_memory_task,peak_memory_all = peakMemory(),peakMemoryAll(None if dynamic else pool)
 		logdriver.info("Weak lensing calculations for realization {0} completed in {1:.3f}s".format(r+1,now-last_timestamp))
 		logdriver.info("Peak memory usage: {0:.3f} (task), {1[0]:.3f} (all {1[1]} tasks)".format(peak_memory_task,peak_memory_all))
 
-		#Log progress and peak memory usage to stderr
-		if (pool is None) or (pool.is_master()):
+		#Log progress and peak memory usage to stderr (with the dynamic queue, the master logs the progress on all the realizations as the tasks complete them)
+		if (pool is not None) and dynamic:
+			if pool.is_master():
+				logstderr.info("Peak memory usage: {0:.3f} (task)".format(peak_memory_task))
+		elif (pool is None) or (pool.is_master()):
 			logstderr.info("Progress: {0:.2f}%, peak memory usage: {1:.3f} (task), {2[0]:.3f} (all {2[1]} tasks)".format(100*(rloc+1.)/realizations_per_task,peak_memory_task,peak_memory_all))
 
 
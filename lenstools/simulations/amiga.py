@@ -1,9 +1,12 @@
 from __future__ import division
+import os
 import re
 
 from .nbody import NbodySnapshot
+from .logs import logplanes
 
 import numpy as np
+import pandas as pd
 
 from astropy.cosmology import w0waCDM
 import astropy.constants as cnst
@@ -80,7 +83,73 @@ class AmigaHalos(NbodySnapshot):
 		#Return to user
 		return header
 
-	def getPositions(self,first=None,last=None,save=True):
+	###############################################################################################
+	#########################Halo catalog parsing##################################################
+	###############################################################################################
+
+	#Columns of the AHF catalog that are needed: mass, position, virial radius and concentration
+	_columns = (3,5,6,7,11,42)
+
+	#Binary cache of the parsed columns, next to the AHF file
+	def _columnCache(self):
+		return "{0}.columns.npy".format(self.fp.name)
+
+	def _readColumns(self,cache=True):
+
+		#Parse only once
+		if getattr(self,"_halo_columns",None) is not None:
+			return self._halo_columns
+
+		#Read the columns from the binary cache, if it is more recent than the catalog
+		cache_file = self._columnCache()
+		if cache and os.path.exists(cache_file) and (os.path.getmtime(cache_file)>=os.path.getmtime(self.fp.name)):
+			logplanes.debug("Reading halo catalog columns from {0}".format(cache_file))
+			self._halo_columns = np.load(cache_file,mmap_mode="r")
+			return self._halo_columns
+
+		#Parse only the needed columns of the text file, with the pandas C parser
+		logplanes.debug("Parsing halo catalog {0}".format(self.fp.name))
+		columns = pd.read_csv(self.fp.name,sep=r"\s+",comment="#",header=None,usecols=self._columns,dtype=dict((c,np.float64) for c in self._columns),engine="c")
+		self._halo_columns = np.ascontiguousarray(columns[list(self._columns)].values.T)
+
+		#Write the binary cache (not fatal if the directory is read only)
+		if cache:
+			try:
+				np.save(cache_file,self._halo_columns)
+				logplanes.debug("Saved halo catalog columns to {0}".format(cache_file))
+			except (IOError,OSError):
+				logplanes.warning("Could not save halo catalog columns to {0}".format(cache_file))
+
+		return self._halo_columns
+
+	#The halos handled by this instance are the rows of the catalog
+	def _particleRange(self):
+
+		first = getattr(self,"_first",None) or 0
+		last = getattr(self,"_last",None) or self._readColumns().shape[1]
+
+		return first,last
+
+	def getPositions(self,first=None,last=None,save=True,cache=True):
+
+		"""
+		Reads in the halo positions, virial radii and concentrations (read in of a subset is allowed); only the needed columns of the AHF catalog are parsed, and they are cached in a binary file next to the catalog, which is used as long as it is more recent than the catalog
+
+		:param first: first halo in the file to be read, if None 0 is assumed
+		:type first: int. or None
+
+		:param last: last halo in the file to be read, if None the total number of halos is assumed
+		:type last: int. or None
+
+		:param save: if True saves the halo positions as attribute
+		:type save: bool.
+
+		:param cache: if True, read (or create) the binary cache of the parsed columns
+		:type cache: bool.
+
+		:returns: numpy array with the halo positions
+
+		"""
 
 		#Matter density today
 		rhoM = self.cosmology.critical_density0 * self.cosmology.Om0
@@ -88,14 +157,11 @@ class AmigaHalos(NbodySnapshot):
 		if first is None:
 			first = 0
 
-		if last is None:
-			m,x,y,z,rv,c = np.loadtxt(self.fp,usecols=(3,5,6,7,11,42))[first:].T
-		else:
-			m,x,y,z,rv,c = np.loadtxt(self.fp,usecols=(3,5,6,7,11,42))[first:last].T
+		m,x,y,z,rv,c = self._readColumns(cache)[:,first:last]
 		
 		positions = np.array((x,y,z)).astype(np.float32).T * self.kpc_over_h
 		self.virial_radius = rv * self.kpc_over_h 
-		self.concentration = c
+		self.concentration = np.array(c)
 		self.weights = ((1./(4*np.pi)) * (c**3/(np.log(1.+c)-c/(1.+c))) * m*(u.Msun/self.header["h"]) / (rhoM*(self.virial_radius**3))).decompose().value
 
 		if save:
@@ -9,7 +9,6 @@ else:
 	from StringIO import StringIO
 
 import numpy as np
-from scipy import interpolate
 import astropy.units as u
 from astropy.cosmology import FLRW
 
@@ -464,7 +463,6 @@ class TransferFunction(object):
 		assert k.unit.physical_type=="wavenumber"
 		self._k = k.to((u.Mpc)**-1)
 		self._transfer = dict()
-		self._interpolated = dict()
 
 	def add(self,z,T):
 
@@ -482,6 +480,9 @@ class TransferFunction(object):
 		if hasattr(self,"_sorted_z"):
 			del(self._sorted_z)
 
+		if hasattr(self,"_table"):
+			del(self._table)
+
 		assert T.shape==self._k.shape,"There should be exactly one transfer function value for each wavenumber! len(T)={0} len(k)={1}".format(len(T),len(self._k))
 		self._transfer[z] = T
 
@@ -521,7 +522,7 @@ class TransferFunction(object):
 		:param z: redshift
 		:type z: float.
 
-		:param k: wavenumbers at which to compute the transfer function (linearly interpolated with scipy.interp1d)
+		:param k: wavenumbers at which to compute the transfer function (linearly interpolated, the transfer function is 1 outside of the tabulated range)
 		:type k: quantity
 
 		:returns: transfer function at k
@@ -532,20 +533,60 @@ class TransferFunction(object):
 		assert k.unit.physical_type=="wavenumber"
 
 		#If the transfer function is not tabulated with z, use the closest z in the table
-		if not hasattr(self,"_sorted_z"):
-			self._sorted_z = np.sort(np.array(list(self._transfer.keys())))
+		return self.interpolate(z,k,z_interpolation="nearest")
 
-		if z in self._transfer:
-			zt = z
+
+	def interpolate(self,z,k,z_interpolation="linear"):
+
+		"""
+		Vectorized evaluation of the transfer function on arrays of (z,k) pairs
+
+		:param z: redshifts (must be broadcastable against k); redshifts outside of the tabulated range are clipped to its boundaries
+		:type z: float. or array
+
+		:param k: wavenumbers (linearly interpolated, the transfer function is 1 outside of the tabulated range)
+		:type k: quantity
+
+		:param z_interpolation: "linear" to interpolate linearly between the tabulated redshifts, "nearest" to use the closest tabulated redshift
+		:type z_interpolation: str.
+
+		:returns: transfer function at (z,k)
+		:rtype: array
+
+		"""
+
+		#Tabulate the transfer function on a sorted (z,k) grid the first time it is needed
+		if not hasattr(self,"_table"):
+			zt = np.sort(np.array(list(self._transfer.keys())))
+			order = np.argsort(self._k.value)
+			self._table = (zt,self._k.value[order],np.array([ self._transfer[zi][order] for zi in zt ]))
+
+		zt,kt,tt = self._table
+		z = np.asarray(z,dtype=np.float64)
+		k = k.to((u.Mpc)**-1).value
+		z,k = np.broadcast_arrays(z,k)
+
+		#Bracket the wavenumbers
+		ik = np.clip(np.searchsorted(kt,k,side="right")-1,0,len(kt)-2)
+		wk = (k - kt[ik]) / (kt[ik+1] - kt[ik])
+
+		#Bracket (or round) the redshifts
+		if (z_interpolation=="nearest") or (len(zt)==1):
+			iz = np.clip(np.searchsorted(zt,z),1,max(len(zt)-1,1))
+			iz = np.where(np.abs(z-zt[iz-1])<=np.abs(z-zt[np.minimum(iz,len(zt)-1)]),iz-1,np.minimum(iz,len(zt)-1))
+			t = tt[iz,ik]*(1.-wk) + tt[iz,ik+1]*wk
+		elif z_interpolation=="linear":
+			zc = np.clip(z,zt[0],zt[-1])
+			iz = np.clip(np.searchsorted(zt,zc,side="right")-1,0,len(zt)-2)
+			wz = (zc - zt[iz]) / (zt[iz+1] - zt[iz])
+			t = (tt[iz,ik]*(1.-wk) + tt[iz,ik+1]*wk)*(1.-wz) + (tt[iz+1,ik]*(1.-wk) + tt[iz+1,ik+1]*wk)*wz
 		else:
-			zt = self._sorted_z[np.abs(self._sorted_z - z).argmin()] 
+			raise ValueError("z_interpolation must be either 'linear' or 'nearest'")
 
-		#If interpolator has not been built yet for the current redshift, build it
-		if zt not in self._interpolated:
-			self._interpolated[zt] = interpolate.interp1d(self._k.value,self._transfer[zt],fill_value=1,bounds_error=False)
+		#Outside of the tabulated wavenumbers the transfer function is 1
+		t[(k<kt[0])|(k>kt[-1])] = 1.
 
-		#Use interpolator to compute the transfer function
-		return self._interpolated[zt](k.to((u.Mpc)**-1).value)
+		return t
 
 	#I/O
 	def save(self,filename):
@@ -606,6 +647,9 @@ class CAMBTransferFromPower(TransferFunction):
 		if hasattr(self,"_sorted_z"):
 			del(self._sorted_z)
 
+		if hasattr(self,"_table"):
+			del(self._table)
+
 		assert T.shape==self._k.shape,"There should be exactly one transfer function value for each wavenumber! len(T)={0} len(k)={1}".format(len(T),len(self._k))
 		self._transfer[z] = np.sqrt(T) 
 
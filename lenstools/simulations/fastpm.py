@@ -79,6 +79,13 @@ class FastPMSnapshot(NbodySnapshot):
 
 		return header
 
+	#Handle on the bigfile columns (opened once)
+	@property
+	def _data(self):
+		if getattr(self,"_bigdata",None) is None:
+			self._bigdata = bigfile.BigData(self.fp)
+		return self._bigdata
+
 	def setLimits(self):
 
 		if self.pool is None:
@@ -87,7 +94,7 @@ class FastPMSnapshot(NbodySnapshot):
 		else:
 
 			#Divide equally between tasks
-			Nt,Np = self.pool.size+1,bigfile.BigData(self.fp).size
+			Nt,Np = self.pool.size+1,self._data.size
 			part_per_task = Np//Nt
 			self._first = part_per_task*self.pool.rank
 			self._last = part_per_task*(self.pool.rank+1)
@@ -96,23 +103,53 @@ class FastPMSnapshot(NbodySnapshot):
 			if (Np%Nt) and (self.pool.rank==Nt-1):
 				self._last += Np%Nt
 
-	def getPositions(self,first=None,last=None,save=True):
+	#The number of particles in the file is the size of the columns (light cone outputs do not contain NC^3 particles)
+	def _particleRange(self):
 
-		#Get data pointer
-		data = bigfile.BigData(self.fp)
-		
-		#Read in positions in Mpc/h
-		if (first is None) or (last is None):
-			positions = data["Position"][:]*self.Mpc_over_h
-			aemit = data["Aemit"][:]
+		first = self._first if (self._first is not None) else 0
+		last = self._last if (self._last is not None) else self._data.size
+
+		return first,last
+
+	#Read a column (or a range of rows of it) from the file
+	def _readColumn(self,name,first=None,last=None):
+
+		if (first is None) and (last is None):
+			return self._data[name][:]
 		else:
-			positions = data["Position"][first:last]*self.Mpc_over_h
-			aemit = data["Aemit"][first:last]
+			return self._data[name][first:last]
+
+	#Enforce periodic boundary conditions in the transverse directions, in place
+	def _transformPositions(self,positions,aemit):
 
-		#Enforce periodic boundary conditions
 		for n in (0,1):
-			positions[:,n][positions[:,n]<0] += self.header["box_size"]
-			positions[:,n][positions[:,n]>self.header["box_size"]] -= self.header["box_size"]
+			positions[:,n][positions[:,n]<0] += self.header["box_size"].value
+			positions[:,n][positions[:,n]>self.header["box_size"].value] -= self.header["box_size"].value
+
+		return positions
+
+	def getPositions(self,first=None,last=None,save=True):
+
+		"""
+		Reads in the particles positions (read in of a subset is allowed): when first and last are specified, the numpy array convention is followed (i.e. getPositions(first=a,last=b)=getPositions()[a:b])
+
+		:param first: first particle in the file to be read, if None 0 is assumed
+		:type first: int. or None
+
+		:param last: last particle in the file to be read, if None the total number of particles is assumed
+		:type last: int. or None
+
+		:param save: if True saves the particles positions as attribute
+		:type save: bool.
+
+		:returns: numpy array with the particle positions
+
+		"""
+		
+		#Read in positions in Mpc/h: the units are attached without copying the array
+		positions = self._readColumn("Position",first,last)
+		aemit = self._readColumn("Aemit",first,last)
+		positions = u.Quantity(self._transformPositions(positions,aemit),unit=self.Mpc_over_h,copy=False)
 
 		#Maybe save
 		if save:
@@ -130,10 +167,59 @@ class FastPMSnapshot(NbodySnapshot):
 	###########################################################################################
 
 	def getVelocities(self,first=None,last=None,save=True):
-		raise NotImplementedError
+
+		"""
+		Reads in the particles velocities (read in of a subset is allowed): when first and last are specified, the numpy array convention is followed (i.e. getVelocities(first=a,last=b)=getVelocities()[a:b])
+
+		:param first: first particle in the file to be read, if None 0 is assumed
+		:type first: int. or None
+
+		:param last: last particle in the file to be read, if None the total number of particles is assumed
+		:type last: int. or None
+
+		:param save: if True saves the particles velocities as attribute
+		:type save: bool.
+
+		:returns: numpy array with the particle velocities
+
+		"""
+
+		#Read in velocities in km/s, without copies
+		velocities = u.Quantity(self._readColumn("Velocity",first,last),unit=u.km/u.s,copy=False)
+
+		#Maybe save
+		if save:
+			self.velocities = velocities
+
+		#Return
+		return velocities
 
 	def getID(self,first=None,last=None,save=True):
-		raise NotImplementedError
+
+		"""
+		Reads in the particles IDs (read in of a subset is allowed): when first and last are specified, the numpy array convention is followed (i.e. getID(first=a,last=b)=getID()[a:b])
+
+		:param first: first particle in the file to be read, if None 0 is assumed
+		:type first: int. or None
+
+		:param last: last particle in the file to be read, if None the total number of particles is assumed
+		:type last: int. or None
+
+		:param save: if True saves the particles IDs as attribute
+		:type save: bool.
+
+		:returns: numpy array with the particle IDs
+
+		"""
+
+		ids = self._readColumn("ID",first,last)
+
+		#Maybe save
+		if save:
+			self.id = ids
+
+		#Return
+		return ids
 
 	def write(self,filename,files=1):
 		raise NotImplementedError
@@ -150,9 +236,10 @@ class FastPMSnapshotStretchZ(FastPMSnapshot):
 
 	"""
 
-	def getPositions(self,first=None,last=None,save=True):
-		super(FastPMSnapshotStretchZ,self).getPositions(first,last,True)
+	#Replace z with comoving distances, computed from the scale factors at emission
+	def _transformPositions(self,positions,aemit):
 
-		#Replace z with comoving distances
-		self.positions[:,2] = self.cosmology.comoving_distance(1./self.aemit-1.).to(self.positions.unit).astype(np.float32)
-		return self.positions
+		positions = super(FastPMSnapshotStretchZ,self)._transformPositions(positions,aemit)
+		positions[:,2] = self.cosmology.comoving_distance(1./aemit-1.).to(self.Mpc_over_h).value
+		
+		return positions
@@ -294,7 +294,85 @@ class Gadget2Snapshot(NbodySnapshot):
 
 	############################################################################################
 
-	def getPositions(self,first=None,last=None,save=True):
+	#Byte offset of each particle block from the beginning of the file: 4 bytes (endianness) + 256 bytes (header) + 8 bytes (void) before the positions, 8 void bytes between the blocks
+	_blocks = ["positions","velocities","id"]
+
+	def _blockOffset(self,block):
+
+		numPart = self._header["num_particles_file"]
+		offset = 4 + 256 + 8
+
+		for b in self._blocks:
+			if b==block:
+				return offset
+			offset += 4 * 3 * numPart + 8
+
+		raise ValueError("Block {0} not recognized, must be one of {1}".format(block,self._blocks))
+
+	def mapBlock(self,block,first=None,last=None):
+
+		"""
+		Maps a block of particle data from the snapshot file with np.memmap (mapping of a subset is allowed, with the same conventions as getPositions): nothing is read from disk until the data is accessed, and only the pages of the [first,last) particles are touched
+
+		:param block: particle data to map (positions, velocities or id)
+		:type block: str.
+
+		:param first: first particle in the file to be mapped, if None 0 is assumed
+		:type first: int. or None
+
+		:param last: last particle in the file to be mapped, if None the total number of particles is assumed
+		:type last: int. or None
+
+		:returns: tuple(read only view of the data in the native Gadget2 precision and units,units of the data; None for the IDs)
+
+		"""
+
+		numPart = self._header["num_particles_file"]
+
+		if first is None:
+			first = 0
+		if last is None:
+			last = numPart
+
+		assert first>=0 and last>=first and last<=numPart
+
+		#Data type and units of the block
+		if block=="positions":
+			dtype,width = np.float32,3
+			try:
+				unit = self.kpc_over_h
+			except AttributeError:
+				unit = u.kpc
+		elif block=="velocities":
+			dtype,width = np.float32,3
+			unit = u.Unit(self._velocity_unit * u.cm / u.s)
+		elif block=="id":
+			dtype,width = np.int32,1
+			unit = None
+		else:
+			raise ValueError("Block {0} not recognized, must be one of {1}".format(block,self._blocks))
+
+		#Map only the requested particles
+		offset = self._blockOffset(block) + 4 * width * first
+		shape = (last-first,width) if width>1 else (last-first,)
+
+		if last==first:
+			return np.zeros(shape,dtype=dtype),unit
+
+		return np.memmap(self.fp.name,dtype=dtype,mode="r",offset=offset,shape=shape),unit
+
+	def _mapped(self,block,first,last):
+
+		data,unit = self.mapBlock(block,first,last)
+		if unit is None:
+			return data
+
+		#No copies and no unit conversions: the data stays in the file units
+		return u.Quantity(data,unit=unit,copy=False)
+
+	############################################################################################
+
+	def getPositions(self,first=None,last=None,save=True,mmap=False):
 
 		"""
 		Reads in the particles positions (read in of a subset is allowed): when first and last are specified, the numpy array convention is followed (i.e. getPositions(first=a,last=b)=getPositions()[a:b])
@@ -308,6 +386,9 @@ class Gadget2Snapshot(NbodySnapshot):
 		:param save: if True saves the particles positions as attribute
 		:type save: bool.
 
+		:param mmap: if True, the positions are memory mapped read only from the file (see mapBlock) instead of being read in memory, and are returned in the file units with no copies
+		:type mmap: bool.
+
 		:returns: numpy array with the particle positions
 
 		"""
@@ -320,6 +401,12 @@ class Gadget2Snapshot(NbodySnapshot):
 		self.virial_radius = None
 		self.concentration = None
 
+		if mmap:
+			positions = self._mapped("positions",first,last)
+			if save:
+				self.positions = positions
+			return positions
+
 		numPart = self._header["num_particles_file"]
 
 		#Calculate the offset from the beginning of the file: 4 bytes (endianness) + 256 bytes (header) + 8 bytes (void)
@@ -360,7 +447,7 @@ class Gadget2Snapshot(NbodySnapshot):
 
 	############################################################################################
 
-	def getVelocities(self,first=None,last=None,save=True):
+	def getVelocities(self,first=None,last=None,save=True,mmap=False):
 
 		"""
 		Reads in the particles velocities (read in of a subset is allowed): when first and last are specified, the numpy array convention is followed (i.e. getVelocities(first=a,last=b)=getVelocities()[a:b])
@@ -374,12 +461,21 @@ class Gadget2Snapshot(NbodySnapshot):
 		:param save: if True saves the particles velocities as attrubute
 		:type save: bool.
 
+		:param mmap: if True, the velocities are memory mapped read only from the file (see mapBlock) instead of being read in memory, and are returned in the file units with no copies
+		:type mmap: bool.
+
 		:returns: numpy array with the particle velocities
 
 		"""
 
 		assert not self.fp.closed
 
+		if mmap:
+			velocities = self._mapped("velocities",first,last)
+			if save:
+				self.velocities = velocities
+			return velocities
+
 		numPart = self._header["num_particles_file"]
 
 		#Calculate the offset from the beginning of the file: 4 bytes (endianness) + 256 bytes (header) + 8 bytes (void)
@@ -427,7 +523,7 @@ class Gadget2Snapshot(NbodySnapshot):
 
 	############################################################################################
 
-	def getID(self,first=None,last=None,save=True):
+	def getID(self,first=None,last=None,save=True,mmap=False):
 
 		"""
 		Reads in the particles IDs, 4 byte ints, (read in of a subset is allowed): when first and last are specified, the numpy array convention is followed (i.e. getID(first=a,last=b)=getID()[a:b])
@@ -441,12 +537,21 @@ class Gadget2Snapshot(NbodySnapshot):
 		:param save: if True saves the particles IDs as attribute
 		:type save: bool.
 
+		:param mmap: if True, the IDs are memory mapped read only from the file (see mapBlock) instead of being read in memory, with no copies
+		:type mmap: bool.
+
 		:returns: numpy array with the particle IDs
 
 		"""
 
 		assert not self.fp.closed
 
+		if mmap:
+			ids = self._mapped("id",first,last)
+			if save:
+				self.id = ids
+			return ids
+
 		numPart = self._header["num_particles_file"]
 
 		#Calculate the offset from the beginning of the file: 4 bytes (endianness) + 256 bytes (header) + 8 bytes (void)
@@ -786,4 +891,8 @@ class Gadget2SnapshotPipe(Gadget2SnapshotDE):
 		self.virial_radius = None
 		self.concentration = None
 
+	#The positions are read in the constructor: the parent class reads them only when asked to
+	@classmethod
+	def _lazyHandler(cls):
+		return Gadget2SnapshotDE
 
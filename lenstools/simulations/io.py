@@ -1,6 +1,9 @@
 from __future__ import division
 
+import os
 import re
+import json
+from collections import OrderedDict
 
 import numpy as np
 import astropy.units as u
@@ -17,30 +20,11 @@ except ImportError:
 	fitsio = None
 
 ####################################################################
-#######################FITS format##################################
+#######################Common header handling#######################
 ####################################################################
 
-#Header
-def readFITSHeader(filename):
-	with fits.open(filename) as fp:
-		return fp[0].header
-
-#Read
-def readFITS(cls,filename,init_cosmology=True):
-
-	#Read the FITS file with the plane information (if there are two HDU's the second one is the imaginary part)
-	if fitsio is not None:
-		hdu = fitsio(filename)
-	else:
-		hdu = fits.open(filename)
-			
-	if len(hdu)>2:
-		raise ValueError("There are more than 2 HDUs, file format unknown")
-
-	if fitsio is not None:
-		header = hdu[0].read_header()
-	else:
-		header = hdu[0].header
+#Parse the header into the Plane constructor keyword arguments
+def _parseHeader(header,init_cosmology=True):
 
 	#Retrieve the info from the header (handle old FITS header format too)
 	try:
@@ -88,26 +72,84 @@ def readFITS(cls,filename,init_cosmology=True):
 		name,exponent = re.match(r"([a-zA-Z]+)([0-9])?",unit_string).groups()
 		unit = getattr(u,name)
 		if exponent is not None:
-			unit **= exponent
+			unit **= int(exponent)
 	except AttributeError:
 		unit = u.dimensionless_unscaled
 	except (ValueError,KeyError):
 		unit = u.rad**2
 
+	return dict(angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles)
+
+#Build the header (key,value,comment) out of the Plane attributes
+def _buildHeader(self):
+
+	#A cosmology instance should be available in order to generate the header
+	assert self.cosmology is not None
+
+	header = OrderedDict()
+	header["H0"] = (self.cosmology.H0.to(u.km/(u.s*u.Mpc)).value,"Hubble constant in km/s*Mpc")
+	header["h"] = (self.cosmology.h,"Dimensionless Hubble constant")
+	header["OMEGA_M"] = (self.cosmology.Om0,"Dark Matter density")
+	header["OMEGA_L"] = (self.cosmology.Ode0,"Dark Energy density")
+	header["W0"] = (self.cosmology.w0,"Dark Energy equation of state")
+	header["WA"] = (self.cosmology.wa,"Dark Energy running equation of state")
+
+	header["Z"] = (self.redshift,"Redshift of the lens plane")
+	header["CHI"] = (self.cosmology.h * self.comoving_distance.to(u.Mpc).value,"Comoving distance in Mpc/h")
+
+	if self.side_angle.unit.physical_type=="angle":
+		header["ANGLE"] = (self.side_angle.to(u.deg).value,"Side angle in degrees")
+	elif self.side_angle.unit.physical_type=="length":
+		header["SIDE"] = (self.side_angle.to(u.Mpc).value*self.cosmology.h,"Side length in Mpc/h")
+
+	header["NPART"] = (float(self.num_particles),"Number of particles on the plane")
+	header["UNIT"] = (self.unit.to_string(),"Pixel value unit")
+
+	return header
+
+####################################################################
+#######################FITS format##################################
+####################################################################
+
+#Header
+def readFITSHeader(filename):
+	with fits.open(filename) as fp:
+		return fp[0].header
+
+#Read
+def readFITS(cls,filename,init_cosmology=True):
+
+	#Read the FITS file with the plane information (if there are two HDU's the second one is the imaginary part)
+	if fitsio is not None:
+		hdu = fitsio(filename)
+	else:
+		hdu = fits.open(filename)
+			
+	if len(hdu)>2:
+		raise ValueError("There are more than 2 HDUs, file format unknown")
+
+	if fitsio is not None:
+		header = hdu[0].read_header()
+	else:
+		header = hdu[0].header
+
+	#Retrieve the info from the header
+	info = _parseHeader(header,init_cosmology)
+
 	#Instantiate the new PotentialPlane instance
 	if fitsio is not None:
 
 		if len(hdu)==1:
-			new_plane = cls(hdu[0].read(),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls(hdu[0].read(),filename=filename,**info)
 		else:
-			new_plane = cls(hdu[1].read() + 1.0j*hdu[1].read(),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls(hdu[1].read() + 1.0j*hdu[1].read(),filename=filename,**info)
 
 	else:
 			
 		if len(hdu)==1:
-			new_plane = cls(hdu[0].data.astype(np.float64),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls(hdu[0].data.astype(np.float64),filename=filename,**info)
 		else:
-			new_plane = cls((hdu[0].data + 1.0j*hdu[1].data).astype(np.complex128),angle=angle,redshift=redshift,comoving_distance=comoving_distance,cosmology=cosmology,unit=unit,num_particles=num_particles,filename=filename)
+			new_plane = cls((hdu[0].data + 1.0j*hdu[1].data).astype(np.complex128),filename=filename,**info)
 
 	#Close the FITS file and return
 	hdu.close()
@@ -117,9 +159,6 @@ def readFITS(cls,filename,init_cosmology=True):
 
 #Write
 def saveFITS(self,filename,double_precision):
-
-	#A cosmology instance should be available in order to save in FITS format
-	assert self.cosmology is not None
 		
 	#Create the hdu
 	if self.space=="real":
@@ -139,23 +178,8 @@ def saveFITS(self,filename,double_precision):
 
 
 	#Generate a header
-	hdu.header["H0"] = (self.cosmology.H0.to(u.km/(u.s*u.Mpc)).value,"Hubble constant in km/s*Mpc")
-	hdu.header["h"] = (self.cosmology.h,"Dimensionless Hubble constant")
-	hdu.header["OMEGA_M"] = (self.cosmology.Om0,"Dark Matter density")
-	hdu.header["OMEGA_L"] = (self.cosmology.Ode0,"Dark Energy density")
-	hdu.header["W0"] = (self.cosmology.w0,"Dark Energy equation of state")
-	hdu.header["WA"] = (self.cosmology.wa,"Dark Energy running equation of state")
-
-	hdu.header["Z"] = (self.redshift,"Redshift of the lens plane")
-	hdu.header["CHI"] = (hdu.header["h"] * self.comoving_distance.to(u.Mpc).value,"Comoving distance in Mpc/h")
-
-	if self.side_angle.unit.physical_type=="angle":
-		hdu.header["ANGLE"] = (self.side_angle.to(u.deg).value,"Side angle in degrees")
-	elif self.side_angle.unit.physical_type=="length":
-		hdu.header["SIDE"] = (self.side_angle.to(u.Mpc).value*self.cosmology.h,"Side length in Mpc/h")
-
-	hdu.header["NPART"] = (float(self.num_particles),"Number of particles on the plane")
-	hdu.header["UNIT"] = (self.unit.to_string(),"Pixel value unit") 
+	for key,card in _buildHeader(self).items():
+		hdu.header[key] = card
 
 	#Save the plane
 	if self.space=="real":
@@ -165,4 +189,120 @@ def saveFITS(self,filename,double_precision):
 
 	hdulist.writeto(filename,overwrite=True)
 
-########################################################################################################################################
\ No newline at end of file
+########################################################################################################################################
+
+####################################################################
+#######################NPY format###################################
+####################################################################
+
+#The header is stored in a JSON sidecar file next to the data
+def _sidecarName(filename):
+	return os.path.splitext(filename)[0] + ".json"
+
+def _saveSidecar(self,filename):
+	with open(_sidecarName(filename),"w") as fp:
+		json.dump(OrderedDict([ (key,card[0] if isinstance(card[0],str) else float(card[0])) for key,card in _buildHeader(self).items() ]),fp,indent=1)
+
+#Header
+def readNPYHeader(filename):
+	with open(_sidecarName(filename),"r") as fp:
+		return json.load(fp)
+
+#Read
+def readNPY(cls,filename,init_cosmology=True,mmap=False):
+
+	#Parse the sidecar header
+	info = _parseHeader(readNPYHeader(filename),init_cosmology)
+
+	#Read the data, optionally mapping it read only
+	if mmap:
+		data = np.load(filename,mmap_mode="r")
+	else:
+		data = np.load(filename)
+
+	return cls(data,filename=filename,**info)
+
+#Write
+def saveNPY(self,filename):
+
+	#The data is stored in its native precision, so it can be mapped with no conversions
+	with open(filename,"wb") as fp:
+		np.save(fp,np.ascontiguousarray(self.data))
+
+	#Write the sidecar header
+	_saveSidecar(self,filename)
+
+########################################################################################################################################
+
+####################################################################
+#######################Compact Fourier format#######################
+####################################################################
+
+#Fourier modes (rows,columns of the rfft half plane) that are kept when truncating at lmax
+def _truncatedModes(npix,side_angle,lmax):
+
+	num_columns = npix//2 + 1
+	if lmax is None:
+		return num_columns
+
+	#Multipole of the fundamental mode
+	l_fundamental = 2.0*np.pi / side_angle.to(u.rad).value
+	return min(int(np.floor(lmax/l_fundamental)) + 1,num_columns)
+
+#Read
+def readNPZ(cls,filename,init_cosmology=True):
+
+	#Parse the sidecar header
+	info = _parseHeader(readNPYHeader(filename),init_cosmology)
+
+	#Read the stored modes and pad them with zeros up to the full half plane
+	with np.load(filename) as fp:
+		modes = fp["modes"]
+		npix = int(fp["npix"])
+
+	num_modes = modes.shape[1]
+	data = np.zeros((npix,npix//2+1),dtype=np.complex128)
+	data[:num_modes,:num_modes] = modes[:num_modes]
+	data[npix-modes.shape[0]+num_modes:,:num_modes] = modes[num_modes:]
+
+	return cls(data,filename=filename,**info)
+
+#Write
+def saveNPZ(self,filename,lmax=None,compress=False):
+
+	if self.space=="real":
+		data = np.fft.rfft2(self.data)
+	elif self.space=="fourier":
+		data = self.data
+	else:
+		raise ValueError("Space must either be real of Fourier!")
+
+	npix = data.shape[0]
+	assert data.shape==(npix,npix//2+1),"The compact format supports only square planes!"
+
+	#Angular size of the plane, needed to convert lmax into a number of modes
+	if self.side_angle.unit.physical_type=="angle":
+		side_angle = self.side_angle
+	else:
+		side_angle = (self.side_angle/self.comoving_distance).decompose().value * u.rad
+
+	#Keep only the modes with |lx|,|ly|<=lmax (positive and negative ly frequencies are on the rows), in single precision
+	num_modes = _truncatedModes(npix,side_angle,lmax)
+	if 2*num_modes-1 < npix:
+		modes = np.concatenate((data[:num_modes,:num_modes],data[npix-num_modes+1:,:num_modes])).astype(np.complex64)
+	else:
+		modes = data.astype(np.complex64)
+
+	#Lossless compression is optional, as it trades write/read bandwidth for CPU time
+	if compress:
+		savez = np.savez_compressed
+	else:
+		savez = np.savez
+
+	with open(filename,"wb") as fp:
+		savez(fp,modes=modes,npix=npix,lmax=(-1.0 if lmax is None else float(lmax)))
+
+	#Write the sidecar header
+	_saveSidecar(self,filename)
+
+########################################################################################################################################
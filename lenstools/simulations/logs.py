@@ -1,8 +1,11 @@
 import sys,platform
+import time
 import resource
 import logging
+from contextlib import contextmanager
 
 import numpy as np
+import pandas as pd
 import astropy.units as u
 
 #########
@@ -58,3 +61,124 @@ def peakMemoryAll(pool):
 	pool.comm.Reduce(memory_task_raw,memory_task_all)
 
 	return memory_task_all[0]*unit,pool.size+1
+
+#Get the current memory usage (resident set size) for a single task
+def currentMemory():
+	try:
+		with open("/proc/self/statm","r") as fp:
+			rss_pages = int(fp.read().split()[1])
+		return rss_pages*resource.getpagesize()*u.Gbyte/(1024.**3)
+	except (IOError,OSError):
+		return np.nan*u.Gbyte
+
+##########################################
+#Structured time and memory usage profile#
+##########################################
+
+class Profiler(object):
+
+	"""
+	Records the time spent, the bytes read and the memory usage of each phase (load, roll, deflection lookup...) of each lens crossed during the ray tracing
+
+	"""
+
+	def __init__(self,enabled=True):
+
+		"""
+		:param enabled: if False, the phases are not timed and nothing is recorded
+		:type enabled: bool.
+
+		"""
+
+		self.enabled = enabled
+		self.lens = None
+		self.tags = dict()
+		self._records = list()
+
+	@contextmanager
+	def phase(self,name,bytes_read=0):
+
+		"""
+		Context manager that times the enclosed block as one phase of the current lens (self.lens)
+
+		:param name: name of the phase
+		:type name: str.
+
+		:param bytes_read: number of bytes read from disk during the phase
+		:type bytes_read: int.
+
+		"""
+
+		if not self.enabled:
+			yield
+			return
+
+		start = time.time()
+		yield
+		self.record(name,time.time()-start,bytes_read)
+
+	def record(self,name,elapsed,bytes_read=0):
+
+		"""
+		Add a profile record for the current lens (self.lens)
+
+		:param name: name of the phase
+		:type name: str.
+
+		:param elapsed: time spent in the phase (seconds)
+		:type elapsed: float.
+
+		:param bytes_read: number of bytes read from disk during the phase
+		:type bytes_read: int.
+
+		"""
+
+		if not self.enabled:
+			return
+
+		entry = dict(self.tags)
+		entry.update(lens=self.lens,phase=name,time=elapsed,bytes_read=bytes_read,memory=currentMemory().to(u.Gbyte).value,peak_memory=peakMemory().to(u.Gbyte).value)
+		self._records.append(entry)
+
+	def reset(self):
+		self._records = list()
+
+	@property
+	def table(self):
+
+		"""
+		Profile records as a table, one row for each (lens,phase); times are in seconds, memory usage in Gbyte
+
+		:rtype: :py:class:`pandas.DataFrame`
+
+		"""
+
+		columns = list(self.tags.keys()) + ["lens","phase","time","bytes_read","memory","peak_memory"]
+		return pd.DataFrame(self._records,columns=columns)
+
+	def gather(self,pool):
+
+		"""
+		Collect the profile tables of all the tasks in the pool on the master task (collective call), adding the host name and rank columns
+
+		:param pool: MPI pool
+		:type pool: :py:class:`~lenstools.utils.mpi.MPIWhirlPool`
+
+		:returns: the table with the profiles of all tasks (None on the tasks that are not the master)
+		:rtype: :py:class:`pandas.DataFrame`
+
+		"""
+
+		table = self.table
+		table["host"] = platform.node()
+		if pool is None:
+			table["rank"] = 0
+			return table
+
+		table["rank"] = pool.rank
+		all_tables = pool.comm.gather(table,root=0)
+
+		if pool.is_master():
+			return pd.concat(all_tables,ignore_index=True)
+		else:
+			return None
@@ -23,6 +23,17 @@ from astropy.cosmology import w0waCDM,z_at_value
 from ..utils.fft import NUMPYFFTPack
 fftengine = NUMPYFFTPack()
 
+#Mass assignment schemes, with the order of their window functions
+_assignment_order = {"NGP":1,"CIC":2,"TSC":3}
+
+#Fourier transform of the mass assignment window, the frequencies along each axis are in units of the inverse cell size
+def _assignmentWindow(order,*frequencies):
+	return reduce(mul,[ np.sinc(f)**order for f in frequencies ])
+
+#Combine the Fourier transforms of a field gridded twice, the second time on a grid shifted by half a cell: this cancels the leading aliasing contributions
+def _interlace(field_ft,shifted_ft,*frequencies):
+	return 0.5*(field_ft + shifted_ft*np.exp(1.0j*np.pi*sum(frequencies)))
+
 #KD-Tree
 from scipy.spatial import cKDTree as KDTree
 
@@ -205,6 +216,11 @@ class NbodySnapshot(object):
 		
 		return cls(fp,pool,header_kwargs=header_kwargs)
 
+	#Handler that reads the particles from the snapshot file only when asked to (handlers that read them in the constructor return a lazy counterpart)
+	@classmethod
+	def _lazyHandler(cls):
+		return cls
+
 	@property
 	def header(self):
 
@@ -385,6 +401,10 @@ class NbodySnapshot(object):
 
 		self.positions = positions
 
+		#The neighbor distances have to be computed again
+		if hasattr(self,"_neighbor_distances"):
+			del self._neighbor_distances
+
 	def setVelocities(self,velocities):
 
 		"""
@@ -400,11 +420,257 @@ class NbodySnapshot(object):
 
 		self.velocities = velocities
 
+	###################################################################################################################################################
+
+	#Range of particles in the file handled by this instance
+	def _particleRange(self):
+
+		first = self._first if (self._first is not None) else 0
+		last = self._last if (self._last is not None) else self._header["num_particles_file"]
+
+		return first,last
+
+	def chunks(self,chunk_size,quantity="positions"):
+
+		"""
+		Iterate over the particles handled by this instance (all of them, or the ones assigned to this task by setLimits), reading them from the snapshot file one chunk at a time; the chunks are not saved as attributes
+
+		:param chunk_size: number of particles in each chunk
+		:type chunk_size: int.
+
+		:param quantity: particle property to read ("positions", "velocities" or "id")
+		:type quantity: str.
 
-	def massDensity(self,resolution=0.5*Mpc,smooth=None,left_corner=None,save=False,density_placeholder=None):
+		:returns: generator of (first,last,chunk) tuples, with first,last relative to the first particle handled by this instance
 
 		"""
-		Uses a C backend gridding function to compute the matter mass density fluctutation for the current snapshot: the density is evaluated using a nearest neighbor search
+
+		getter = {"positions":self.getPositions,"velocities":self.getVelocities,"id":self.getID}[quantity]
+
+		first,last = self._particleRange()
+		for start in range(first,last,chunk_size):
+			stop = min(start+chunk_size,last)
+			yield start-first,stop-first,getter(first=start,last=stop,save=False)
+
+	#Read the particle positions from the snapshot file in chunks: yields (first,last,positions), with first,last relative to the particles handled by this instance
+	def _positionChunks(self,chunk_size):
+		return self.chunks(chunk_size,"positions")
+
+	###################################################################################################################################################
+	############################Spatially sorted copy of the positions (sidecar of the snapshot file)#################################################
+	###################################################################################################################################################
+
+	#Names of the sorted positions and of the cell index files, next to the snapshot file (keyed by the range of particles)
+	def _sortedSidecar(self):
+
+		first,last = self._first,self._last
+		if (first is None) and (last is None):
+			return "{0}.sorted.npy".format(self.fp.name),"{0}.sorted_index.npz".format(self.fp.name)
+		else:
+			return "{0}.sorted_{1}-{2}.npy".format(self.fp.name,*self._particleRange()),"{0}.sorted_index_{1}-{2}.npz".format(self.fp.name,*self._particleRange())
+
+	def writeSortedSidecar(self,num_cells=64,chunk_size=None):
+
+		"""
+		Write a copy of the positions of the particles handled by this instance, sorted by the cell of a num_cells^3 grid they fall in (cells in row major order), next to the snapshot file; the index of the first particle in each cell is saved too, so that slabPositions (and cutPlaneGaussianGrid, cutPlaneAngular) can read only the particles in the cells that intersect a slab
+
+		:param num_cells: number of cells of the grid along each axis
+		:type num_cells: int.
+
+		:param chunk_size: if not None, the particles are read from the snapshot file and sorted chunk_size at a time (in three passes)
+		:type chunk_size: int.
+
+		:returns: names of the sorted positions and of the index files
+
+		"""
+
+		positions_file,index_file = self._sortedSidecar()
+		first,last = self._particleRange()
+
+		#The positions in memory are reused, or read once if chunk_size is None; otherwise each pass reads them from the snapshot file chunk_size at a time
+		if hasattr(self,"positions"):
+			positions = self.positions
+		elif chunk_size is None:
+			positions = self.getPositions(first=first,last=last,save=False)
+		else:
+			positions = None
+
+		def chunks():
+			if positions is not None:
+				return [(0,last-first,positions)]
+			return self.chunks(chunk_size)
+
+		#Particles with weights (halos) cannot be reordered
+		length_unit = self.getPositions(first=first,last=min(first+1,last),save=False).unit if (positions is None) else positions.unit
+		assert self.weights is None,"Only particles without weights can be sorted!"
+
+		#Bounds of the grid
+		lower = np.array([ c.to(length_unit).value.min(axis=0) for (f,l,c) in chunks() ]).min(axis=0)
+		upper = np.array([ c.to(length_unit).value.max(axis=0) for (f,l,c) in chunks() ]).max(axis=0)
+		cell_size = np.maximum(upper-lower,np.finfo(np.float32).tiny) * (1.+1.0e-6) / num_cells
+
+		def cells(chunk):
+			ijk = np.clip(((chunk.to(length_unit).value - lower) / cell_size).astype(np.int64),0,num_cells-1)
+			return (ijk[:,0]*num_cells + ijk[:,1])*num_cells + ijk[:,2]
+
+		#Count the particles in each cell
+		counts = np.zeros(num_cells**3,dtype=np.int64)
+		for f,l,chunk in chunks():
+			counts += np.bincount(cells(chunk),minlength=num_cells**3)
+
+		offsets = np.concatenate(([0],np.cumsum(counts)))
+
+		#Write the particles in cell order, to a temporary file that is moved in place when complete
+		logplanes.info("Writing {0} particles sorted in {1}^3 cells to {2}".format(last-first,num_cells,positions_file))
+		sorted_positions = np.lib.format.open_memmap(positions_file+".tmp",mode="w+",dtype=np.float32,shape=(last-first,3))
+		filled = offsets[:-1].copy()
+
+		for f,l,chunk in chunks():
+
+			chunk_cells = cells(chunk)
+			order = np.argsort(chunk_cells,kind="mergesort")
+			chunk_cells = chunk_cells[order]
+
+			#Position of each particle within its cell
+			cell_counts = np.bincount(chunk_cells,minlength=num_cells**3)
+			rank_in_cell = np.arange(len(chunk_cells)) - np.concatenate(([0],np.cumsum(cell_counts)))[chunk_cells]
+
+			sorted_positions[filled[chunk_cells]+rank_in_cell] = chunk.to(length_unit).value[order]
+			filled += cell_counts
+
+		sorted_positions.flush()
+		del sorted_positions
+		os.rename(positions_file+".tmp",positions_file)
+
+		#Save the index (after the positions, so that an index more recent than the positions is complete)
+		with open(index_file+".tmp","wb") as indexfp:
+			np.savez(indexfp,offsets=offsets,lower=lower,cell_size=cell_size,num_cells=num_cells,particle_range=np.array([first,last]))
+		os.rename(index_file+".tmp",index_file)
+		logplanes.info("Saved sorted particle index to {0}".format(index_file))
+
+		return positions_file,index_file
+
+	#Index of the sorted copy of the positions, if available and up to date
+	def _sortedIndex(self):
+
+		positions_file,index_file = self._sortedSidecar()
+
+		if not(os.path.exists(positions_file) and os.path.exists(index_file)):
+			raise IOError("No sorted copy of the positions next to {0}: create one with writeSortedSidecar (or nbodysort)".format(self.fp.name))
+
+		if min(os.path.getmtime(positions_file),os.path.getmtime(index_file))<os.path.getmtime(self.fp.name):
+			raise IOError("The sorted copy of the positions is older than {0}: recreate it with writeSortedSidecar (or nbodysort)".format(self.fp.name))
+
+		if os.path.getmtime(index_file)<os.path.getmtime(positions_file):
+			raise IOError("The index of the sorted copy of the positions next to {0} is incomplete: recreate it with writeSortedSidecar (or nbodysort)".format(self.fp.name))
+
+		index = np.load(index_file)
+		assert tuple(index["particle_range"])==self._particleRange(),"The sorted copy of the positions does not cover the particles handled by this instance!"
+
+		return index
+
+	def slabPositions(self,normal,lower,upper):
+
+		"""
+		Read from the spatially sorted copy of the positions (see writeSortedSidecar) only the particles in the cells that intersect the slab lower<=x[normal]<upper; the particles in the intersecting cells that lie outside the slab are returned as well
+
+		:param normal: direction normal to the slab (0,1,2)
+		:type normal: int.
+
+		:param lower: lower edge of the slab
+		:type lower: quantity
+
+		:param upper: upper edge of the slab
+		:type upper: quantity
+
+		:returns: positions of the particles in the cells that intersect the slab
+
+		"""
+
+		index = self._sortedIndex()
+		positions_file,index_file = self._sortedSidecar()
+		first,last = self._particleRange()
+		length_unit = self.getPositions(first=first,last=min(first+1,last),save=False).unit
+
+		#Cells that intersect the slab
+		num_cells = int(index["num_cells"])
+		cell_range = [ int(np.clip(np.floor((edge.to(length_unit).value-index["lower"][normal])/index["cell_size"][normal]),0,num_cells-1)) for edge in (lower,upper) ]
+		cells = np.take(np.arange(num_cells**3).reshape((num_cells,)*3),range(cell_range[0],cell_range[1]+1),axis=normal).reshape(-1)
+		cells.sort()
+
+		#Merge the contiguous particle ranges
+		starts,ends = index["offsets"][cells],index["offsets"][cells+1]
+		breaks = np.where(starts[1:]!=ends[:-1])[0]
+		starts,ends = starts[np.concatenate(([0],breaks+1))],ends[np.concatenate((breaks,[len(ends)-1]))]
+
+		#Read only the selected ranges
+		sorted_positions = np.load(positions_file,mmap_mode="r")
+		positions = np.empty(((ends-starts).sum(),3),dtype=np.float32)
+		n = 0
+		for s,e in zip(starts,ends):
+			positions[n:n+e-s] = sorted_positions[s:e]
+			n += e-s
+
+		if self.pool is not None:
+			logplanes.debug("Task {0} read {1} of {2} particles from the sorted copy".format(self.pool.rank,len(positions),last-first))
+		else:
+			logplanes.debug("Read {0} of {1} particles from the sorted copy".format(len(positions),last-first))
+
+		return positions*length_unit
+
+	#Length unit of the particle positions, read from a single particle: when streaming, the lower corner of the grid must be given, as finding the minimum of the positions would take an additional pass over the snapshot file
+	def _streamInfo(self,left_corner):
+
+		assert left_corner is not None,"Specify the left_corner of the grid when streaming the particles in chunks!"
+
+		first,last = self._particleRange()
+		return self.getPositions(first=first,last=min(first+1,last),save=False).unit
+
+	#Grid the particles with the C backend: if the positions are None, they are read from the snapshot file in chunks and accumulated on the grid (a new one, or density if provided); properties returns the weights, virial radii and concentrations of the particles read last (all of them, or the current chunk), args are passed to the gridder after the grid
+	def _gridParticles(self,gridder,positions,binning,properties,chunk_size=None,transform=None,density=None,args=(),cull=False):
+
+		if transform is None:
+			transform = lambda p:p.value
+
+		if density is None:
+			density = np.zeros([ len(b)-1 for b in binning ],dtype=np.float32)
+
+		#Drop the particles whose profile does not reach the grid before handing them to the gridder
+		def grid(p,w,r,c):
+			
+			if cull and (r is not None):
+				
+				reach = np.ones(len(p),dtype=np.bool_)
+				for d in range(3):
+					reach &= (p[:,d]+r>binning[d][0]) & (p[:,d]-r<binning[d][-1])
+
+				logplanes.debug("{0} of {1} halos reach the grid".format(reach.sum(),len(p)))
+				p,w,r,c = [ (a[reach] if (a is not None) else None) for a in (p,w,r,c) ]
+
+			gridder(p,tuple(binning),w,r,c,density,*args)
+
+		if positions is not None:
+			grid(transform(positions),*properties())
+			return density
+
+		#Reading a chunk updates the weights, virial radii and concentrations of the particles (halo catalogs)
+		for first,last,chunk in self._positionChunks(chunk_size):
+			
+			if self.pool is not None:
+				logplanes.debug("Task {0} gridding particles {1}-{2}".format(self.pool.rank,first,last))
+			else:
+				logplanes.debug("Gridding particles {0}-{1}".format(first,last))
+
+			grid(transform(chunk),*properties())
+
+		return density
+
+	###################################################################################################################################################
+
+	def massDensity(self,resolution=0.5*Mpc,smooth=None,left_corner=None,save=False,density_placeholder=None,chunk_size=None,assignment="NGP",grid_shift=0.0):
+
+		"""
+		Uses a C backend gridding function to compute the matter mass density fluctutation for the current snapshot: the density is evaluated using a nearest grid point (or cloud in cell, triangular shaped cloud) mass assignment
 
 		:param resolution: resolution below which particles are grouped together; if an int is passed, this is the size of the grid
 		:type resolution: float with units or int.
@@ -421,21 +687,36 @@ class NbodySnapshot(object):
 		:param density placeholder: if not None, it is used as a fixed memory chunk for MPI communications of the density
 		:type density_placeholder: array
 
+		:param chunk_size: if not None, and the positions are not in memory already, the particles are read from the snapshot file and gridded chunk_size at a time, so that the full particle positions are never in memory (left_corner must be specified)
+		:type chunk_size: int.
+
+		:param assignment: mass assignment scheme, nearest grid point, cloud in cell or triangular shaped cloud; with CIC and TSC the box is assumed periodic
+		:type assignment: str. ("NGP","CIC","TSC")
+
+		:param grid_shift: shift of the grid with respect to the left corner, in units of the cell size (a shift of 0.5 is used for interlacing)
+		:type grid_shift: float.
+
 		:returns: tuple(numpy 3D array with the (unsmoothed) matter density fluctuation on a grid,bin resolution along the axes)  
 
 		"""
 
 		#Sanity checks
 		assert type(resolution) in [np.int,quantity.Quantity]
+		assert assignment in _assignment_order,"The mass assignment scheme must be one of {0}".format(", ".join(sorted(_assignment_order)))
 		
 		if type(resolution)==quantity.Quantity:	
 			assert resolution.unit.physical_type=="length"
 
-		#Check if positions are already available, otherwise retrieve them
+		#Check if positions are already available, otherwise retrieve them (all at once, or one chunk at a time when gridding)
 		if hasattr(self,"positions"):
 			positions = self.positions
+			length_unit = positions.unit
+		elif chunk_size is not None:
+			positions = None
+			length_unit = self._streamInfo(left_corner)
 		else:
 			positions = self.getPositions(save=False)
+			length_unit = positions.unit
 
 		assert hasattr(self,"weights")
 		assert hasattr(self,"virial_radius")
@@ -451,33 +732,42 @@ class NbodySnapshot(object):
 		if type(resolution)==quantity.Quantity:
 
 			#Scale to appropriate units
-			resolution = resolution.to(positions.unit)
-			xi = np.arange(xmin.to(positions.unit).value,(xmin + self._header["box_size"]).to(positions.unit).value,resolution.value)
-			yi = np.arange(ymin.to(positions.unit).value,(ymin + self._header["box_size"]).to(positions.unit).value,resolution.value)
-			zi = np.arange(zmin.to(positions.unit).value,(zmin + self._header["box_size"]).to(positions.unit).value,resolution.value)
+			resolution = resolution.to(length_unit)
+			xi = np.arange(xmin.to(length_unit).value,(xmin + self._header["box_size"]).to(length_unit).value,resolution.value)
+			yi = np.arange(ymin.to(length_unit).value,(ymin + self._header["box_size"]).to(length_unit).value,resolution.value)
+			zi = np.arange(zmin.to(length_unit).value,(zmin + self._header["box_size"]).to(length_unit).value,resolution.value)
 
 		else:
 
-			xi = np.linspace(xmin.to(positions.unit).value,(xmin + self._header["box_size"]).to(positions.unit).value,resolution+1)
-			yi = np.linspace(ymin.to(positions.unit).value,(ymin + self._header["box_size"]).to(positions.unit).value,resolution+1)
-			zi = np.linspace(zmin.to(positions.unit).value,(zmin + self._header["box_size"]).to(positions.unit).value,resolution+1)
+			xi = np.linspace(xmin.to(length_unit).value,(xmin + self._header["box_size"]).to(length_unit).value,resolution+1)
+			yi = np.linspace(ymin.to(length_unit).value,(ymin + self._header["box_size"]).to(length_unit).value,resolution+1)
+			zi = np.linspace(zmin.to(length_unit).value,(zmin + self._header["box_size"]).to(length_unit).value,resolution+1)
 
+		#Shift the grid if prompted: the particles that fall off the grid are wrapped around the periodic box
+		if grid_shift:
+			xi,yi,zi = [ b - grid_shift*(b[1]-b[0]) for b in (xi,yi,zi) ]
+
+		periodic = 7 if (assignment!="NGP" or grid_shift) else 0
 
 		#Compute the number count histogram
-		assert positions.value.dtype==np.float32
+		assert (positions is None) or positions.value.dtype==np.float32
 
-		#Weights
-		if self.weights is not None:
-			weights = (self.weights * self._header["num_particles_total"] / ((len(xi) - 1) * (len(yi) - 1) * (len(zi) - 1))).astype(np.float32)
-		else:
-			weights = None
+		#Weights and virial radii of the particles read last
+		def properties():
 
-		if self.virial_radius is not None:
-			rv = self.virial_radius.to(positions.unit).value
-		else:
-			rv = None
+			if self.weights is not None:
+				weights = (self.weights * self._header["num_particles_total"] / ((len(xi) - 1) * (len(yi) - 1) * (len(zi) - 1))).astype(np.float32)
+			else:
+				weights = None
+
+			if self.virial_radius is not None:
+				rv = self.virial_radius.to(length_unit).value
+			else:
+				rv = None
+
+			return weights,rv,self.concentration
 
-		density = ext._nbody.grid3d(positions.value,(xi,yi,zi),weights,rv,self.concentration) * (len(xi)-1) * (len(yi)-1) * (len(zi)-1) / self._header["num_particles_total"]
+		density = self._gridParticles(ext._nbody.grid3d,positions,(xi,yi,zi),properties,chunk_size,args=(_assignment_order[assignment],periodic)) * (len(xi)-1) * (len(yi)-1) * (len(zi)-1) / self._header["num_particles_total"]
 
 		#Accumulate from the other processors
 		if self.pool is not None:
@@ -495,7 +785,7 @@ class NbodySnapshot(object):
 				self.pool.closeWindow()
 
 		#Recompute resolution to make sure it represents the bin size correctly
-		bin_resolution = ((xi[1:]-xi[:-1]).mean() * positions.unit,(yi[1:]-yi[:-1]).mean() * positions.unit,(zi[1:]-zi[:-1]).mean() * positions.unit)
+		bin_resolution = ((xi[1:]-xi[:-1]).mean() * length_unit,(yi[1:]-yi[:-1]).mean() * length_unit,(zi[1:]-zi[:-1]).mean() * length_unit)
 
 		#Perform smoothing if prompted
 		if smooth is not None:
@@ -519,7 +809,7 @@ class NbodySnapshot(object):
 
 	###################################################################################################################################################
 
-	def cutPlaneGaussianGrid(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",add_nu_density=0,ratio_interp=1,**kwargs):
+	def cutPlaneGaussianGrid(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",add_nu_density=0,ratio_interp=1,chunk_size=None,assignment="NGP",sorted_sidecar=False,project_halos=False,**kwargs):
 
 		"""
 		Cuts a density (or lensing potential) plane out of the snapshot by computing the particle number density on a slab and performing Gaussian smoothing; the plane coordinates are cartesian comoving
@@ -548,6 +838,18 @@ class NbodySnapshot(object):
 		:param kind: decide if computing a density or gravitational potential plane (this is computed solving the poisson equation)
 		:type kind: str. ("density" or "potential")
 
+		:param chunk_size: if not None, and the positions are not in memory already, the particles are read from the snapshot file and gridded chunk_size at a time, so that the full particle positions are never in memory (left_corner must be specified)
+		:type chunk_size: int.
+
+		:param assignment: mass assignment scheme for particles without a NFW profile, nearest grid point, cloud in cell or triangular shaped cloud; the CIC and TSC windows are deconvolved in Fourier space from the plane
+		:type assignment: str. ("NGP","CIC","TSC")
+
+		:param sorted_sidecar: if True, and the positions are not in memory already, only the particles in the cells that intersect the slab are read from the spatially sorted copy of the positions (see writeSortedSidecar)
+		:type sorted_sidecar: bool.
+
+		:param project_halos: if True, and thickness_resolution is 1, the NFW profile of the particles that have one (halos) is averaged along the normal over the slab, instead of being sampled at the center of the slab (recommended for slabs thinner than the halos)
+		:type project_halos: bool.
+
 		:param kwargs: accepted keyword are: 'density_placeholder', a pre-allocated numpy array, with a RMA window opened on it; this facilitates the communication with different processors by using a single RMA window during the execution. 'l_squared' a pre-computed meshgrid of squared multipoles used for smoothing
 		:type kwargs: dict.
 
@@ -558,6 +860,7 @@ class NbodySnapshot(object):
 		#Sanity checks
 		assert normal in range(3),"There are only 3 dimensions!"
 		assert kind in ["density","potential"],"Specify density or potential plane!"
+		assert assignment in _assignment_order,"The mass assignment scheme must be one of {0}".format(", ".join(sorted(_assignment_order)))
 		assert type(thickness)==quantity.Quantity and thickness.unit.physical_type=="length"
 		assert type(center)==quantity.Quantity and center.unit.physical_type=="length"
 
@@ -571,11 +874,21 @@ class NbodySnapshot(object):
 		#Direction of the plane
 		plane_directions = [ d for d in range(3) if d!=normal ]
 
-		#Get the particle positions if not available get
+		#Get the particle positions if not available get (all at once, only the ones in the slab, or one chunk at a time when gridding)
 		if hasattr(self,"positions"):
 			positions = self.positions
+			length_unit = positions.unit
+		elif sorted_sidecar:
+			positions = self.slabPositions(normal,center-thickness/2,center+thickness/2)
+			length_unit = positions.unit
+			if left_corner is None:
+				left_corner = self._sortedIndex()["lower"]*length_unit
+		elif chunk_size is not None:
+			positions = None
+			length_unit = self._streamInfo(left_corner)
 		else:
 			positions = self.getPositions(first=self._first,last=self._last,save=False)
+			length_unit = positions.unit
 
 		assert hasattr(self,"weights")
 		assert hasattr(self,"virial_radius")
@@ -594,47 +907,50 @@ class NbodySnapshot(object):
 		if type(plane_resolution)==quantity.Quantity:
 			
 			assert plane_resolution.unit.physical_type=="length"
-			plane_resolution = plane_resolution.to(positions.unit)
-			binning[plane_directions[0]] = np.arange(left_corner[plane_directions[0]].to(positions.unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(positions.unit).value,plane_resolution.value)
-			binning[plane_directions[1]] = np.arange(left_corner[plane_directions[1]].to(positions.unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(positions.unit).value,plane_resolution.value)
+			plane_resolution = plane_resolution.to(length_unit)
+			binning[plane_directions[0]] = np.arange(left_corner[plane_directions[0]].to(length_unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(length_unit).value,plane_resolution.value)
+			binning[plane_directions[1]] = np.arange(left_corner[plane_directions[1]].to(length_unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(length_unit).value,plane_resolution.value)
 
 		else:
 
-			binning[plane_directions[0]] = np.linspace(left_corner[plane_directions[0]].to(positions.unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(positions.unit).value,plane_resolution+1)
-			binning[plane_directions[1]] = np.linspace(left_corner[plane_directions[1]].to(positions.unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(positions.unit).value,plane_resolution+1)
+			binning[plane_directions[0]] = np.linspace(left_corner[plane_directions[0]].to(length_unit).value,(left_corner[plane_directions[0]] + self._header["box_size"]).to(length_unit).value,plane_resolution+1)
+			binning[plane_directions[1]] = np.linspace(left_corner[plane_directions[1]].to(length_unit).value,(left_corner[plane_directions[1]] + self._header["box_size"]).to(length_unit).value,plane_resolution+1)
 
 		
 		#Binning in the normal direction		
 		assert type(thickness_resolution) in [np.int,quantity.Quantity]
-		center = center.to(positions.unit)
-		thickness  = thickness.to(positions.unit)
+		center = center.to(length_unit)
+		thickness  = thickness.to(length_unit)
 		
 		if type(thickness_resolution)==quantity.Quantity:
 			
 			assert thickness_resolution.unit.physical_type=="length"
-			thickness_resolution = thickness_resolution.to(positions.unit)
-			binning[normal] = np.arange((center - thickness/2).to(positions.unit).value,(center + thickness/2).to(positions.unit).value,thickness_resolution.value)
+			thickness_resolution = thickness_resolution.to(length_unit)
+			binning[normal] = np.arange((center - thickness/2).to(length_unit).value,(center + thickness/2).to(length_unit).value,thickness_resolution.value)
 
 		else:
 
-			binning[normal] = np.linspace((center - thickness/2).to(positions.unit).value,(center + thickness/2).to(positions.unit).value,thickness_resolution+1)
+			binning[normal] = np.linspace((center - thickness/2).to(length_unit).value,(center + thickness/2).to(length_unit).value,thickness_resolution+1)
 
-		#Weights
-		if self.weights is not None:
-			weights = self.weights.astype(np.float32)
-		else:
-			weights = None
+		#Weights and virial radii of the particles read last
+		def properties():
 
-		#Virial radius
-		if self.virial_radius is not None:
-			assert weights is not None,"Particles have virial radiuses, you should specify their weight!"
-			weights  = (weights * self._header["num_particles_total"] / ((len(binning[0]) - 1) * (len(binning[1]) - 1) * (len(binning[2]) - 1))).astype(np.float32)
-			rv = self.virial_radius.to(positions.unit).value
-		else:
-			rv = None
+			if self.weights is not None:
+				weights = self.weights.astype(np.float32)
+			else:
+				weights = None
+
+			if self.virial_radius is not None:
+				assert weights is not None,"Particles have virial radiuses, you should specify their weight!"
+				weights  = (weights * self._header["num_particles_total"] / ((len(binning[0]) - 1) * (len(binning[1]) - 1) * (len(binning[2]) - 1))).astype(np.float32)
+				rv = self.virial_radius.to(length_unit).value
+			else:
+				rv = None
+
+			return weights,rv,self.concentration
 
 		#Recompute resolution to make sure it represents the bin size correctly
-		bin_resolution = [ (binning[n][1:]-binning[n][:-1]).mean() * positions.unit for n in (0,1,2) ]
+		bin_resolution = [ (binning[n][1:]-binning[n][:-1]).mean() * length_unit for n in (0,1,2) ]
 
 		############################################################################################################
 		#################################Longitudinal normalization factor##########################################
@@ -653,7 +969,7 @@ class NbodySnapshot(object):
 			density_normalization = bin_resolution[normal] * center * (1.+zlens)
 
 		#Now use gridding to compute the density along the slab
-		assert positions.value.dtype==np.float32
+		assert (positions is None) or positions.value.dtype==np.float32
 
 		#Log
 		if self.pool is not None:
@@ -665,7 +981,10 @@ class NbodySnapshot(object):
 		#Gridding#
 		##########
 
-		density = ext._nbody.grid3d_nfw(positions.value,tuple(binning),weights,rv,self.concentration)
+		#The mass assignment scheme is used only on the plane, which is periodic; the halos that do not reach the slab are culled
+		order = _assignment_order[assignment]
+		periodic = (1<<plane_directions[0]) | (1<<plane_directions[1]) if order>1 else 0
+		density = self._gridParticles(ext._nbody.grid3d_nfw,positions,binning,properties,chunk_size,args=(order,periodic,normal,int(project_halos)),cull=True)
 
 		###################################################################################################################################
 
@@ -748,8 +1067,10 @@ class NbodySnapshot(object):
 
 		bin_resolution.pop(normal)
 
-		#If smoothing is enabled or potential calculations are needed, we need to FFT the density field
-		if (smooth is not None) or kind=="potential":
+		#If smoothing is enabled, potential calculations are needed or the mass assignment window has to be deconvolved, we need to FFT the density field
+		deconvolve = (order>1) and (self.virial_radius is None)
+		
+		if (smooth is not None) or kind=="potential" or deconvolve:
 
 			#Compute the multipoles
 			if "l_squared" in kwargs.keys():
@@ -770,6 +1091,11 @@ class NbodySnapshot(object):
 
 			density_ft = fftengine.rfftn(density_projected)
 
+			#Deconvolve the mass assignment window
+			if deconvolve:
+				lx,ly = np.meshgrid(fftengine.fftfreq(density_projected.shape[0]),fftengine.rfftfreq(density_projected.shape[1]),indexing="ij")
+				density_ft /= _assignmentWindow(order,lx,ly)
+
                         #### JL: add neutrino density
                         if add_nu_density:
                                 print '\n !!!!! min,max of andreas np.sqrt(l_squared)', np.amin(np.sqrt(l_squared)), np.amax(np.sqrt(l_squared))
@@ -826,49 +1152,440 @@ class NbodySnapshot(object):
 
 	############################################################################################################################################################################
 
-	def neighborDistances(self,neighbors=64):
+	def cutPlanes(self,slabs,plane_resolution=4096,left_corner=None,thickness_resolution=1,smooth=1,kind="density",add_nu_density=0,ratio_interp=1,chunk_size=None,assignment="NGP",interlacing=False,**kwargs):
+
+		"""
+		Cuts many density (or lensing potential) planes out of the snapshot at once: each particle is binned in all the slabs it belongs to in a single sweep of the C gridder, and the Poisson equation is solved for all the planes with a single batch of FFTs. The results are the same as calling cutPlaneGaussianGrid for each slab (particles with a NFW profile are gridded on one slab at a time, but still in a single sweep through the particles). With MPI the planes are reduced with a reduce-scatter, so that each task solves the Poisson equation for a range of slabs: if the positions are in memory, the slabs are gridded one at a time and the reduction of each slab overlaps with the gridding of the next one
+
+		:param slabs: specifications of the slabs to cut, one (normal,center,thickness) tuple for each plane
+		:type slabs: list.
+
+		:param plane_resolution: plane resolution (perpendicular to the normal)
+		:type plane_resolution: float. with units (or int.)
+
+		:param left_corner: specify the position of the lower left corner of the box; if None, the minimum of the (x,y,z) of the contained particles is assumed
+		:type left_corner: tuple of quantities or None
+
+		:param thickness_resolution: plane resolution (along the normal)
+		:type thickness_resolution: float. with units (or int.)
+
+		:param smooth: if not None, performs a smoothing of the density (or potential) with a gaussian kernel of scale "smooth x the pixel resolution"
+		:type smooth: int. or None
+
+		:param kind: decide if computing a density or gravitational potential plane (this is computed solving the poisson equation)
+		:type kind: str. ("density" or "potential")
+
+		:param chunk_size: if not None, and the positions are not in memory already, the particles are read from the snapshot file and gridded chunk_size at a time, so that the full particle positions are never in memory (left_corner must be specified)
+		:type chunk_size: int.
+
+		:param assignment: mass assignment scheme on the plane, nearest grid point, cloud in cell or triangular shaped cloud; the CIC and TSC windows are deconvolved in Fourier space from the planes
+		:type assignment: str. ("NGP","CIC","TSC")
+
+		:param interlacing: if True, each plane is gridded a second time with the pixels shifted by half their size, and the two are combined in Fourier space to reduce aliasing (not supported for particles with a NFW profile)
+		:type interlacing: bool.
+
+		:param kwargs: accepted keyword are: 'density_placeholder', a pre-allocated numpy array with shape (number of slabs,plane_resolution,plane_resolution) that holds the planes during the gridding (the number of slabs is doubled with interlacing); 'l_squared' a pre-computed meshgrid of squared multipoles used for smoothing; 'project_halos' for particles with a NFW profile (see cutPlaneGaussianGrid)
+		:type kwargs: dict.
+
+		:returns: list of tuple(numpy 2D array with the density (or lensing potential),bin resolution along the axes, number of particles on the plane), one for each slab
+
+		"""
+
+		#Sanity checks
+		assert kind in ["density","potential"],"Specify density or potential plane!"
+		assert assignment in _assignment_order,"The mass assignment scheme must be one of {0}".format(", ".join(sorted(_assignment_order)))
+		for normal,center,thickness in slabs:
+			assert normal in range(3),"There are only 3 dimensions!"
+			assert type(thickness)==quantity.Quantity and thickness.unit.physical_type=="length"
+			assert type(center)==quantity.Quantity and center.unit.physical_type=="length"
+
+		#Redshift must be bigger than 0 or we cannot proceed
+		if ("redshift" in self.header) and (self.header["redshift"]<=0.0):
+			raise ValueError("The snapshot redshift must be >0 for the lensing density to be defined!")
+
+		#Particles with structure (halos) are gridded with their NFW profile, and cannot be interlaced
+		halos = getattr(self,"virial_radius",None) is not None
+		assert not(halos and interlacing),"Interlacing is not supported for particles with a NFW profile!"
+
+		#Cosmological normalization factor
+		cosmo_normalization = 1.5 * self.header["H0"]**2 * self.header["Om0"] / c**2
+
+		#Get the particle positions if not available get (all at once, or one chunk at a time when gridding)
+		if hasattr(self,"positions"):
+			positions = self.positions
+			length_unit = positions.unit
+		elif chunk_size is not None:
+			positions = None
+			length_unit = self._streamInfo(left_corner)
+		else:
+			positions = self.getPositions(first=self._first,last=self._last,save=False)
+			length_unit = positions.unit
+
+		assert hasattr(self,"weights")
+
+		#Lower left corner of the planes
+		if left_corner is None:
+			left_corner = positions.min(axis=0)
+
+		#Transverse binning, the same for all the slabs
+		assert type(plane_resolution) in [np.int,quantity.Quantity]
+		
+		if type(plane_resolution)==quantity.Quantity:
+			assert plane_resolution.unit.physical_type=="length"
+			plane_resolution = plane_resolution.to(length_unit)
+			binning = [ np.arange(left_corner[d].to(length_unit).value,(left_corner[d] + self._header["box_size"]).to(length_unit).value,plane_resolution.value) for d in range(3) ]
+		else:
+			binning = [ np.linspace(left_corner[d].to(length_unit).value,(left_corner[d] + self._header["box_size"]).to(length_unit).value,plane_resolution+1) for d in range(3) ]
+
+		#Binning in the normal direction of each slab
+		assert type(thickness_resolution) in [np.int,quantity.Quantity]
+		normal_binning = list()
+
+		for normal,center,thickness in slabs:
+
+			center = center.to(length_unit)
+			thickness = thickness.to(length_unit)
+
+			if type(thickness_resolution)==quantity.Quantity:
+				assert thickness_resolution.unit.physical_type=="length"
+				normal_binning.append(np.arange((center - thickness/2).to(length_unit).value,(center + thickness/2).to(length_unit).value,thickness_resolution.to(length_unit).value))
+			else:
+				normal_binning.append(np.linspace((center - thickness/2).to(length_unit).value,(center + thickness/2).to(length_unit).value,thickness_resolution+1))
+
+		#Slab specifications for the gridder: (normal,lower edge,bin size,number of bins,transverse shift in pixels); with interlacing each slab is followed by a copy with the pixels shifted by half their size
+		copies = 1 + int(interlacing)
+		slab_specs = np.repeat(np.array([ (normal,b[0],b[1]-b[0],len(b)-1,0.0) for ((normal,center,thickness),b) in zip(slabs,normal_binning) ],dtype=np.float64),copies,axis=0)
+		if interlacing:
+			slab_specs[1::2,4] = 0.5
+
+		Nslabs = len(slab_specs)
+		order = _assignment_order[assignment]
+
+		#Weights (and virial radii, concentrations of the halos) of the particles read last
+		def properties():
+
+			if self.weights is not None:
+				weights = self.weights.astype(np.float32)
+			else:
+				weights = None
+
+			if halos:
+				assert weights is not None,"Particles have virial radiuses, you should specify their weight!"
+				return weights,self.virial_radius.to(length_unit).value,self.concentration
+			else:
+				return weights,None,None
+
+		#Log
+		if self.pool is not None:
+			logplanes.debug("Task {0} began gridding procedure on {1} slabs".format(self.pool.rank,len(slabs)))
+		else:
+			logplanes.debug("Began gridding procedure on {0} slabs".format(len(slabs)))
+
+		##########
+		#Gridding#
+		##########
+
+		assert (positions is None) or positions.value.dtype==np.float32
+		npix = len(binning[0]) - 1
+
+		if "density_placeholder" in kwargs:
+			density_projected = kwargs["density_placeholder"]
+			assert density_projected.shape==(Nslabs,npix,npix)
+			density_projected[:] = 0.0
+		else:
+			density_projected = np.zeros((Nslabs,npix,npix),dtype=np.float32)
+
+		#Grid the particles on the planes of the slabs first<=s<last
+		def gridSlabs(first,last):
+
+			planes = density_projected[first*copies:last*copies]
+
+			if halos:
+
+				#Halos are gridded with their NFW profile on each slab and projected along the normal (the halos that do not reach the slab are culled)
+				def gridder(p,b,w,rv,concentration,planes):
+
+					for s in range(first,last):
+
+						normal = slabs[s][0]
+						slab_binning = list(b)
+						slab_binning[normal] = normal_binning[s]
+						num_cells = (len(slab_binning[0]) - 1) * (len(slab_binning[1]) - 1) * (len(slab_binning[2]) - 1)
+						slab_weights = (w * self._header["num_particles_total"] / num_cells).astype(np.float32)
+
+						#The mass assignment scheme is used only on the plane, which is periodic
+						plane_directions = [ d for d in range(3) if d!=normal ]
+						periodic = (1<<plane_directions[0]) | (1<<plane_directions[1]) if order>1 else 0
+						
+						density = self._gridParticles(ext._nbody.grid3d_nfw,p,slab_binning,lambda:(slab_weights,rv,concentration),transform=lambda x:x,args=(order,periodic,normal,int(kwargs.get("project_halos",False))),cull=True)
+						planes[s-first] += density.sum(normal)
+
+				self._gridParticles(gridder,positions,binning,properties,chunk_size,density=planes)
+
+			else:
+			
+				#The plane directions are periodic
+				specs = slab_specs[first*copies:last*copies]
+				gridder = lambda p,b,w,rv,concentration,planes,*args:ext._nbody.grid2d_slabs(p,w,b,specs,planes,*args)
+				self._gridParticles(gridder,positions,binning,properties,chunk_size,density=planes,args=(order,int(order>1 or interlacing)))
+
+		#The planes are reduced from all the tasks with a reduce-scatter: each task gets the planes of a range of slabs, and solves the Poisson equation for them
+		if self.pool is None:
+			first_slab,last_slab = 0,len(slabs)
+		else:
+			slab_edges = self.pool.slabEdges(len(slabs))
+			first_slab,last_slab = slab_edges[self.pool.rank],slab_edges[self.pool.rank+1]
+
+		if (self.pool is not None) and (positions is not None):
+
+			#With the positions in memory the slabs are gridded one at a time, and the reduction of each slab (onto the task that owns it) proceeds while the next one is gridded
+			requests = list()
+
+			for s in range(len(slabs)):
+				gridSlabs(s,s+1)
+				owner = np.searchsorted(slab_edges,s,side="right") - 1
+				requests += self.pool.reduceArray(density_projected[s*copies:(s+1)*copies],root=owner,blocking=False)
+
+			logplanes.debug("Task {0} done with gridding procedure, waiting for the reductions".format(self.pool.rank))
+			self.pool.wait(requests)
+			density_projected = density_projected[first_slab*copies:last_slab*copies]
+
+		else:
+
+			#The particles streamed from the snapshot file are read once for all the slabs
+			gridSlabs(0,len(slabs))
+
+			if self.pool is not None:
+				logplanes.debug("Task {0} collected {1:.3e} particles".format(self.pool.rank,density_projected.sum()))
+				density_projected = self.pool.reduceScatter(density_projected.reshape(len(slabs),-1)).reshape((-1,npix,npix))
+
+		#Log
+		if self.pool is not None:
+			logplanes.debug("Task {0} done with gridding procedure and reduction".format(self.pool.rank))
+		else:
+			logplanes.debug("Done with gridding procedure")
+
+		if (self.pool is None) or (self.pool.is_master()):
+			logstderr.debug("Done with gridding procedure: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+		#Bin resolution, density and Poisson normalizations for each plane
+		bin_resolutions = list()
+		density_factors = list()
+		density_normalizations = list()
+		potential_normalizations = np.zeros(len(slabs))
+
+		for s,(normal,center,thickness) in enumerate(slabs):
+
+			bin_resolution = [ (binning[n][1:]-binning[n][:-1]).mean() * length_unit for n in (0,1,2) ]
+			bin_resolution[normal] = (normal_binning[s][1:]-normal_binning[s][:-1]).mean() * length_unit
+
+			#Normalization to the density fluctuation
+			density_factors.append((self._header["box_size"]**3 / (bin_resolution[0]*bin_resolution[1]*bin_resolution[2])).decompose().value / self._header["num_particles_total"])
+
+			#Longitudinal normalization factor (if the comoving distance is not provided in the header, the position along the normal direction is assumed)
+			if "comoving_distance" in self.header:
+				density_normalizations.append(bin_resolution[normal] * self.header["comoving_distance"] / self.header["scale_factor"])
+				chi = self.header["comoving_distance"]
+			else:
+				zlens = z_at_value(self.cosmology.comoving_distance,center)
+				density_normalizations.append(bin_resolution[normal] * center * (1.+zlens))
+				chi = center
+
+			bin_resolution.pop(normal)
+			bin_resolutions.append(bin_resolution)
+			potential_normalizations[s] = -2.0 * (bin_resolution[0] * bin_resolution[1] / chi**2).decompose().value
+
+		#Compute the number of particles on the planes of this task, and normalize the density to the density fluctuation (the interlaced copy of each slab follows it)
+		num_planes = last_slab - first_slab
+		density_projected = density_projected.reshape((num_planes,copies,npix,npix))
+		NumPartTotal = density_projected[:,0].sum(axis=(1,2)).astype(np.float64)
+
+		for s in range(num_planes):
+			density_projected[s] *= density_factors[first_slab+s]
+
+		#################################################################################################################################
+		######################################Ready to solve poisson equation via FFTs###################################################
+		#################################################################################################################################
+
+		#If smoothing is enabled, potential calculations are needed, the mass assignment window has to be deconvolved (not for halos) or the planes interlaced, FFT all the planes of this task at once
+		deconvolve = (order>1) and not(halos)
+		
+		if num_planes and ((smooth is not None) or kind=="potential" or deconvolve or interlacing):
+
+			#Compute the multipoles
+			if "l_squared" in kwargs.keys():
+				l_squared = kwargs["l_squared"]
+			else:
+				lx,ly = np.meshgrid(fftengine.fftfreq(npix),fftengine.rfftfreq(npix),indexing="ij")
+				l_squared = lx**2 + ly**2
+				
+				#Avoid dividing by 0
+				l_squared[0,0] = 1.0
+
+			if self.pool is not None:
+				logplanes.debug("Task {0} proceeding in density FFT operations on {1} planes...".format(self.pool.rank,num_planes))
+			else:
+				logplanes.debug("Proceeding in density FFT operations on {0} planes...".format(num_planes))
+
+			density_ft = fftengine.rfft2(density_projected)
+			lx,ly = np.meshgrid(fftengine.fftfreq(npix),fftengine.rfftfreq(npix),indexing="ij")
+
+			#Combine the interlaced planes
+			if interlacing:
+				density_ft = _interlace(density_ft[:,0],density_ft[:,1],lx,ly)
+			else:
+				density_ft = density_ft[:,0]
+
+			#Deconvolve the mass assignment window
+			if deconvolve:
+				density_ft /= _assignmentWindow(order,lx,ly)
+
+			#Add the neutrino density
+			if add_nu_density:
+				density_ft *= ratio_interp(np.sqrt(l_squared))
+
+			#Zero out the zeroth frequency
+			density_ft[:,0,0] = 0.0
+
+			#Solve the poisson equation
+			if kind=="potential":
+				density_ft *= potential_normalizations[first_slab:last_slab,None,None] / (l_squared * ((2.0*np.pi)**2))
+
+			#Perform the smoothing
+			if smooth is not None:
+				density_ft *= np.exp(-0.5*((2.0*np.pi*smooth)**2)*l_squared)
+
+			#Revert the FFT
+			planes = fftengine.irfft2(density_ft)
+
+			if (self.pool is None) or (self.pool.is_master()):
+				logplanes.debug("Done with density FFT operations...")
+				logstderr.debug("Done with density FFT operations: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+		else:
+			planes = density_projected[:,0]
+
+		#Multiply by the normalization factors
+		lensing_potentials = np.empty((num_planes,npix,npix),dtype=np.float64)
+
+		for s in range(num_planes):
+
+			lensing_potential = (planes[s] * cosmo_normalization * density_normalizations[first_slab+s]).decompose()
+			assert lensing_potential.unit.physical_type=="dimensionless"
+			lensing_potentials[s] = lensing_potential.value
+
+		#Collect the planes of all the tasks on the master
+		if self.pool is not None:
+
+			lensing_potentials = self.pool.gatherSlabs(lensing_potentials,len(slabs))
+			NumPartTotal = self.pool.gatherSlabs(NumPartTotal,len(slabs))
+
+			#If this task is not the master, we can return now
+			if not self.pool.is_master():
+				return [(None,)*3]*len(slabs)
+
+		results = list()
+
+		for s in range(len(slabs)):
+
+			#Add units to lensing potential
+			if kind=="potential":
+				lensing_potential = lensing_potentials[s] * rad**2
+			else:
+				lensing_potential = lensing_potentials[s]
+
+			results.append((lensing_potential,bin_resolutions[s],NumPartTotal[s]))
+
+		#Return
+		return results
+
+
+	############################################################################################################################################################################
+
+	#Sidecar file that stores the distances of the particles to their N-th nearest neighbor, next to the snapshot file
+	def _neighborsSidecar(self,neighbors):
+
+		first,last = self._first,self._last
+		if (first is None) and (last is None):
+			return "{0}.nn{1}.npy".format(self.fp.name,neighbors)
+		else:
+			return "{0}.nn{1}_{2}-{3}.npy".format(self.fp.name,neighbors,*self._particleRange())
+
+	def neighborDistances(self,neighbors=64,workers=1,sidecar=False):
 
 		"""
-		Find the N-th nearest neighbors to each particle
+		Find the N-th nearest neighbors to each particle; the distances are kept in memory, so that they are computed only once for each neighbor order
 
 		:param neighbors: neighbor order
 		:type neighbors: int.
 
+		:param workers: number of parallel workers used to query the KD-Tree (-1 uses all the available cores)
+		:type workers: int.
+
+		:param sidecar: if True, the distances are read from a sidecar file next to the snapshot file, keyed by the neighbor order (and the range of particles); if the file does not exist, or is older than the snapshot file, it is (re)created after computing the distances
+		:type sidecar: bool.
+
 		:returns: array with units
 
 		"""
 
+		#Check if the distances were computed already
+		if not hasattr(self,"_neighbor_distances"):
+			self._neighbor_distances = dict()
+
+		if neighbors in self._neighbor_distances:
+			return self._neighbor_distances[neighbors]
+
+		#Read the distances from the sidecar file if available, and more recent than the snapshot file (before the positions are read: only their unit is needed)
+		if sidecar:
+			
+			sidecar_file = self._neighborsSidecar(neighbors)
+			if os.path.exists(sidecar_file) and (os.path.getmtime(sidecar_file)>=os.path.getmtime(self.fp.name)):
+				
+				logplanes.debug("Reading neighbor distances from {0}".format(sidecar_file))
+				rp = np.load(sidecar_file)
+
+				first,last = self._particleRange()
+				assert rp.shape[0]==last-first,"The neighbor distances in {0} do not match the number of particles!".format(sidecar_file)
+
+				if hasattr(self,"positions"):
+					length_unit = self.positions.unit
+				else:
+					length_unit = self.getPositions(first=first,last=min(first+1,last),save=False).unit
+				
+				self._neighbor_distances[neighbors] = rp * length_unit
+				return self._neighbor_distances[neighbors]
+
 		#Get the particle positions if not available get
 		if hasattr(self,"positions"):
-			positions = self.positions.copy()
+			positions = self.positions
 		else:
-			positions = self.getPositions(save=False)
+			positions = self.getPositions(first=self._first,last=self._last,save=False)
 
 		#Build the KD-Tree
 		particle_tree = KDTree(positions.value)
 
-		#For memory reasons, with large datasets it's better to proceed in chunks with nearest neighbors queries
-		numPart = positions.shape[0]
-		rp = np.zeros(numPart)
-
-		#Split the particles in chunks
-		chunkSize = numPart // neighbors
-		remaining = numPart % neighbors
-
-		#Cycle over the chunks, querying the tree
-		for i in range(neighbors):
-			rp[i*chunkSize:(i+1)*chunkSize] = particle_tree.query(positions[i*chunkSize:(i+1)*chunkSize].value,k=neighbors)[0][:,neighbors-1]
+		#Query the tree in parallel, retrieving only the distance to the N-th neighbor
+		try:
+			rp = particle_tree.query(positions.value,k=[neighbors],workers=workers)[0][:,0]
+		except TypeError:
+			rp = particle_tree.query(positions.value,k=[neighbors],n_jobs=workers)[0][:,0]
 
-		if remaining:
-			rp[neighbors*chunkSize:] = particle_tree.query(positions[neighbors*chunkSize:].value,k=neighbors)[0][:,neighbors-1]
+		#Save the distances for reuse
+		if sidecar:
+			logplanes.debug("Saving neighbor distances to {0}".format(sidecar_file))
+			with open(sidecar_file+".tmp","wb") as sidecarfp:
+				np.save(sidecarfp,rp)
+			os.rename(sidecar_file+".tmp",sidecar_file)
 
 		#Return
-		return rp * positions.unit
+		self._neighbor_distances[neighbors] = rp * positions.unit
+		return self._neighbor_distances[neighbors]
 
 
 	############################################################################################################################################################################
 
-	def cutPlaneAdaptive(self,normal=2,center=7.0*Mpc,left_corner=None,plane_resolution=0.1*Mpc,neighbors=64,neighborDistances=None,kind="density",projectAll=False):
+	def cutPlaneAdaptive(self,normal=2,center=7.0*Mpc,left_corner=None,plane_resolution=0.1*Mpc,neighbors=64,neighborDistances=None,kind="density",projectAll=False,workers=1,sidecar=False):
 
 		"""
 		Cuts a density (or gravitational potential) plane out of the snapshot by computing the particle number density using an adaptive smoothing scheme; the plane coordinates are cartesian comoving
@@ -897,6 +1614,12 @@ class NbodySnapshot(object):
 		:param projectAll: if True, all the snapshot is projected on a single slab perpendicular to the normal, ignoring the position of the center
 		:type projectAll: bool.
 
+		:param workers: number of parallel workers used to find the nearest neighbors (passed to neighborDistances)
+		:type workers: int.
+
+		:param sidecar: if True, the neighbor distances are reused from (or saved to) a sidecar file next to the snapshot (passed to neighborDistances)
+		:type sidecar: bool.
+
 		:returns: tuple(numpy 2D array with the computed particle number density (or lensing potential),bin resolution along the axes,number of particles on the plane)
 
 		"""
@@ -951,7 +1674,7 @@ class NbodySnapshot(object):
 		if neighborDistances is None:
 	
 			#Find the distance to the Nth-nearest neighbor
-			rp = self.neighborDistances(neighbors).to(positions.unit).value
+			rp = self.neighborDistances(neighbors,workers=workers,sidecar=sidecar).to(positions.unit).value
 
 		else:
 			
@@ -1030,7 +1753,7 @@ class NbodySnapshot(object):
 
 	############################################################################################################################################################################
 
-	def cutPlaneAngular(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,left_corner=None,plane_lower_corner=np.array([0.0,0.0])*deg,plane_size=0.15*deg,plane_resolution=1.0*arcmin,thickness_resolution=0.1*Mpc,smooth=None,tomography=False,kind="density",space="real"):
+	def cutPlaneAngular(self,normal=2,thickness=0.5*Mpc,center=7.0*Mpc,left_corner=None,plane_lower_corner=np.array([0.0,0.0])*deg,plane_size=0.15*deg,plane_resolution=1.0*arcmin,thickness_resolution=0.1*Mpc,smooth=None,tomography=False,kind="density",space="real",chunk_size=None,sorted_sidecar=False):
 
 		"""
 		Same as cutPlaneGaussianGrid(), except that this method will return a lens plane as seen from an observer at z=0; the spatial transverse units are converted in angular units as seen from the observer
@@ -1071,6 +1794,12 @@ class NbodySnapshot(object):
 		:param space: if "real" return the lens plane in real space, if "fourier" the Fourier transform is not inverted
 		:type space: str.
 
+		:param chunk_size: if not None, and the positions are not in memory already, the particles are read from the snapshot file and gridded chunk_size at a time, so that the full particle positions are never in memory (left_corner must be specified)
+		:type chunk_size: int.
+
+		:param sorted_sidecar: if True, and the positions are not in memory already, only the particles in the cells that intersect the slab are read from the spatially sorted copy of the positions (see writeSortedSidecar)
+		:type sorted_sidecar: bool.
+
 		:returns: tuple(numpy 2D or 3D array with the (unsmoothed) particle angular number density,bin angular resolution, total number of particles on the plane); the constant spatial part of the density field is subtracted (we keep the fluctuation only)
 
 		"""
@@ -1090,28 +1819,34 @@ class NbodySnapshot(object):
 		plane_directions = range(3)
 		plane_directions.pop(normal)
 
-		#Get the particle positions if not available get
+		#Get the particle positions if not available get (all at once, only the ones in the slab, or one chunk at a time when gridding)
 		if hasattr(self,"positions"):
-			positions = self.positions.copy()
+			positions = self.positions
+			length_unit = positions.unit
+		elif sorted_sidecar:
+			positions = self.slabPositions(normal,center-thickness/2,center+thickness/2)
+			length_unit = positions.unit
+			if left_corner is None:
+				left_corner = self._sortedIndex()["lower"]*length_unit
+		elif chunk_size is not None:
+			positions = None
+			length_unit = self._streamInfo(left_corner)
 		else:
 			positions = self.getPositions(save=False)
+			length_unit = positions.unit
 
 		assert hasattr(self,"weights")
 		assert hasattr(self,"virial_radius")
 		assert hasattr(self,"concentration")
 
 		#Scale the units
-		thickness = thickness.to(positions.unit)
-		center = center.to(positions.unit)
+		thickness = thickness.to(length_unit)
+		center = center.to(length_unit)
 
 		#Lower left corner of the plane
 		if left_corner is None:
 			left_corner = positions.min(axis=0)
 
-		#Translate the transverse coordinates so that the lower corner is in (0,0)
-		for i in range(2):
-			positions[:,plane_directions[i]] -= left_corner[plane_directions[i]].astype(np.float32)
-
 		#Create a list that holds the bins
 		binning = [None,None,None]
 		
@@ -1132,44 +1867,55 @@ class NbodySnapshot(object):
 
 		
 		#Get the snapshot comoving distance from the observer (which is the same as the plane comoving distance)
-		plane_comoving_distance = self.cosmology.comoving_distance(self._header["redshift"]).to(positions.unit)
+		plane_comoving_distance = self.cosmology.comoving_distance(self._header["redshift"]).to(length_unit)
 
 		#Binning in the normal direction		
 		assert type(thickness_resolution) in [np.int,quantity.Quantity]
-		center = center.to(positions.unit)
-		thickness  = thickness.to(positions.unit)
+		center = center.to(length_unit)
+		thickness  = thickness.to(length_unit)
 		
 		if type(thickness_resolution)==quantity.Quantity:
 			
 			assert thickness_resolution.unit.physical_type=="length"
-			thickness_resolution = thickness_resolution.to(positions.unit)
-			binning[normal] = np.arange((plane_comoving_distance - thickness/2).to(positions.unit).value,(plane_comoving_distance + thickness/2).to(positions.unit).value,thickness_resolution.value)
+			thickness_resolution = thickness_resolution.to(length_unit)
+			binning[normal] = np.arange((plane_comoving_distance - thickness/2).to(length_unit).value,(plane_comoving_distance + thickness/2).to(length_unit).value,thickness_resolution.value)
 
 		else:
 
-			binning[normal] = np.linspace((plane_comoving_distance - thickness/2).to(positions.unit).value,(plane_comoving_distance + thickness/2).to(positions.unit).value,thickness_resolution+1)
+			binning[normal] = np.linspace((plane_comoving_distance - thickness/2).to(length_unit).value,(plane_comoving_distance + thickness/2).to(length_unit).value,thickness_resolution+1)
 
 
-		#Now that everything has the same units, let's go dimensionless to convert into angular units
-		length_unit = positions.unit
-		positions = positions.value
+		#Now that everything has the same units, let's go dimensionless to convert into angular units (on a copy of the positions)
+		def angular(positions):
 
-		#Convert the normal direction into comoving distance from the observer
-		positions[:,normal] += (plane_comoving_distance.value - center.value)
+			positions = positions.to(length_unit).value.copy()
 
-		#Convert the longitudinal spatial coordinates into angles (theta = comiving transverse/comoving distance)
-		for i in range(2):
-			positions[:,plane_directions[i]] /= positions[:,normal]
+			#Translate the transverse coordinates so that the lower corner is in (0,0)
+			for i in range(2):
+				positions[:,plane_directions[i]] -= left_corner[plane_directions[i]].to(length_unit).value.astype(np.float32)
 
-		#Now use grid3d to compute the angular density on the lens plane
-		assert positions.dtype==np.float32
+			#Convert the normal direction into comoving distance from the observer
+			positions[:,normal] += (plane_comoving_distance.value - center.value)
 
-		if self.virial_radius is not None:
-			rv = self.virial_radius.to(positions.unit).value
-		else:
-			rv = None
+			#Convert the longitudinal spatial coordinates into angles (theta = comiving transverse/comoving distance)
+			for i in range(2):
+				positions[:,plane_directions[i]] /= positions[:,normal]
 
-		density = ext._nbody.grid3d(positions,tuple(binning),self.weights,rv,self.concentration)
+			assert positions.dtype==np.float32
+			return positions
+
+		#Weights and virial radii of the particles read last
+		def properties():
+
+			if self.virial_radius is not None:
+				rv = self.virial_radius.to(length_unit).value
+			else:
+				rv = None
+
+			return self.weights,rv,self.concentration
+
+		#Now use grid3d to compute the angular density on the lens plane
+		density = self._gridParticles(ext._nbody.grid3d,positions,binning,properties,chunk_size,transform=angular)
 
 		#Accumulate the density from the other processors
 		if self.pool is not None:
@@ -1286,7 +2032,144 @@ class NbodySnapshot(object):
 	#############################################################################################################################################
 
 
-	def powerSpectrum(self,k_edges,resolution=None,return_num_modes=False,density_placeholder=None):
+	#Grid the particles on the slab (along the first axis) of the periodic density grid owned by this task: each particle is sent to the tasks that own the cells covered by its cloud
+	def _slabDensity(self,positions,left_corner,num_cells,assignment,grid_shift=0.0):
+
+		num_tasks,rank = (1,0) if (self.pool is None) else (self.pool.comm.size,self.pool.comm.rank)
+		assert num_cells%num_tasks==0,"The number of grid cells ({0}) must be divisible by the number of tasks ({1})!".format(num_cells,num_tasks)
+		slab_cells = num_cells//num_tasks
+		order = _assignment_order[assignment]
+
+		#Positions in units of the cell size, wrapped in the periodic box
+		cells = np.mod((positions - left_corner).to(self._header["box_size"].unit).value*num_cells/self._header["box_size"].value + grid_shift,num_cells).astype(np.float32)
+		cells[cells>=num_cells] = 0.0
+
+		#Weights
+		if self.weights is not None:
+			weights = (self.weights * self._header["num_particles_total"] / num_cells**3).astype(np.float32)
+		else:
+			weights = None
+
+		#Destination tasks: the cell of the particle and, with CIC or TSC, the neighboring cells along the first axis (across the periodic boundary, the particle is shifted by a box size)
+		cell = cells[:,0].astype(np.int64)
+		rows,destinations,shifts = list(),list(),list()
+
+		for d in ((0,) if (order==1 or num_tasks==1) else (0,-1,1)):
+
+			neighbor = cell + d
+			shift = num_cells*((neighbor<0).astype(np.int64) - (neighbor>=num_cells).astype(np.int64))
+			task = np.mod(neighbor,num_cells)//slab_cells
+
+			#Send at most one copy of the particle with the same shift to each task
+			new = np.ones(len(cell),dtype=np.bool_)
+			for previous_task,previous_shift in zip(destinations,shifts):
+				new &= (task!=previous_task) | (shift!=previous_shift)
+
+			rows.append(np.where(new)[0])
+			destinations.append(task)
+			shifts.append(shift)
+
+		destinations = [ t[r] for t,r in zip(destinations,rows) ]
+		shifts = [ h[r] for h,r in zip(shifts,rows) ]
+
+		#Sort the particles by destination and exchange them
+		rows,destinations,shifts = np.concatenate(rows),np.concatenate(destinations),np.concatenate(shifts)
+		sort = np.argsort(destinations,kind="mergesort")
+		rows,destinations,shifts = rows[sort],destinations[sort],shifts[sort]
+
+		send = cells[rows]
+		send[:,0] += shifts
+		send_weights = weights[rows] if (weights is not None) else None
+		counts = np.bincount(destinations,minlength=num_tasks)
+
+		if self.pool is not None:
+			send = self.pool.exchange(send,counts)
+			if send_weights is not None:
+				send_weights = self.pool.exchange(send_weights,counts)
+
+		#Grid the particles on the slab (periodic along the transverse directions)
+		binning = (np.arange(rank*slab_cells,(rank+1)*slab_cells+1,dtype=np.float64),np.arange(num_cells+1,dtype=np.float64),np.arange(num_cells+1,dtype=np.float64))
+		density = np.zeros((slab_cells,num_cells,num_cells),dtype=np.float32)
+		ext._nbody.grid3d(send,binning,send_weights,None,None,density,order,6 if num_tasks>1 else 7)
+
+		return density * num_cells**3 / self._header["num_particles_total"]
+
+	#Power spectrum with the density grid distributed in slabs between the tasks, and a slab decomposed FFT
+	def _distributedPowerSpectrum(self,k_edges,resolution,assignment,interlacing):
+
+		num_tasks,rank = (1,0) if (self.pool is None) else (self.pool.comm.size,self.pool.comm.rank)
+		box_size = self._header["box_size"]
+
+		#Number of cells along each side of the periodic grid
+		if type(resolution)==quantity.Quantity:
+			num_cells = int(np.ceil((box_size/resolution).decompose().value))
+		else:
+			num_cells = resolution
+
+		slab_cells = num_cells//num_tasks
+		bin_resolution = box_size / num_cells
+
+		#Lower left corner of the grid, common to all the tasks
+		if hasattr(self,"positions"):
+			positions = self.positions
+		else:
+			positions = self.getPositions(save=False)
+
+		left_corner = positions.min(axis=0).to(box_size.unit).value if len(positions) else np.inf*np.ones(3)
+		if self.pool is not None:
+			left_corner = np.array(self.pool.comm.allgather(left_corner)).min(axis=0)
+
+		#Grid the particles on the slabs and Fourier transform: rfft in the slab, then along the first axis after a transpose
+		def slabFFT(grid_shift):
+			
+			density_ft = fftengine.rfft2(self._slabDensity(positions,left_corner*box_size.unit,num_cells,assignment,grid_shift))
+			if self.pool is not None:
+				density_ft = self.pool.transposeSlabs(density_ft)
+
+			return np.fft.fft(density_ft,axis=0)
+
+		density_ft = slabFFT(0.0)
+		if interlacing:
+			density_shifted_ft = slabFFT(0.5)
+
+		#This task owns the modes with (global) second index in [rank*slab_cells,(rank+1)*slab_cells)
+		fy,fz = np.meshgrid(fftengine.fftfreq(num_cells)[rank*slab_cells:(rank+1)*slab_cells],fftengine.rfftfreq(num_cells),indexing="ij")
+		iy,iz = np.meshgrid(np.arange(rank*slab_cells,(rank+1)*slab_cells),np.arange(num_cells//2+1),indexing="ij")
+		iy = np.minimum(iy,num_cells-iy)
+
+		kpix = (2.0*np.pi/box_size).to(k_edges.unit).value
+		num_bins = len(k_edges) - 1
+		power_spectrum = np.zeros(num_bins)
+		hits = np.zeros(num_bins,dtype=np.int64)
+
+		#Bin the power one plane at a time
+		for x in range(num_cells):
+
+			fx = fftengine.fftfreq(num_cells)[x]
+			plane_ft = density_ft[x]
+
+			if interlacing:
+				plane_ft = _interlace(plane_ft,density_shifted_ft[x],fx,fy,fz)
+
+			if assignment!="NGP":
+				plane_ft = plane_ft / _assignmentWindow(_assignment_order[assignment],fx,fy,fz)
+
+			#Modes with edges[b] < k <= edges[b+1] fall in bin b
+			k = np.sqrt((min(x,num_cells-x)*kpix)**2 + (iy*kpix)**2 + (iz*kpix)**2)
+			b = np.searchsorted(k_edges.value,k.ravel(),side="left") - 1
+			valid = (b>=0) & (b<num_bins)
+
+			power_spectrum += np.bincount(b[valid],weights=np.abs(plane_ft.ravel()[valid])**2,minlength=num_bins)
+			hits += np.bincount(b[valid],minlength=num_bins)
+
+		#Reduce the binned power
+		if self.pool is not None:
+			power_spectrum = self.pool.comm.allreduce(power_spectrum)
+			hits = self.pool.comm.allreduce(hits)
+
+		return hits,power_spectrum,(bin_resolution,)*3
+
+	def powerSpectrum(self,k_edges,resolution=None,return_num_modes=False,density_placeholder=None,assignment="NGP",interlacing=False,distributed=False):
 
 		"""
 		Computes the power spectrum of the relative density fluctuations in the snapshot at the wavenumbers specified by k_edges; a discrete particle number density is computed before hand to prepare the FFT grid
@@ -1303,6 +2186,15 @@ class NbodySnapshot(object):
 		:param density placeholder: if not None, it is used as a fixed memory chunk for MPI communications in the density calculations
 		:type density_placeholder: array
 
+		:param assignment: mass assignment scheme, to be passed to the massDensity method; the CIC and TSC windows are deconvolved from the density before computing the power
+		:type assignment: str. ("NGP","CIC","TSC")
+
+		:param interlacing: if True, the density is computed a second time on a grid shifted by half a cell, and the two are combined to reduce aliasing
+		:type interlacing: bool.
+
+		:param distributed: if True, each task owns a slab of the (periodic) density grid and the particles are exchanged between the tasks, the FFT is slab decomposed and the binned power is reduced on all the tasks; this way no task needs to hold the full grid in memory. The number of grid cells must be divisible by the number of tasks
+		:type distributed: bool.
+
 		:returns: tuple(k_values(bin centers),power spectrum at the specified k_values)
 
 		"""
@@ -1317,11 +2209,28 @@ class NbodySnapshot(object):
 		if (k_edges[1:] - k_edges[:-1]).mean() < 2.0*np.pi/self._header["box_size"]:
 			raise ValueError("Your bins are too small! Minimum allowed by the current box size is {0}".format(2.0*np.pi/self._header["box_size"]))
 
+		#Distributed computation
+		if distributed:
+			
+			assert not hasattr(self,"density"),"The density is already computed! Delete the density attribute of this instance"
+			hits,power_spectrum,bin_resolution = self._distributedPowerSpectrum(k_edges,resolution,assignment,interlacing)
+			
+			k = 0.5*(k_edges[1:]+k_edges[:-1])
+			return_tuple = (k,(power_spectrum/hits) * (bin_resolution[0] * bin_resolution[1] * bin_resolution[2])**2 / (self._header["box_size"]**3))
+
+			if return_num_modes:
+				return_tuple += (hits,)
+
+			return return_tuple
+
 		#Compute the gridded number density
 		if not hasattr(self,"density"):
-			density,bin_resolution = self.massDensity(resolution=resolution,density_placeholder=density_placeholder) 
+			density,bin_resolution = self.massDensity(resolution=resolution,density_placeholder=density_placeholder,assignment=assignment)
+			if interlacing:
+				density_shifted,bin_resolution = self.massDensity(resolution=resolution,density_placeholder=density_placeholder,assignment=assignment,grid_shift=0.5)
 		else:
 			assert resolution is None,"The spatial resolution is already specified in the attributes of this instance! Call massDensity() to modify!"
+			assert not interlacing,"Interlacing needs to compute the density again! Delete the density attribute of this instance"
 			density,bin_resolution = self.density,self.resolution
 		
 		#Decide pixel sizes in Fourier spaces
@@ -1339,6 +2248,15 @@ class NbodySnapshot(object):
 
 		#Perform the FFT
 		density_ft = fftengine.rfftn(density)
+		fx,fy,fz = np.meshgrid(fftengine.fftfreq(density.shape[0]),fftengine.fftfreq(density.shape[1]),fftengine.rfftfreq(density.shape[2]),indexing="ij")
+
+		#Combine with the interlaced density
+		if interlacing:
+			density_ft = _interlace(density_ft,fftengine.rfftn(density_shifted),fx,fy,fz)
+
+		#Deconvolve the mass assignment window
+		if assignment!="NGP":
+			density_ft /= _assignmentWindow(_assignment_order[assignment],fx,fy,fz)
 
 		#Compute the azimuthal averages
 		hits,power_spectrum = ext._topology.rfft3_azimuthal(density_ft,density_ft,kpixX.value,kpixY.value,kpixZ.value,k_edges.value)
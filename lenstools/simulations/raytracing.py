@@ -1,17 +1,21 @@
 from ..image.convergence import Spin0,ConvergenceMap,OmegaMap
 from ..image.shear import Spin1,Spin2,ShearMap
 
-import sys
+import sys,os
 import time
 import gc
 
-from .logs import logplanes,logray,logstderr,peakMemory
+from .logs import logplanes,logray,logstderr,peakMemory,Profiler
 
 from operator import mul
 from functools import reduce
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 import numpy as np
 from scipy.spatial import cKDTree as KDTree
+from scipy.spatial import Delaunay
+from scipy.interpolate import LinearNDInterpolator
 
 try:
 	import matplotlib.pyplot as plt
@@ -23,9 +27,9 @@ except ImportError:
 from ..utils.fft import NUMPYFFTPack
 fftengine = NUMPYFFTPack()
 
-from astropy.units import km,s,Mpc,rad,deg,dimensionless_unscaled,quantity
+from astropy.units import km,s,Mpc,rad,deg,dimensionless_unscaled,quantity,Unit
 
-from .io import readFITSHeader,readFITS,saveFITS
+from .io import readFITSHeader,readFITS,saveFITS,readNPYHeader,readNPY,saveNPY,readNPZ,saveNPZ
 from .camb import TransferFunction
 
 #Enable garbage collection if not active already
@@ -39,6 +43,8 @@ if not gc.isenabled():
 
 class Plane(Spin0):
 
+	#Pending random roll (in pixels) of read only data, applied to the lookup positions instead of the data
+	_pixel_shift = None
 
 	def __init__(self,data,angle,redshift=2.0,cosmology=None,comoving_distance=None,unit=rad**2,num_particles=None,masked=False,filename=None):
 
@@ -75,7 +81,7 @@ class Plane(Spin0):
 		:param filename: name of the file
 		:type filename: str.
 
-		:param format: format of the file, only FITS implemented so far; if None, it's detected automatically from the filename
+		:param format: format of the file (FITS, npy or npz); if None, it's detected automatically from the filename
 		:type format: str.
 
 		:returns: header object
@@ -83,20 +89,30 @@ class Plane(Spin0):
 		"""
 
 		if format is None:
-			
-			extension = filename.split(".")[-1]
-			if extension in ["fit","fits"]:
-				format="fits"
-			else:
-				raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
-
+			format = Plane._detectFormat(filename)
 
 		if format=="fits":
 			return readFITSHeader(filename)
+		elif format in ["npy","npz"]:
+			return readNPYHeader(filename)
 		else:
 			raise ValueError("Format {0} not implemented yet!!".format(format))
 
 
+	#Detect the file format from the extension
+	@staticmethod
+	def _detectFormat(filename):
+
+		extension = filename.split(".")[-1]
+		if extension in ["fit","fits"]:
+			return "fits"
+		elif extension=="npy":
+			return "npy"
+		elif extension=="npz":
+			return "npz"
+		else:
+			raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
+
 	##########################################################################################################################################################
 	
 
@@ -123,66 +139,75 @@ class Plane(Spin0):
 		return angle_scale.to(deg),pixel_scale
 
 
-	def save(self,filename,format=None,double_precision=False):
+	def save(self,filename,format=None,double_precision=False,lmax=None,compress=False):
 
 		"""
-		Saves the Plane to an external file, of which the format can be specified (only fits implemented so far)
+		Saves the Plane to an external file, of which the format can be specified (FITS, npy or npz; the npy format stores the data uncompressed in its native precision, with the header in a JSON sidecar file, so that it can be memory mapped when loading; the npz format is a compact Fourier space format that stores only the rfft half plane in single precision, with the header in a JSON sidecar file)
 
 		:param filename: name of the file on which to save the plane
 		:type filename: str.
 
-		:param format: format of the file, only FITS implemented so far; if None, it's detected automatically from the filename
+		:param format: format of the file (FITS, npy or npz); if None, it's detected automatically from the filename
 		:type format: str.
 
-		:param double_precision: if True saves the Plane in double precision
+		:param double_precision: if True saves the Plane in double precision (FITS format only)
 		:type double_precision: bool.
 
+		:param lmax: if not None, discard the Fourier modes with multipole above lmax (npz format only)
+		:type lmax: float.
+
+		:param compress: if True, compress the data losslessly (npz format only)
+		:type compress: bool.
+
 		"""
 
 		if format is None:
-			
-			extension = filename.split(".")[-1]
-			if extension in ["fit","fits"]:
-				format="fits"
-			else:
-				raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
+			format = self._detectFormat(filename)
+
+		#Apply any pending roll before writing the data
+		self._materialize()
 
 		if format=="fits":
 			saveFITS(self,filename=filename,double_precision=double_precision)
+		elif format=="npy":
+			saveNPY(self,filename=filename)
+		elif format=="npz":
+			saveNPZ(self,filename=filename,lmax=lmax,compress=compress)
 		else:
 			raise ValueError("Format {0} not implemented yet!!".format(format))
 
 
 	@classmethod
-	def load(cls,filename,format=None,init_cosmology=True):
+	def load(cls,filename,format=None,init_cosmology=True,mmap=False):
 
 		"""
-		Loads the Plane from an external file, of which the format can be specified (only fits implemented so far)
+		Loads the Plane from an external file, of which the format can be specified (FITS, npy or npz; planes in npz format are loaded in Fourier space)
 
 		:param filename: name of the file from which to load the plane
 		:type filename: str.
 
-		:param format: format of the file, only FITS implemented so far; if None, it's detected automatically from the filename
+		:param format: format of the file (FITS, npy or npz); if None, it's detected automatically from the filename
 		:type format: str.
 
 		:param init_cosmology: if True, instantiates the cosmology attribute of the PotentialPlane
 		:type init_cosmology: bool.
 
+		:param mmap: if True, the data is memory mapped read only instead of being read in memory, so that processes on the same node share the page cache (npy format only, ignored otherwise)
+		:type mmap: bool.
+
 		:returns: PotentialPlane instance that wraps the data contained in the file
 
 		"""
 
 		if format is None:
-			
-			extension = filename.split(".")[-1]
-			if extension in ["fit","fits"]:
-				format="fits"
-			else:
-				raise IOError("File format not recognized from extension '{0}', please specify it manually".format(extension))
-
+			format = cls._detectFormat(filename)
 
 		if format=="fits":
 			return readFITS(cls,filename=filename,init_cosmology=init_cosmology)
+		elif format=="npy":
+			return readNPY(cls,filename=filename,init_cosmology=init_cosmology,mmap=mmap)
+		elif format=="npz":
+			return readNPZ(cls,filename=filename,init_cosmology=init_cosmology)
 		else:
 			raise ValueError("Format {0} not implemented yet!!".format(format))
 
@@ -190,7 +215,7 @@ class Plane(Spin0):
 	def randomRoll(self,seed=None,lmesh=None):
 
 		"""
-		Randomly shifts the plane along its axes, enforcing periodic boundary conditions
+		Randomly shifts the plane along its axes, enforcing periodic boundary conditions; if the plane data is read only (i.e. memory mapped or shared between processes), the shift is not applied to the data but to the positions at which the plane is evaluated and to the arrays computed from it
 
 		:param seed: random seed with which to initialize the generator
 		:type seed: int.
@@ -209,10 +234,23 @@ class Plane(Spin0):
 		if self.space=="real":
 
 			#Roll in real space
-			self.data = np.roll(np.roll(self.data,np.random.randint(0,self.data.shape[0]),axis=0),np.random.randint(0,self.data.shape[1]),axis=1)	
+			shift = np.random.randint(0,self.data.shape[0]),np.random.randint(0,self.data.shape[1])
+
+			if self.data.flags.writeable:
+				self.data = np.roll(np.roll(self.data,shift[0],axis=0),shift[1],axis=1)
+			else:
+				#Avoid a private copy of read only data: keep track of the shift and apply it to the lookups
+				self._addShift(shift)
 		
 		elif self.space=="fourier":
 
+			random_shift = np.random.randint(0,self.data.shape[0],size=2)
+
+			if not self.data.flags.writeable:
+				#Avoid a private copy of read only data: the phases below correspond to a roll by -random_shift in real space
+				self._addShift((-random_shift[1],-random_shift[0]))
+				return
+
 			#Rolling in Fourier space is just multiplying by phases
 			if lmesh is None:
 				l = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
@@ -224,7 +262,6 @@ class Plane(Spin0):
 			logplanes.debug("l meshgrid initialized in {0:.3f}s".format(now-last_timestamp))
 			last_timestamp = now 
 
-			random_shift = np.random.randint(0,self.data.shape[0],size=2)
 			self.data *= np.exp(2.0j*np.pi*np.tensordot(random_shift,l,axes=(0,0)))
 
 			#Timestamp
@@ -237,6 +274,73 @@ class Plane(Spin0):
 			raise ValueError("space must be either real or fourier!")
 
 
+	#Keep track of a pending roll (in real space pixels) of read only data
+	def _addShift(self,shift):
+
+		if self._pixel_shift is not None:
+			shift = self._pixel_shift[0]+shift[0],self._pixel_shift[1]+shift[1]
+
+		self._pixel_shift = shift[0]%self.data.shape[0],shift[1]%self.data.shape[0]
+
+	#Apply the pending roll to a real space array computed from the data
+	def _rolled(self,array):
+
+		if self._pixel_shift is None:
+			return array
+
+		return np.roll(np.roll(array,self._pixel_shift[0],axis=-2),self._pixel_shift[1],axis=-1)
+
+	#Apply a pending roll to the data, making a private copy of read only data
+	def _materialize(self):
+
+		if self._pixel_shift is not None:
+
+			if self.space=="real":
+				self.data = self._rolled(self.data)
+			else:
+				l = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
+				self.data = self.data * np.exp(-2.0j*np.pi*np.tensordot(self._pixel_shift[::-1],l,axes=(0,0)))
+
+			self._pixel_shift = None
+
+		elif not self.data.flags.writeable:
+			self.data = self.data.copy()
+
+	#Translate the lookup positions according to the pending roll; whole plane computations need the roll applied to the data
+	def _shiftPositions(self,x,y):
+
+		if self._pixel_shift is None:
+			return x,y
+
+		if (x is None) or (y is None):
+			self._materialize()
+			return x,y
+
+		#Looking up a plane rolled by s at pixel i is the same as looking up the original plane at pixel i-s: move the positions to the center of that pixel
+		return self._shiftCoordinate(x,1),self._shiftCoordinate(y,0)
+
+	def _shiftCoordinate(self,x,axis):
+
+		if type(x)==quantity.Quantity:
+			pixel = np.mod(((x / self.resolution).decompose().value).astype(np.int32) - self._pixel_shift[axis],self.data.shape[axis])
+			return (pixel + 0.5) * self.resolution
+		else:
+			pixel = np.mod((x / self.resolution.to(rad).value).astype(np.int32) - self._pixel_shift[axis],self.data.shape[axis])
+			return (pixel + 0.5) * self.resolution.to(rad).value
+
+	def gradient(self,x=None,y=None,save=True):
+		x,y = self._shiftPositions(x,y)
+		return super(Plane,self).gradient(x,y,save)
+
+	def hessian(self,x=None,y=None,save=True):
+		x,y = self._shiftPositions(x,y)
+		return super(Plane,self).hessian(x,y,save)
+
+	def gradLaplacian(self,x=None,y=None):
+		x,y = self._shiftPositions(x,y)
+		return super(Plane,self).gradLaplacian(x,y)
+
+
 	def toReal(self):
 
 		"""
@@ -310,6 +414,11 @@ class Plane(Spin0):
 
 			i = np.mod((y / self.resolution.to(rad).value).astype(np.int32),self.data.shape[0])
 
+		#Account for pending rolls
+		if self._pixel_shift is not None:
+			i = np.mod(i-self._pixel_shift[0],self.data.shape[0])
+			j = np.mod(j-self._pixel_shift[1],self.data.shape[1])
+
 		#Return the map values at the specified coordinates
 		return self.data[i,j]
 
@@ -353,7 +462,7 @@ class Plane(Spin0):
 			last_timestamp = now 
 
 			#Go back in real space
-			deflection = fftengine.irfft2(ft_deflection)
+			deflection = self._rolled(fftengine.irfft2(ft_deflection))
 
 			#Timestamp
 			now = time.time()
@@ -375,7 +484,7 @@ class Plane(Spin0):
 
 	#############################################################################################################################################################################
 
-	def scaleWithTransfer(self,z,tfr,with_scale_factor=False,kmesh=None,scaling_method="uniform"):
+	def scaleWithTransfer(self,z,tfr,with_scale_factor=False,kmesh=None,scaling_method="uniform",cache=None,cache_size=None):
 
 		"""
 		Scale the pixel values to a different redshift than the one of the plane by applying a suitable transfer function. This operation works in place
@@ -395,6 +504,12 @@ class Plane(Spin0):
 		:param scaling_method: must be ether "uniform" (all pixels scaled by the same factor, in which case the transfer function at low k is used) or "FFT" in which the full transfer function should be used
 		:type scaling_method: str.
 
+		:param cache: if not None, the scaling factors are looked up in (and added to) this dictionary, keyed by (plane redshift,new redshift,shape,scaling method,...,transfer function,kmesh); each entry keeps a reference to the kmesh it was computed on
+		:type cache: dict.
+
+		:param cache_size: if not None, maximum number of entries in the cache: the oldest entries are evicted first (the cache must preserve the insertion order, e.g. an OrderedDict)
+		:type cache_size: int.
+
 		"""
 
 		#Type check
@@ -407,48 +522,93 @@ class Plane(Spin0):
 		#Log
 		logplanes.debug("Scaling fluctuations on lens at redshift {0:.6f} to redshift {1:.6f} with method {2}".format(z0,z1,scaling_method))
 
+		#The scaling is performed in place
+		self._materialize()
+
+		#Look up the scaling factor (a number for uniform scaling, an array of Fourier pixels for FFT scaling); the entries hold the kmesh they are keyed by, so that its id cannot be reused by another mesh while they are cached
+		key = (z0,z1,self.data.shape,scaling_method,with_scale_factor,self.side_angle.value,self.side_angle.unit.to_string(),tfr,id(kmesh))
+		if (cache is not None) and (key in cache):
+			scaling = cache[key][1]
+		else:
+			scaling = self._transferScaling(z1,tfr,with_scale_factor,kmesh,scaling_method)
+			if cache is not None:
+				cache[key] = (kmesh,scaling)
+				while (cache_size is not None) and (len(cache)>cache_size):
+					del cache[next(iter(cache))]
+
 		if scaling_method=="uniform":
 			
 			#Scale all the pixels on the plane by the same factor
+			self.data *= scaling
+		
+		else:
+
+			#The scaling is performed in Fourier space: multiply the Fourier pixels by the transfer function ratio and transform back to real space
+			ft_plane = fftengine.rfft2(self.data)
+			ft_plane *= scaling
+			self.data[:] = fftengine.irfft2(ft_plane)
+
+		#Log
+		logplanes.debug("Scaled fluctuations on lens at redshift {0:.6f} to redshift {1:.6f} with method {2}".format(z0,z1,scaling_method))
+
+
+	#Multiplicative factor that scales the plane to redshift z1
+	def _transferScaling(self,z1,tfr,with_scale_factor,kmesh,scaling_method):
+
+		z0 = self.redshift
+
+		if scaling_method=="uniform":
+			
+			#All the pixels on the plane are scaled by the same factor
 			z0t,k,t0 = tfr[z0]
 			z1t,k,t1 = tfr[z1]
 
 			if z0t==z1t:
 				raise ValueError("The transfer function binning in z is too coarse! No scaling can be performed!")
 
-			self.data *= t1[0]/t0[0]
+			scaling = t1[0]/t0[0]
 		
 		elif scaling_method=="FFT":
 
-			#The scaling is performed in Fourier space
-			ft_plane = fftengine.rfft2(self.data)
-
 			if kmesh is None:
 				lx,ly = np.array(np.meshgrid(fftengine.rfftfreq(self.data.shape[0]),fftengine.fftfreq(self.data.shape[0])))
 				kmesh = np.sqrt(lx**2+ly**2)*2.*np.pi / self.side_angle
 
-			#Multiply by the Fourier pixels by the transfer function
-			ft_plane *= tfr(z1,kmesh)
-			ft_plane /= tfr(z0,kmesh)
-
-			#Invert the transfer function to get the scaled plane in real space
-			self.data[:] = fftengine.irfft2(ft_plane)
+			#Ratio of the transfer functions on the Fourier pixels
+			scaling = tfr(z1,kmesh)
+			scaling /= tfr(z0,kmesh)
 
 		else:
 			raise ValueError("Scaling method {0} not recognized".format(scaling_method))
 
 		if with_scale_factor:
-			self.data *= (1+z1)/(1+z0)
+			scaling *= (1+z1)/(1+z0)
 
-		#Log
-		logplanes.debug("Scaled fluctuations on lens at redshift {0:.6f} to redshift {1:.6f} with method {2}".format(z0,z1,scaling_method))
+		return scaling
+
+#The whole plane operations inherited from Spin0 need the pending roll of read only data applied first
+def _rollFirst(method):
+
+	if isinstance(method,property):
+		return property(_rollFirst(method.fget),doc=method.__doc__)
+
+	def rolled(self,*args,**kwargs):
+		if self._pixel_shift is not None:
+			self._materialize()
+		return method(self,*args,**kwargs)
+
+	rolled.__name__,rolled.__doc__ = method.__name__,method.__doc__
+	return rolled
+
+for _name in ["mean","std","cutRegion","visualize","mask","maskBoundaries","maskedFraction","boundary","pdf","plotPDF","peakCount","peakHistogram","gaussianPeakHistogram","locatePeaks","peakDistances","peakTwoPCF","minkowskiFunctionals","moments","powerSpectrum","cross","plotPowerSpectrum","twoPointFunction","bispectrum","smooth","__add__","__mul__"]:
+	setattr(Plane,_name,_rollFirst(Spin0.__dict__[_name]))
 
 ########################################################################################
 
 #Scale fluctuations with transfer function
 class TransferSpecs(object):
 
-	def __init__(self,tfr,cur2target,with_scale_factor,kmesh,scaling_method):
+	def __init__(self,tfr,cur2target,with_scale_factor,kmesh,scaling_method,cache_scaling=True,cache_size=None):
 
 		"""
 		Specifications for fluctuations scaling
@@ -468,6 +628,12 @@ class TransferSpecs(object):
 		:param scaling_method: must be ether "average" (all pixels scaled by the same factor, in which case the transfer function at low k is used) or "FFT" in which the full transfer function should be used
 		:type scaling_method: str.
 
+		:param cache_scaling: if True, the scaling factors are computed once for each lens and reused for all the realizations traced with these specifications (the FFT scaling holds one array of Fourier pixels per lens in memory)
+		:type cache_scaling: bool.
+
+		:param cache_size: maximum number of scaling factors kept in the cache, the oldest are evicted first; if None, one for each lens redshift in cur2target
+		:type cache_size: int.
+
 		"""
 
 		#Sanity check
@@ -479,6 +645,14 @@ class TransferSpecs(object):
 		self.kmesh = kmesh
 		self.scaling_method = scaling_method
 
+		#Scaling factors already computed for each lens, shared among all the realizations traced with these specifications
+		if cache_scaling:
+			self.cache = OrderedDict()
+			self.cache_size = len(cur2target) if (cache_size is None) else cache_size
+		else:
+			self.cache = None
+			self.cache_size = None
+
 ########################################################################################
 
 ###########################################################
@@ -531,7 +705,7 @@ class DensityPlane(Plane):
 		density_ft[0,0] = 0.0
 
 		#Instantiate the new PotentialPlane
-		return PotentialPlane(data=fftengine.irfft2(density_ft),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,num_particles=self.num_particles,unit=rad**2)
+		return PotentialPlane(data=self._rolled(fftengine.irfft2(density_ft)),angle=self.side_angle,redshift=self.redshift,comoving_distance=self.comoving_distance,cosmology=self.cosmology,num_particles=self.num_particles,unit=rad**2)
 
 	def densityGradient(self,x=None,y=None,lmesh=None):
 
@@ -656,7 +830,7 @@ class PotentialPlane(Plane):
 			tensor_xy = fftengine.irfft2(ft_tensor_xy)
 			tensor_yy = fftengine.irfft2(ft_tensor_yy)
 
-			tensor = np.array([tensor_xx,tensor_yy,tensor_xy])
+			tensor = self._rolled(np.array([tensor_xx,tensor_yy,tensor_xy]))
 
 		else:
 			raise ValueError("space must be either real or fourier!")
@@ -718,7 +892,7 @@ class PotentialPlane(Plane):
 
 			ly,lx = np.meshgrid(fftengine.fftfreq(self.data.shape[0]),fftengine.rfftfreq(self.data.shape[0]),indexing="ij")
 			ft_laplacian = -1.0 * (2.0*np.pi)**2 * (lx**2 + ly**2) * self.data
-			laplacian = fftengine.irfft2(ft_laplacian) 			
+			laplacian = self._rolled(fftengine.irfft2(ft_laplacian))
 
 		else:
 			raise ValueError("space must be either real or fourier!")
@@ -968,6 +1142,106 @@ class ShearTensorPlane(Spin2):
 			self.comoving_distance = cosmology.comoving_distance(redshift)
 
 
+#######################################################
+###############InverseMapping class####################
+#######################################################
+
+class InverseMapping(object):
+
+	"""
+	Maps source plane positions back onto apparent positions, interpolating the final positions of a regular grid of light rays traced backwards; the interpolation structure is built only once and can be queried with any number of source catalogs
+
+	:param initial_grid: positions of the grid rays as seen from the observer, shape (2,N)
+	:type initial_grid: quantity
+
+	:param final_grid: positions of the grid rays on the source plane, shape (2,N)
+	:type final_grid: quantity
+
+	:param interpolation: "nearest" (nearest grid ray), "inverse_distance" (inverse distance weighting of the nearest neighbors) or "linear" (barycentric interpolation on the Delaunay triangulation of the distorted grid, nearest grid ray outside of it)
+	:type interpolation: str.
+
+	:param neighbors: number of nearest neighbors used in the "inverse_distance" interpolation
+	:type neighbors: int.
+
+	:param workers: number of threads used to query the KD tree
+	:type workers: int.
+
+	"""
+
+	def __init__(self,initial_grid,final_grid,interpolation="nearest",neighbors=4,workers=1):
+
+		#Sanity check
+		assert interpolation in ["nearest","inverse_distance","linear"],"interpolation must be one of [nearest,inverse_distance,linear]!"
+		assert initial_grid.shape==final_grid.shape and initial_grid.shape[0]==2
+		assert neighbors>=1,"The number of neighbors must be positive!"
+
+		self.unit = initial_grid.unit
+		self.initial_grid = initial_grid.value
+		self.interpolation = interpolation
+		self.neighbors = neighbors
+		self.workers = workers
+
+		#Build the KD tree on the distorted grid (unbalanced trees are faster to build and about as fast to query)
+		final_grid = final_grid.to(self.unit).value.transpose()
+		self.tree = KDTree(final_grid,balanced_tree=False,compact_nodes=False)
+
+		#Triangulate the distorted grid if needed
+		if interpolation=="linear":
+			self.interpolator = LinearNDInterpolator(Delaunay(final_grid),self.initial_grid.transpose())
+
+	def _query(self,points,k):
+
+		#Parallel queries (the keyword has been renamed in recent scipy versions)
+		try:
+			return self.tree.query(points,k=k,workers=self.workers)
+		except TypeError:
+			return self.tree.query(points,k=k,n_jobs=self.workers)
+
+	def __call__(self,source_positions):
+
+		"""
+		Computes the apparent positions of the sources
+
+		:param source_positions: angular positions of the unlensed sources, shape (2,...)
+		:type source_positions: quantity
+
+		:returns: apparent positions of the sources, with the same shape as source_positions
+
+		"""
+
+		points = source_positions.reshape((2,)+(reduce(mul,source_positions.shape[1:]),)).to(self.unit).value.transpose()
+
+		if self.interpolation=="nearest":
+			
+			distances,index = self._query(points,k=1)
+			apparent_positions = self.initial_grid[:,index]
+
+		elif self.interpolation=="inverse_distance":
+
+			#The query drops the neighbor axis when a single neighbor is requested
+			distances,index = self._query(points,k=self.neighbors)
+			distances,index = distances.reshape((len(points),self.neighbors)),index.reshape((len(points),self.neighbors))
+
+			#Sources that coincide with a grid ray take its position
+			with np.errstate(divide="ignore"):
+				weights = 1.0 / distances
+			exact = np.isinf(weights).any(axis=1)
+			weights[exact] = (distances[exact]==0).astype(np.float64)
+
+			apparent_positions = (self.initial_grid[:,index] * weights[None]).sum(-1) / weights.sum(-1)[None]
+
+		else:
+
+			apparent_positions = self.interpolator(points).transpose()
+
+			#Sources outside the triangulation fall back to the nearest grid ray
+			outside = np.isnan(apparent_positions[0])
+			if outside.any():
+				distances,index = self._query(points[outside],k=1)
+				apparent_positions[:,outside] = self.initial_grid[:,index]
+
+		return apparent_positions.reshape(source_positions.shape) * self.unit
+
 #######################################################
 ###############RayTracer class#########################
 #######################################################
@@ -979,7 +1253,7 @@ class RayTracer(object):
 
 	"""
 
-	def __init__(self,lens_mesh_size=None,lens_type=PotentialPlane):
+	def __init__(self,lens_mesh_size=None,lens_type=PotentialPlane,profile=False,pool=None):
 
 		self.Nlenses = 0
 		self.lens = list()
@@ -987,6 +1261,16 @@ class RayTracer(object):
 		self.redshift = list()
 		self.lens_type = lens_type
 
+		#If an MPIWhirlPool is provided, the lens planes read from file are shared among the tasks on the same node: each distinct plane is read by one task in node shared memory, and all the tasks trace against the same read only copy. Loading the lenses becomes a collective call on the node, hence all the tasks on a node must load their lenses in step (the same number of times, not necessarily the same files)
+		self.pool = pool
+		self._shared_windows = list()
+
+		#Opt-in time and memory profile of each phase of each lens crossing (a Profiler instance can be shared among tracers)
+		if isinstance(profile,Profiler):
+			self.profiler = profile
+		else:
+			self.profiler = Profiler(enabled=profile)
+
 		#If we know the size of the lens planes already we can compute, once and for all, the FFT meshgrid
 		if lens_mesh_size is not None:
 			self.lmesh = np.array(np.meshgrid(fftengine.rfftfreq(lens_mesh_size),fftengine.fftfreq(lens_mesh_size)))
@@ -994,6 +1278,19 @@ class RayTracer(object):
 			self.lmesh = None
 
 
+	@property
+	def profile(self):
+
+		"""
+		Time and memory profile of the lens crossings, one row for each (lens,phase); empty unless the tracer was created with profile=True
+
+		:rtype: :py:class:`pandas.DataFrame`
+
+		"""
+
+		return self.profiler.table
+
+
 	def addLens(self,lens_specification):
 
 		"""
@@ -1032,8 +1329,8 @@ class RayTracer(object):
 		#If completed correctly, log info to the user
 		logray.debug("Added lens at redshift {0:.3f}(comoving distance {1:.3f})".format(self.redshift[-1],self.distance[-1]))
 
-	#Load the lens
-	def loadLens(self,lens):
+	#Load the lens (the lenses read from file are randomly rolled, unless roll is False)
+	def loadLens(self,lens,roll=True):
 
 		if type(lens)==self.lens_type:
 			return lens
@@ -1041,12 +1338,18 @@ class RayTracer(object):
 		elif type(lens)==str:
 				
 			logray.info("Reading plane from {0}...".format(lens))
-			current_lens = self.lens_type.load(lens)
+			with self.profiler.phase("load",bytes_read=os.path.getsize(lens)):
+				current_lens = self._loadFiles([lens])[0]
+			
 			logray.info("Read plane from {0}...".format(lens))
 			logstderr.debug("Read plane: peak memory usage {0:.3f} (task)".format(peakMemory()))
+
+			if not roll:
+				return current_lens
 			
 			logray.info("Randomly rolling lens at z={0:.3f} along its axes...".format(current_lens.redshift))
-			current_lens.randomRoll()
+			with self.profiler.phase("roll"):
+				current_lens.randomRoll()
 			logray.info("Rolled lens at z={0:.3f} along its axes...".format(current_lens.redshift))
 			logstderr.debug("Rolled lens: peak memory usage {0:.3f} (task)".format(peakMemory()))
 
@@ -1056,6 +1359,79 @@ class RayTracer(object):
 			raise TypeError("Lens format not recognized!")
 
 
+	#Read the lens from file; the compact npz planes are stored in Fourier space to save disk space only, hence they go back to real space (the rays hit the lens at arbitrary positions), while the planes stored in Fourier space in the other formats stay there and get their deflections with FFTs
+	def _loadFile(self,filename):
+
+		current_lens = self.lens_type.load(filename,mmap=True)
+		if (current_lens.space=="fourier") and (self.lens_type._detectFormat(filename)=="npz"):
+			current_lens.toReal()
+
+		return current_lens
+
+	#Read a list of lenses from file, either in the memory of this task or in node shared memory
+	def _loadFiles(self,filenames):
+
+		if self.pool is None:
+			return [ self._loadFile(filename) for filename in filenames ]
+		
+		return self._loadShared(filenames)
+
+	#Read the lenses requested by all the tasks on the node in node shared memory (collective call on the node communicator): each distinct file is read by one task only
+	def _loadShared(self,filenames):
+
+		node_comm = self.pool.node_comm
+		node_size,node_rank = node_comm.Get_size(),node_comm.Get_rank()
+
+		#The lenses loaded by the previous call may still be in use: free only the memory of the older ones
+		while len(self._shared_windows)>1:
+			self.pool.closeSharedWindow(self._shared_windows.pop(0))
+
+		#Distinct files requested on the node: the n-th one is read by task n%node_size
+		distinct = list()
+		for task_filenames in node_comm.allgather(list(filenames)):
+			distinct += [ filename for filename in task_filenames if filename not in distinct ]
+
+		planes = dict()
+		nbytes = 0
+
+		for n,filename in enumerate(distinct):
+			if n%node_size==node_rank:
+				planes[filename] = (self._loadFile(filename),nbytes)
+				nbytes += planes[filename][0].data.nbytes
+
+		#Copy the planes in the shared memory, and let all the tasks on the node know where to find them
+		win = self.pool.openSharedWindow(nbytes)
+		self._shared_windows.append(win)
+
+		for filename,(plane,offset) in planes.items():
+			self.pool.sharedArray(win,node_rank,plane.data.shape,plane.data.dtype,offset)[:] = plane.data
+			planes[filename] = (plane,plane.data.shape,plane.data.dtype.str,offset)
+			plane.data = None
+
+		node_comm.Barrier()
+		specs = node_comm.allgather(planes)
+
+		#Nobody is allowed to write on the shared planes: the random rolls are applied to the lookups
+		shared_lenses = list()
+		for filename in filenames:
+			owner = distinct.index(filename)%node_size
+			plane,shape,dtype,offset = specs[owner][filename]
+			plane.data = self.pool.sharedArray(win,owner,shape,dtype,offset)
+			plane.data.flags.writeable = False
+			shared_lenses.append(plane)
+
+		return shared_lenses
+
+	def closeSharedPlanes(self):
+
+		"""
+		Free the node shared memory that holds the lens planes read so far (collective call on the node communicator): the lenses loaded before cannot be used afterwards
+
+		"""
+
+		while len(self._shared_windows):
+			self.pool.closeSharedWindow(self._shared_windows.pop(0))
+
 	def randomRoll(self,seed=None):
 
 		"""
@@ -1090,7 +1466,104 @@ class RayTracer(object):
 	#############################(backward ray tracing)###############################################################################
 	##################################################################################################################################
 
-	def shoot(self,initial_positions,z=2.0,initial_deflection=None,kind="positions",save_intermediate=False,compute_all_deflections=False,callback=None,transfer=None,**kwargs):
+	#Evaluate a lookup function (deflections, shear matrices...) on a bucket of rays, splitting the rays in disjoint chunks among the threads in a pool
+	@staticmethod
+	def _lookupChunks(lookup,positions,pool=None,workers=1):
+
+		if pool is None:
+			return lookup(positions[0],positions[1])
+
+		#Split the flattened rays in one chunk per thread
+		shape = positions.shape[1:]
+		flat_positions = positions.reshape((2,reduce(mul,shape)))
+		bounds = np.linspace(0,flat_positions.shape[1],workers+1).astype(int)
+		chunks = [ flat_positions[:,bounds[n]:bounds[n+1]] for n in range(len(bounds)-1) if bounds[n+1]>bounds[n] ]
+
+		#The lens plane is shared read only among the threads; map returns when all the chunks are done
+		values = pool.map(lambda c:lookup(c[0],c[1]),chunks)
+
+		#Stitch the chunks back together
+		if isinstance(values[0],quantity.Quantity):
+			unit = values[0].unit
+			values = np.concatenate([ v.to(unit).value for v in values ],axis=-1) * unit
+		else:
+			values = np.concatenate(values,axis=-1)
+
+		return values.reshape(values.shape[:-1]+shape)
+
+	#Save the ray state after crossing lens k, together with the state of the random generators (that roll the lenses still to be crossed)
+	@staticmethod
+	def _saveCheckpoint(filename,k,state,generators=()):
+
+		arrays = dict(lens=k)
+		for name,value in state.items():
+			if value is None:
+				continue
+			if isinstance(value,quantity.Quantity):
+				arrays[name] = value.value
+				arrays[name+"_unit"] = value.unit.to_string()
+			else:
+				arrays[name] = value
+
+		for n,generator in enumerate((np.random,)+tuple(generators)):
+			if generator is None:
+				continue
+			algorithm,keys,pos,has_gauss,cached_gaussian = generator.get_state()
+			arrays["random{0}_keys".format(n)] = keys
+			arrays["random{0}_state".format(n)] = np.array([pos,has_gauss,cached_gaussian])
+
+		#Write to a temporary file first, so that a job killed while writing never corrupts the previous checkpoint
+		logray.debug("Checkpointing ray state after lens {0} to {1}".format(k,filename))
+		tmp_filename = filename + ".tmp"
+		with open(tmp_filename,"wb") as fp:
+			np.savez(fp,**arrays)
+		os.rename(tmp_filename,filename)
+
+	#Read the ray state back from a checkpoint and restore the random generators: returns the index of the last lens crossed and the state
+	@staticmethod
+	def _loadCheckpoint(filename,generators=()):
+
+		with np.load(filename) as data:
+			arrays = dict((name,data[name]) for name in data.files)
+
+		for n,generator in enumerate((np.random,)+tuple(generators)):
+			if generator is None:
+				continue
+			pos,has_gauss,cached_gaussian = arrays.pop("random{0}_state".format(n))
+			generator.set_state(("MT19937",arrays.pop("random{0}_keys".format(n)),int(pos),int(has_gauss),float(cached_gaussian)))
+
+		k = int(arrays.pop("lens"))
+		state = dict()
+		for name in arrays:
+			if name.endswith("_unit"):
+				continue
+			if name+"_unit" in arrays:
+				state[name] = arrays[name] * Unit(str(arrays[name+"_unit"]))
+			else:
+				state[name] = arrays[name]
+
+		logray.info("Resuming from checkpoint {0}: lenses up to {1} already crossed".format(filename,k))
+		return k,state
+
+	#Specifications recorded in the checkpoints: source redshifts, redshifts of the lenses in the system and files the crossed lenses are read from (empty for the lenses in memory)
+	def _checkpointSpecs(self,z,lenses):
+		return dict(source_redshift=np.array(z,dtype=np.float64),lens_redshift=np.array(self.redshift,dtype=np.float64),lens_files=np.array([ (lens if isinstance(lens,str) else "") for lens in lenses ]))
+
+	#A checkpoint can be resumed only with the same specifications it was written with
+	@staticmethod
+	def _checkCheckpoint(filename,state,specs):
+
+		for name,value in specs.items():
+			
+			assert (name in state) and (state[name].shape==value.shape),"Checkpoint {0} does not match the current specifications ({1})!".format(filename,name)
+			
+			if value.dtype.kind=="f":
+				assert np.allclose(state[name],value),"Checkpoint {0} does not match the current specifications ({1})!".format(filename,name)
+			else:
+				assert (state[name]==value).all(),"Checkpoint {0} does not match the current specifications ({1})!".format(filename,name)
+
+
+	def shoot(self,initial_positions,z=2.0,initial_deflection=None,kind="positions",save_intermediate=False,compute_all_deflections=False,callback=None,transfer=None,workers=1,checkpoint=None,checkpoint_every=1,**kwargs):
 
 		"""
 		Shots a bucket of light rays from the observer to the sources at redshift z (backward ray tracing), through the system of gravitational lenses, and computes the deflection statistics
@@ -1098,8 +1571,8 @@ class RayTracer(object):
 		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
 		:type initial_positions: numpy array or quantity
 
-		:param z: redshift of the sources; if an array is passed, a redshift must be specified for each ray, i.e. z.shape==initial_positions.shape[1:]
-		:type z: float. or array
+		:param z: redshift of the sources; if an array is passed, a redshift must be specified for each ray, i.e. z.shape==initial_positions.shape[1:]; if a list is passed, the rays are traced to each of the source redshifts in the list in a single pass through the lenses
+		:type z: float., array or list
 
 		:param initial_deflection: if not None, this is the initial deflection light rays undergo with respect to the line of sight (equivalent to specifying the first derivative IC on the lensing ODE); must have the same shape as initial_positions
 		:type initial_deflection: numpy array or quantity
@@ -1119,10 +1592,19 @@ class RayTracer(object):
 		:param transfer: if not None, scales the fluctuations on each lens plane to a different redshift (before computing the ray defections) using a provided transfer function 
 		:type transfer: :py:class:`TransferSpecs`
 
+		:param workers: number of threads among which the light rays are split in disjoint chunks when retrieving deflections and shear matrices; the threads share the same lens plane in memory
+		:type workers: int.
+
+		:param checkpoint: if not None, name of the file in which the ray state is saved every checkpoint_every lenses; if the file exists already, the ray tracing resumes from the last lens it records. The file is removed when the ray tracing completes
+		:type checkpoint: str.
+
+		:param checkpoint_every: number of lenses crossed between checkpoints
+		:type checkpoint_every: int.
+
 		:param kwargs: the keyword arguments are passed to the callback if not None
 		:type kwargs: dict.
 
-		:returns: angular positions (or jacobians) of the light rays after the last lens crossing
+		:returns: angular positions (or jacobians) of the light rays after the last lens crossing; if z is a list, a list with the results at each of the source redshifts
 
 		"""
 
@@ -1132,6 +1614,7 @@ class RayTracer(object):
 		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
 		assert kind in ["positions","jacobians","shear","convergence"],"kind must be one in [positions,jacobians,shear,convergence]!"
 		assert transfer is None or isinstance(transfer,TransferSpecs)
+		assert workers>=1,"The number of workers must be positive!"
 
 		#Allocate arrays for the intermediate light ray positions and deflections
 
@@ -1155,7 +1638,25 @@ class RayTracer(object):
 			dotter[(0,0,1,1,2,2,3,3),(0,2,0,2,2,1,2,1),(0,2,1,3,0,2,1,3)] = 1
 
 		#Decide which is the last lens the light rays should cross
-		if type(z)==np.ndarray:
+		if type(z) in [list,tuple]:
+
+			#Check that redshift is not too high given the current lenses
+			assert max(z)<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
+			assert not save_intermediate,"save_intermediate is not supported with multiple source redshifts!"
+
+			#Compute the last lens for each of the source redshifts: the outputs are filled as the rays reach them
+			last_lens_source = [ (zs>np.array(self.redshift)).argmin() - 1 for zs in z ]
+			last_lens = max(last_lens_source)
+			source_outputs = [None] * len(z)
+
+			#The sources in front of the first lens are reached by the undeflected rays
+			for n in [ n for n,l in enumerate(last_lens_source) if l<0 ]:
+				if kind=="positions":
+					source_outputs[n] = current_positions.copy()
+				else:
+					source_outputs[n] = self._fromJacobian(current_jacobian.copy(),kind)
+
+		elif type(z)==np.ndarray:
 			
 			#Check that shapes correspond
 			assert z.shape==initial_positions.shape[1:]
@@ -1184,125 +1685,219 @@ class RayTracer(object):
 		redshift = np.array([0.0] + self.redshift)
 		lens = self.lens
 
-		#This is the main loop that goes through all the lenses
-		for k in range(last_lens+1):
+		#Resume the ray tracing from the last checkpoint, if any
+		first_lens = 0
+		if checkpoint is not None:
+			checkpoint_specs = self._checkpointSpecs(z,lens)
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
-			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+		if (checkpoint is not None) and os.path.exists(checkpoint):
+			
+			k,state = self._loadCheckpoint(checkpoint)
+			assert (str(state["kind"])==kind) and (state["positions"].shape==initial_positions.shape),"Checkpoint {0} does not match the current ray tracing specifications!".format(checkpoint)
+			self._checkCheckpoint(checkpoint,state,checkpoint_specs)
+			first_lens = k+1
 
-			#If transfer function is provided, scale to target redshift
-			if transfer is not None:
-				current_lens.scaleWithTransfer(transfer.cur2target[current_lens.redshift],tfr=transfer.tfr,with_scale_factor=transfer.with_scale_factor,kmesh=transfer.kmesh,scaling_method=transfer.scaling_method)
+			current_positions = state["positions"]
+			current_deflection = state["deflection"]
+			
+			if kind in ["jacobians","shear","convergence"]:
+				current_jacobian = state["jacobian"]
+				current_jacobian_deflection = state["jacobian_deflection"]
 
-			#Log
-			logray.debug("Crossing lens {0} at redshift z={1:.3f}".format(k,current_lens.redshift))
-			start = time.time()
-			last_timestamp = start
+			if kind=="positions" and save_intermediate:
+				all_positions = state["all_positions"]
 
-			#Compute the deflection angles and log timestamp
-			if compute_all_deflections:
-				deflections = current_lens.deflectionAngles(lmesh=self.lmesh).getValues(current_positions[0],current_positions[1])
-			else:
-				deflections = current_lens.deflectionAngles(current_positions[0],current_positions[1])
+			if type(z) in [list,tuple]:
+				source_outputs = [ state.get("source_output{0}".format(n)) for n in range(len(z)) ]
 
-			now = time.time()
-			logray.debug("Retrieval of deflection angles from potential planes completed in {0:.3f}s".format(now-last_timestamp))
-			logstderr.debug("Retrieval of deflection angles: peak memory usage {0:.3f} (task)".format(peakMemory()))
-			last_timestamp = now
+		#Thread pool that splits the ray lookups on each lens (the threads are released even if the ray tracing is interrupted)
+		if workers>1:
+			pool = ThreadPool(workers)
+			logray.debug("Splitting ray lookups among {0} threads".format(workers))
+		else:
+			pool = None
 
-			#If we are tracing jacobians we need to retrieve the shear matrices too
-			if kind in ["jacobians","convergence","shear"]:
+		try:
+			#This is the main loop that goes through all the lenses
+			for k in range(first_lens,last_lens+1):
 
+				#Load in the lens
+				self.profiler.lens = k
+				current_lens = self.loadLens(lens[k])
+				np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+
+				#If transfer function is provided, scale to target redshift
+				if transfer is not None:
+					with self.profiler.phase("transfer"):
+						current_lens.scaleWithTransfer(transfer.cur2target[current_lens.redshift],tfr=transfer.tfr,with_scale_factor=transfer.with_scale_factor,kmesh=transfer.kmesh,scaling_method=transfer.scaling_method,cache=getattr(transfer,"cache",None),cache_size=getattr(transfer,"cache_size",None))
+
+				#Log
+				logray.debug("Crossing lens {0} at redshift z={1:.3f}".format(k,current_lens.redshift))
+				start = time.time()
+				last_timestamp = start
+
+				#Compute the deflection angles and log timestamp
 				if compute_all_deflections:
-					shear_tensors = current_lens.shearMatrix(lmesh=self.lmesh).getValues(current_positions[0],current_positions[1])
+					deflections = self._lookupChunks(current_lens.deflectionAngles(lmesh=self.lmesh).getValues,current_positions,pool,workers)
 				else:
-					shear_tensors = current_lens.shearMatrix(current_positions[0],current_positions[1])
+					deflections = self._lookupChunks(current_lens.deflectionAngles,current_positions,pool,workers)
 
 				now = time.time()
-				logray.debug("Shear matrices retrieved in {0:.3f}s".format(now-last_timestamp))
-				logstderr.debug("Shear matrices retrieved: peak memory usage {0:.3f} (task)".format(peakMemory()))
+				logray.debug("Retrieval of deflection angles from potential planes completed in {0:.3f}s".format(now-last_timestamp))
+				logstderr.debug("Retrieval of deflection angles: peak memory usage {0:.3f} (task)".format(peakMemory()))
+				self.profiler.record("deflection",now-last_timestamp)
 				last_timestamp = now
-			
-			#####################################################################################
 
-			#Compute geometrical weight factors
-			Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
-			Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
+				#If we are tracing jacobians we need to retrieve the shear matrices too
+				if kind in ["jacobians","convergence","shear"]:
 
-			#Compute the position on the next lens and log timestamp
-			current_deflection *= (Ak-1) 
-			now = time.time()
-			logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+					if compute_all_deflections:
+						shear_tensors = self._lookupChunks(current_lens.shearMatrix(lmesh=self.lmesh).getValues,current_positions,pool,workers)
+					else:
+						shear_tensors = self._lookupChunks(current_lens.shearMatrix,current_positions,pool,workers)
 
-			#Add deflections and log timestamp
-			current_deflection += Ck * deflections 
-			now = time.time()
-			logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+					now = time.time()
+					logray.debug("Shear matrices retrieved in {0:.3f}s".format(now-last_timestamp))
+					logstderr.debug("Shear matrices retrieved: peak memory usage {0:.3f} (task)".format(peakMemory()))
+					self.profiler.record("shear",now-last_timestamp)
+					last_timestamp = now
+			
+				#####################################################################################
 
-			#If we are tracing jacobians we need to compute the matrix product with the shear matrix
-			if kind in ["jacobians","convergence","shear"]:
+				accumulation_start = last_timestamp
 
-				current_jacobian_deflection *= (Ak-1)
+				#Compute geometrical weight factors
+				Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
+				Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
 
-				#This is the part in which the products with the shear matrix are computed
-				current_jacobian_deflection += Ck * (np.tensordot(dotter,current_jacobian,axes=([2],[0])) * shear_tensors).sum(1)
-				
+				#Compute the position on the next lens and log timestamp
+				current_deflection *= (Ak-1) 
+				now = time.time()
+				logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
+				last_timestamp = now
+
+				#Add deflections and log timestamp
+				current_deflection += Ck * deflections 
 				now = time.time()
-				logray.debug("Shear matrix products computed in {0:.3f}s".format(now-last_timestamp))
-				logstderr.debug("Shear matrix products completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
+				logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
 				last_timestamp = now
 
-			###########################################################################################
+				#If we are tracing jacobians we need to compute the matrix product with the shear matrix
+				if kind in ["jacobians","convergence","shear"]:
+
+					current_jacobian_deflection *= (Ak-1)
 
-			if type(z)==np.ndarray:
+					#This is the part in which the products with the shear matrix are computed
+					current_jacobian_deflection += Ck * (np.tensordot(dotter,current_jacobian,axes=([2],[0])) * shear_tensors).sum(1)
 				
-				current_positions[:,k<last_lens_ray] += current_deflection[:,k<last_lens_ray]
-				current_positions[:,k==last_lens_ray] += current_deflection[:,k==last_lens_ray] * (z[None,k==last_lens_ray] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+					now = time.time()
+					logray.debug("Shear matrix products computed in {0:.3f}s".format(now-last_timestamp))
+					logstderr.debug("Shear matrix products completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
+					last_timestamp = now
 
-				#We need to add the distortions to the jacobians too
-				if kind in ["jacobians","convergence","shear"]:
-					current_jacobian[:,k<last_lens_ray] += current_jacobian_deflection[:,k<last_lens_ray]
-					current_jacobian[:,k==last_lens_ray] += current_jacobian_deflection[:,k==last_lens_ray] * (z[None,k==last_lens_ray] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+				###########################################################################################
 
-			else:
+				if type(z) in [list,tuple]:
+
+					#Interpolate to the sources that lie behind this lens, once per source redshift
+					for n in [ n for n,l in enumerate(last_lens_source) if l==k ]:
+					
+						fraction = (z[n] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						if kind=="positions":
+							source_outputs[n] = current_positions + current_deflection*fraction
+						else:
+							source_outputs[n] = self._fromJacobian(current_jacobian + current_jacobian_deflection*fraction,kind)
+
+					#Advance the remaining rays to the next lens
+					if k<last_lens:
+						current_positions += current_deflection
+						if kind in ["jacobians","convergence","shear"]:
+							current_jacobian += current_jacobian_deflection
+
+				elif type(z)==np.ndarray:
+
+					#Compute the ray masks and the interpolation factors only once per lens
+					crossing = k<last_lens_ray
+					ending = k==last_lens_ray
+					fraction = (z[None,ending] - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 				
-				if k<last_lens:
-					current_positions += current_deflection
-				else:
-					current_positions += current_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+					current_positions[:,crossing] += current_deflection[:,crossing]
+					current_positions[:,ending] += current_deflection[:,ending] * fraction
 
-				#We need to add the distortions to the jacobians too
-				if kind in ["jacobians","convergence","shear"]:
+					#We need to add the distortions to the jacobians too
+					if kind in ["jacobians","convergence","shear"]:
+						current_jacobian[:,crossing] += current_jacobian_deflection[:,crossing]
+						current_jacobian[:,ending] += current_jacobian_deflection[:,ending] * fraction
 
+				else:
+				
 					if k<last_lens:
-						current_jacobian += current_jacobian_deflection
+						current_positions += current_deflection
 					else:
-						current_jacobian += current_jacobian_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						current_positions += current_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 
-			now = time.time()
-			logray.debug("Addition of deflections completed in {0:.3f}s".format(now-last_timestamp))
-			logstderr.debug("Addition of deflections completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
-			last_timestamp = now
+					#We need to add the distortions to the jacobians too
+					if kind in ["jacobians","convergence","shear"]:
 
-			#Save the intermediate positions if option was specified
-			if kind=="positions" and save_intermediate:
-				all_positions[k] = current_positions.copy()
+						if k<last_lens:
+							current_jacobian += current_jacobian_deflection
+						else:
+							current_jacobian += current_jacobian_deflection * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 
-			#Optionally, call the callback function on the current positions
-			if callback is not None:
-				if kind=="positions":
-					callback(current_positions,self,k,**kwargs)
-				elif kind=="jacobians":
-					callback(current_jacobian,self,k,**kwargs)
+				now = time.time()
+				logray.debug("Addition of deflections completed in {0:.3f}s".format(now-last_timestamp))
+				logstderr.debug("Addition of deflections completed: peak memory usage {0:.3f} (task)".format(peakMemory()))
+				self.profiler.record("accumulation",now-accumulation_start)
+				last_timestamp = now
 
-			#Log timestamp to cross lens
-			now = time.time()
-			logray.debug("Lens {0} at z={1:.3f} crossed in {2:.3f}s".format(k,current_lens.redshift,now-start))
-			logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
+				#Save the intermediate positions if option was specified
+				if kind=="positions" and save_intermediate:
+					all_positions[k] = current_positions.copy()
+
+				#Optionally, call the callback function on the current positions
+				if callback is not None:
+					if kind=="positions":
+						callback(current_positions,self,k,**kwargs)
+					elif kind=="jacobians":
+						callback(current_jacobian,self,k,**kwargs)
+
+				#Log timestamp to cross lens
+				now = time.time()
+				logray.debug("Lens {0} at z={1:.3f} crossed in {2:.3f}s".format(k,current_lens.redshift,now-start))
+				logstderr.debug("Lens {0} crossed: peak memory usage {1:.3f} (task)".format(k,peakMemory()))
+
+				#Checkpoint the ray state
+				if (checkpoint is not None) and (k<last_lens) and ((k+1)%checkpoint_every==0):
+
+					state = dict(kind=kind,positions=current_positions,deflection=current_deflection,**checkpoint_specs)
+				
+					if kind in ["jacobians","shear","convergence"]:
+						state["jacobian"] = current_jacobian
+						state["jacobian_deflection"] = current_jacobian_deflection
+
+					if kind=="positions" and save_intermediate:
+						state["all_positions"] = all_positions
+
+					if type(z) in [list,tuple]:
+						for n,output in enumerate(source_outputs):
+							state["source_output{0}".format(n)] = output
+
+					with self.profiler.phase("checkpoint"):
+						self._saveCheckpoint(checkpoint,k,state)
 
+		finally:
+			#Release the threads
+			if pool is not None:
+				pool.close()
+				pool.join()
+
+		#The ray tracing is complete, the checkpoint is not needed anymore
+		if (checkpoint is not None) and os.path.exists(checkpoint):
+			os.remove(checkpoint)
+
+		#Return the outputs at each of the source redshifts
+		if type(z) in [list,tuple]:
+			return source_outputs
 
 		#Return the final positions of the light rays (or jacobians)
 		if kind=="positions":
@@ -1313,29 +1908,116 @@ class RayTracer(object):
 				return current_positions
 
 		else:
+			return self._fromJacobian(current_jacobian,kind)
+
 
-			#Different return types according to option (can compute convergence and shear directly)
+	#Different return types according to option (can compute convergence and shear directly)
+	@staticmethod
+	def _fromJacobian(jacobian,kind):
 
-			if kind=="convergence":
-				return 1.0 - 0.5*(current_jacobian[0]+current_jacobian[3]) 
+		if kind=="convergence":
+			return 1.0 - 0.5*(jacobian[0]+jacobian[3]) 
 			
-			elif kind=="shear":
-				return np.array([0.5*(current_jacobian[3] - current_jacobian[0]),-0.5*(current_jacobian[1]+current_jacobian[2])])
+		elif kind=="shear":
+			return np.array([0.5*(jacobian[3] - jacobian[0]),-0.5*(jacobian[1]+jacobian[2])])
 
-			else:
-				return current_jacobian
+		else:
+			return jacobian
 
 	##################################################################################
 	###########Direct calculation of the convergence with Born approximation##########
 	##################################################################################
 
-	def convergenceBorn(self,initial_positions,z=2.0,save_intermediate=False,real_trajectory=False):
+	#Sort out a single bucket of light rays or a batch of buckets that share the lens loads (each with its own lenses and random rolls)
+	def _batchSpecs(self,initial_positions,rolls,lenses):
+
+		batch_mode = isinstance(initial_positions,(list,tuple))
+		if not batch_mode:
+			initial_positions = [initial_positions]
+
+		for positions in initial_positions:
+			assert positions.ndim>=2 and positions.shape[0]==2,"initial positions shape must be (2,...)!"
+			assert type(positions)==quantity.Quantity and positions.unit.physical_type=="angle"
+
+		if rolls is None:
+			rolls = [None] * len(initial_positions)
+		else:
+			assert batch_mode,"rolls can be specified only for a batch of light ray buckets!"
+			assert len(rolls)==len(initial_positions),"You must specify a roll for each bucket of light rays!"
+
+		if lenses is None:
+			lenses = [self.lens] * len(initial_positions)
+		else:
+			assert batch_mode,"lenses can be specified only for a batch of light ray buckets!"
+			assert len(lenses)==len(initial_positions),"You must specify the lenses for each bucket of light rays!"
+			for batch_lenses in lenses:
+				assert len(batch_lenses)==len(self.lens),"Each bucket of light rays must cross a lens at each of the redshifts of the system!"
+
+		#Each bucket of rays with a roll gets its own random generator, so that the shifts do not depend on the batch composition
+		generators = [ (seed if isinstance(seed,np.random.RandomState) else np.random.RandomState(seed)) if (seed is not None) else None for seed in rolls ]
+
+		return batch_mode,initial_positions,generators,lenses
+
+	#Load the k-th lens of each map in the batch, once for each distinct lens; each map rolls its lens independently without touching the plane data: a lens read from file is rolled with the generator of the map (or the global one) exactly as loadLens would, a lens already in memory is rolled on top of its own roll. Returns the loaded lenses with their original rolls, and the lens and roll of each map
+	def _loadBatch(self,k,lenses,generators,transpose=False):
+
+		loaded = dict()
+		batch = list()
+
+		#Read the distinct lens files of the batch at once (a collective call if the planes are shared among the tasks on a node)
+		filenames = list()
+		for lens in lenses:
+			if isinstance(lens,str) and (lens not in filenames):
+				filenames.append(lens)
+
+		logray.info("Reading {0} planes at redshift {1:.3f}...".format(len(filenames),self.redshift[k]))
+		with self.profiler.phase("load",bytes_read=sum([ os.path.getsize(filename) for filename in filenames ])):
+			read = dict(zip(filenames,self._loadFiles(filenames)))
+
+		for lens,generator in zip(lenses,generators):
+
+			key = lens if isinstance(lens,str) else id(lens)
+			if key not in loaded:
+
+				current_lens = read[lens] if isinstance(lens,str) else self.loadLens(lens,roll=False)
+				np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+
+				#Maybe transpose (a pending roll is transposed too)
+				if transpose:
+					logray.debug("Transposing pixel values for lens {0}".format(k))
+					current_lens.data = current_lens.data.T
+					if current_lens._pixel_shift is not None:
+						current_lens._pixel_shift = current_lens._pixel_shift[::-1]
+
+				loaded[key] = current_lens,current_lens._pixel_shift
+
+			current_lens,base_shift = loaded[key]
+			current_lens._pixel_shift = base_shift
+
+			#Roll the lens for this map (before the transposition, as the lenses rolled when loaded from file)
+			if isinstance(lens,str) and (generator is None):
+				generator = np.random
+
+			if (generator is not None) and (current_lens.space=="fourier"):
+				random_shift = generator.randint(0,current_lens.data.shape[0],size=2)
+				current_lens._addShift((-random_shift[1],-random_shift[0]))
+
+			elif generator is not None:
+				shape = current_lens.data.shape[::-1] if transpose else current_lens.data.shape
+				shift = generator.randint(0,shape[0]),generator.randint(0,shape[1])
+				current_lens._addShift(shift[::-1] if transpose else shift)
+
+			batch.append((current_lens,current_lens._pixel_shift))
+
+		return list(loaded.values()),batch
+
+	def convergenceBorn(self,initial_positions,z=2.0,save_intermediate=False,real_trajectory=False,rolls=None,lenses=None):
 
 		"""
 		Computes the convergence directly integrating the lensing density along the line of sight (real or unperturbed)
 
-		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
-		:type initial_positions: numpy array or quantity
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y. If a list is passed, each element is integrated as a separate map, loading each lens only once for the whole batch
+		:type initial_positions: numpy array, quantity or list
 
 		:param z: redshift of the sources
 		:type z: float.
@@ -1346,122 +2028,151 @@ class RayTracer(object):
 		:param real_trajectory: if True, integrate the density on the real light ray trajectory; if False the unperturbed trajectory is used
 		:type real_trajectory: bool.
 
-		:returns: convergence values at each of the initial positions
+		:param rolls: random seeds or numpy RandomState generators (one for each element of the initial_positions list) with which each map in the batch independently rolls the lenses along their axes; the lenses read from file are rolled with these in place of the global generator (None), the lenses in memory are rolled on top of their own roll (None for no additional roll)
+		:type rolls: list.
+
+		:param lenses: lenses crossed by each map in the batch (one list for each element of the initial_positions list, ordered as the lenses in the system, i.e. by redshift); each distinct lens is loaded once for the whole batch. If None, all the maps cross the lenses in the system
+		:type lenses: list.
+
+		:returns: convergence values at each of the initial positions (a list with one entry for each map if initial_positions is a list)
 
 		"""
 
 		#Sanity check
-		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
-		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
+		batch_mode,batch_positions,generators,lenses = self._batchSpecs(initial_positions,rolls,lenses)
 
 		#Check that redshift is not too high given the current lenses
 		assert z<self.redshift[-1],"Given the current lenses you can trace up to redshift {0:.2f}!".format(self.redshift[-1])
 		last_lens = (z>np.array(self.redshift)).argmin() - 1
 
 		if save_intermediate:
-			all_convergence = np.zeros((last_lens+1,) + initial_positions.shape[1:])
+			all_convergence = [ np.zeros((last_lens+1,) + positions.shape[1:]) for positions in batch_positions ]
 
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
 
 		#Initial positions
-		current_positions = initial_positions.copy()
+		current_positions = [ positions.copy() for positions in batch_positions ]
 
 		if real_trajectory:
-			current_deflection = np.zeros(initial_positions.shape) * initial_positions.unit
+			current_deflection = [ np.zeros(positions.shape) * positions.unit for positions in batch_positions ]
 
 		#Timestamp
 		now = time.time()
 		last_timestamp = now
 
 		#Loop that goes through the lenses
-		current_convergence = np.zeros(initial_positions.shape[1:])
+		current_convergence = [ np.zeros(positions.shape[1:]) for positions in batch_positions ]
 		for k in range(last_lens+1):
 
 			#Start time for this lens
 			start = time.time()
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
-			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
-
-			#Extract the density at the ray positions
-			now = time.time()
-			logray.debug("Extracting density values from lens {0} at redshift {1:2f}".format(k,current_lens.redshift))
-			last_timestamp = now
-
-			#Compute full density plane
-			if self.lens_type==PotentialPlane:
-				density = current_lens.density(current_positions[0],current_positions[1])
-			elif self.lens_type==DensityPlane:
-				density = current_lens.getValues(current_positions[0],current_positions[1])
-			else:
-				raise TypeError("Lens format not recognized!")
-
-			#Timestamp
-			now = time.time()
-			logray.debug("Density values extracted in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
-
-			#Cumulate on the convergence
-			if k<last_lens:
-				current_convergence += density * (1. - (distance[k+1]/current_lens.cosmology.comoving_distance(z).to(Mpc).value))
-			else:
-				current_convergence += density * (1. - (distance[k+1]/current_lens.cosmology.comoving_distance(z).to(Mpc).value)) * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+			#Load in the lenses of the batch
+			self.profiler.lens = k
+			loaded,batch = self._loadBatch(k,[ batch_lenses[k] for batch_lenses in lenses ],generators)
 
-			#Compute ray deflections
-			if real_trajectory:
+			#Update all the maps in the batch before moving on to the next lens
+			for b in range(len(batch_positions)):
 
-				#Compute deflections due to current lens
-				deflections = current_lens.deflectionAngles(current_positions[0],current_positions[1])
+				#Roll the lens for this map
+				current_lens,shift = batch[b]
+				current_lens._pixel_shift = shift
 
-				#Geometric factors
-				Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
-				Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
+				#Weight of the lens in the line of sight integral
+				if k<last_lens:
+					weight = 1. - (distance[k+1]/current_lens.cosmology.comoving_distance(z).to(Mpc).value)
+				else:
+					weight = (1. - (distance[k+1]/current_lens.cosmology.comoving_distance(z).to(Mpc).value)) * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
 
-				#Compute the position on the next lens and log timestamp
-				current_deflection *= (Ak-1) 
+				#Extract the density at the ray positions
 				now = time.time()
-				logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
+				logray.debug("Extracting density values from lens {0} at redshift {1:2f}".format(k,current_lens.redshift))
 				last_timestamp = now
 
-				#Add deflections and log timestamp
-				current_deflection += Ck * deflections 
+				#Compute full density plane
+				if self.lens_type==PotentialPlane:
+					density = current_lens.density(current_positions[b][0],current_positions[b][1])
+				elif self.lens_type==DensityPlane:
+					density = current_lens.getValues(current_positions[b][0],current_positions[b][1])
+				else:
+					raise TypeError("Lens format not recognized!")
+
+				#Timestamp
 				now = time.time()
-				logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
+				logray.debug("Density values extracted in {0:.3f}s".format(now-last_timestamp))
+				self.profiler.record("density",now-last_timestamp)
 				last_timestamp = now
 
-				#Add deflection to current positions
-				current_positions += current_deflection
+				#Cumulate on the convergence
+				current_convergence[b] += density * weight
+				self.profiler.record("accumulation",time.time()-last_timestamp)
+
+				#Compute ray deflections
+				if real_trajectory:
+
+					#Compute deflections due to current lens
+					now = time.time()
+					deflections = current_lens.deflectionAngles(current_positions[b][0],current_positions[b][1])
+					self.profiler.record("deflection",time.time()-now)
+					last_timestamp = time.time()
+					accumulation_start = last_timestamp
+
+					#Geometric factors
+					Ak = (distance[k+1] / distance[k+2]) * (1.0 + (distance[k+2] - distance[k+1])/(distance[k+1] - distance[k]))
+					Ck = -1.0 * (distance[k+2] - distance[k+1]) / distance[k+2]
+
+					#Compute the position on the next lens and log timestamp
+					current_deflection[b] *= (Ak-1) 
+					now = time.time()
+					logray.debug("Geometrical weight factors calculations and deflection scaling completed in {0:.3f}s".format(now-last_timestamp))
+					last_timestamp = now
+
+					#Add deflections and log timestamp
+					current_deflection[b] += Ck * deflections 
+					now = time.time()
+					logray.debug("Deflection angles computed in {0:.3f}s".format(now-last_timestamp))
+					last_timestamp = now
+
+					#Add deflection to current positions
+					current_positions[b] += current_deflection[b]
+					self.profiler.record("accumulation",time.time()-accumulation_start)
+
+				#Save the intermediate convergence values if option is enabled
+				if save_intermediate:
+					all_convergence[b][k] = current_convergence[b].copy()
+
+			#Restore the lens rolls (lenses kept in memory are shared between calls)
+			for current_lens,base_shift in loaded:
+				current_lens._pixel_shift = base_shift
 
 			now = time.time()
 			logray.debug("Lens {0} crossed in {1:.3f}s".format(k,now-start))
 			last_timestamp = now
 
-			#Save the intermediate convergence values if option is enabled
-			if save_intermediate:
-				all_convergence[k] = current_convergence.copy()
-
-
 		#Return to the user
 		if save_intermediate:
-			return all_convergence
+			result = all_convergence
 		else:
-			return current_convergence
+			result = current_convergence
+
+		if batch_mode:
+			return result
+		else:
+			return result[0]
 
 	##################################################################################
 	###########Calculation of the convergence at second post-Born order###############
 	##################################################################################
 
-	def convergencePostBorn2(self,initial_positions,z=2.0,save_intermediate=False,include_first_order=False,include_ll=True,include_gp=True,transpose_up_to=-1,callback=None,**kwargs):
+	def convergencePostBorn2(self,initial_positions,z=2.0,save_intermediate=False,include_first_order=False,include_ll=True,include_gp=True,transpose_up_to=-1,callback=None,rolls=None,lenses=None,checkpoint=None,checkpoint_every=1,**kwargs):
 
 		"""
 		Computes the convergence at second post-born order with a double line of sight integral
 
-		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y
-		:type initial_positions: numpy array or quantity
+		:param initial_positions: initial angular positions of the light ray bucket, according to the observer; if unitless, the positions are assumed to be in radians. initial_positions[0] is x, initial_positions[1] is y. If a list is passed, each element is integrated as a separate map, loading each lens only once for the whole batch
+		:type initial_positions: numpy array, quantity or list
 
 		:param z: redshift of the sources
 		:type z: float.
@@ -1481,19 +2192,30 @@ class RayTracer(object):
 		:param transpose_up_to: transpose all the lenses before a certain index before integration
 		:type transpose_up_to: int.
 
-		:param callback: function is called on each contribution to the convergence during the LOS integration. The signature of the callback is callback(array_ov_values,tracer,k,type,**kwargs)
+		:param callback: function is called on each contribution to the convergence during the LOS integration. The signature of the callback is callback(array_ov_values,tracer,k,type,**kwargs); if initial_positions is a list, the index of the map in the batch is passed to the callback as the additional keyword argument batch
 		:type callback: callable.
 
+		:param rolls: random seeds or numpy RandomState generators (one for each element of the initial_positions list) with which each map in the batch independently rolls the lenses along their axes; the lenses read from file are rolled with these in place of the global generator (None), the lenses in memory are rolled on top of their own roll (None for no additional roll)
+		:type rolls: list.
+
+		:param lenses: lenses crossed by each map in the batch (one list for each element of the initial_positions list, ordered as the lenses in the system, i.e. by redshift); each distinct lens is loaded once for the whole batch. If None, all the maps cross the lenses in the system
+		:type lenses: list.
+
+		:param checkpoint: if not None, name of the file in which the integration state is saved every checkpoint_every lenses; if the file exists already, the integration resumes from the last lens it records. The file is removed when the integration completes
+		:type checkpoint: str.
+
+		:param checkpoint_every: number of lenses crossed between checkpoints
+		:type checkpoint_every: int.
+
 		:param kwargs: additional keyword arguments to be passed to the callback
 		:type kwargs: dict.
 
-		:returns: convergence values (2-post born) at each of the initial positions
+		:returns: convergence values (2-post born) at each of the initial positions (a list with one entry for each map if initial_positions is a list)
 
 		"""
 
 		#Sanity check
-		assert initial_positions.ndim>=2 and initial_positions.shape[0]==2,"initial positions shape must be (2,...)!"
-		assert type(initial_positions)==quantity.Quantity and initial_positions.unit.physical_type=="angle"
+		batch_mode,batch_positions,generators,lenses = self._batchSpecs(initial_positions,rolls,lenses)
 		assert self.lens_type==PotentialPlane
 
 		#Check that redshift is not too high given the current lenses
@@ -1501,139 +2223,192 @@ class RayTracer(object):
 		last_lens = (z>np.array(self.redshift)).argmin() - 1
 
 		if save_intermediate:
-			all_convergence = np.zeros((last_lens+1,) + initial_positions.shape[1:])
+			all_convergence = [ np.zeros((last_lens+1,) + positions.shape[1:]) for positions in batch_positions ]
 
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
-
-		#Initial positions
-		current_positions = initial_positions
 
 		#Timestamp
 		now = time.time()
 		last_timestamp = now
 
-		#Loop that goes through the lenses
-		current_convergence = np.zeros(initial_positions.shape[1:])
+		#Loop that goes through the lenses (one set of accumulators for each map in the batch)
+		current_convergence = [ np.zeros(positions.shape[1:]) for positions in batch_positions ]
 		
-		current_deflections_0 = np.zeros(initial_positions.shape)*rad
-		current_deflections_1 = np.zeros(initial_positions.shape)*rad
-		current_deflections = np.zeros(initial_positions.shape)*rad
+		current_deflections_0 = [ np.zeros(positions.shape)*rad for positions in batch_positions ]
+		current_deflections_1 = [ np.zeros(positions.shape)*rad for positions in batch_positions ]
+		current_deflections = [ np.zeros(positions.shape)*rad for positions in batch_positions ]
 		
-		current_jacobians_0 = np.zeros((3,)+initial_positions.shape[1:])
-		current_jacobians_1 = np.zeros((3,)+initial_positions.shape[1:])
-		current_jacobians = np.zeros((3,)+initial_positions.shape[1:])
+		current_jacobians_0 = [ np.zeros((3,)+positions.shape[1:]) for positions in batch_positions ]
+		current_jacobians_1 = [ np.zeros((3,)+positions.shape[1:]) for positions in batch_positions ]
+		current_jacobians = [ np.zeros((3,)+positions.shape[1:]) for positions in batch_positions ]
+
+		#Names of the accumulators in the checkpoints
+		accumulators = dict(convergence=current_convergence,deflections_0=current_deflections_0,deflections_1=current_deflections_1,deflections=current_deflections,jacobians_0=current_jacobians_0,jacobians_1=current_jacobians_1,jacobians=current_jacobians)
+		if save_intermediate:
+			accumulators["all_convergence"] = all_convergence
+
+		#Resume the integration from the last checkpoint, if any
+		first_lens = 0
+		if checkpoint is not None:
+			checkpoint_specs = self._checkpointSpecs(z,[ lens for batch_lenses in lenses for lens in batch_lenses ])
+
+		if (checkpoint is not None) and os.path.exists(checkpoint):
+
+			k,state = self._loadCheckpoint(checkpoint,generators)
+			assert int(state["batch_size"])==len(batch_positions),"Checkpoint {0} does not match the current integration specifications!".format(checkpoint)
+			self._checkCheckpoint(checkpoint,state,checkpoint_specs)
+			first_lens = k+1
+
+			for name in accumulators:
+				for b in range(len(batch_positions)):
+					assert state["{0}{1}".format(name,b)].shape==accumulators[name][b].shape,"Checkpoint {0} does not match the current integration specifications!".format(checkpoint)
+					accumulators[name][b] = state["{0}{1}".format(name,b)]
 		
-		for k in range(last_lens+1):
+		for k in range(first_lens,last_lens+1):
 
 			#Start time for this lens
 			start = time.time()
 
-			#Load in the lens
-			current_lens = self.loadLens(lens[k])
-			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
+			#Load in the lenses of the batch (maybe transposed)
+			self.profiler.lens = k
+			loaded,batch = self._loadBatch(k,[ batch_lenses[k] for batch_lenses in lenses ],generators,transpose=(k<=transpose_up_to))
 
-			#Maybe transpose
-			if k<=transpose_up_to:
-				logray.debug("Transposing pixel values for lens {0}".format(k))
-				current_lens.data = current_lens.data.T
-
-			#Distances, lensing kernel
+			#Distances
 			chi_prev = distance[k]
 			chi = distance[k+1]
-			kernel = 1. - (chi/current_lens.cosmology.comoving_distance(z).to(Mpc).value)
 
-			#################################################################################
-			##Compute lensing quantities (deflections, jacobian, density, density gradient)##
-			#################################################################################
+			#Update all the maps in the batch before moving on to the next lens
+			for b in range(len(batch_positions)):
 
-			#Extract the field values  at the ray positions
-			now = time.time()
-			logray.debug("Extracting field values from lens {0} at redshift {1:2f}".format(k,current_lens.redshift))
-			last_timestamp = now
+				#Roll the lens for this map, lensing kernel
+				current_lens,shift = batch[b]
+				current_lens._pixel_shift = shift
+				kernel = 1. - (chi/current_lens.cosmology.comoving_distance(z).to(Mpc).value)
+				current_positions = batch_positions[b]
+				if batch_mode:
+					kwargs["batch"] = b
 
-			#Update local quantities
-			deflections_lcl = current_lens.deflectionAngles(current_positions[0],current_positions[1])
-			shear_tensors_lcl = current_lens.shearMatrix(current_positions[0],current_positions[1])
-			density_grad_lcl = current_lens.densityGradient(current_positions[0],current_positions[1])
+				#################################################################################
+				##Compute lensing quantities (deflections, jacobian, density, density gradient)##
+				#################################################################################
 
-			#Save geodesic perturbation term
-			if callback is not None:
-				callback((deflections_lcl*density_grad_lcl).decompose().value.sum(0),self,k,"gpgd",**kwargs)
+				#Extract the field values  at the ray positions
+				now = time.time()
+				logray.debug("Extracting field values from lens {0} at redshift {1:2f}".format(k,current_lens.redshift))
+				last_timestamp = now
 
-			if include_first_order:
-				density_lcl = 0.5*(shear_tensors_lcl[0]+shear_tensors_lcl[1])
+				#Update local quantities
+				with self.profiler.phase("deflection"):
+					deflections_lcl = current_lens.deflectionAngles(current_positions[0],current_positions[1])
+				with self.profiler.phase("shear"):
+					shear_tensors_lcl = current_lens.shearMatrix(current_positions[0],current_positions[1])
+				with self.profiler.phase("density_gradient"):
+					density_grad_lcl = current_lens.densityGradient(current_positions[0],current_positions[1])
 
-			#Update integrated quantities
-			if k<last_lens:
-				
-				if include_ll:
-					add_on = (0.5*kernel) * (shear_tensors_lcl*current_jacobians)[[0,1,2,2]].sum(0)
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"ll",**kwargs)
-
-				if include_gp:
-					add_on = kernel * (density_grad_lcl*current_deflections).decompose().value.sum(0)
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"gp",**kwargs)
-				
-				if include_first_order:
-					add_on = kernel * density_lcl
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"born",**kwargs)
+				accumulation_start = time.time()
 
-				current_deflections_0 += deflections_lcl
-				current_deflections_1 += deflections_lcl*(0.5*(chi+chi_prev))
-				current_deflections = -current_deflections_0 + current_deflections_1/chi
+				#Save geodesic perturbation term
+				if callback is not None:
+					callback((deflections_lcl*density_grad_lcl).decompose().value.sum(0),self,k,"gpgd",**kwargs)
 
-				current_jacobians_0 += shear_tensors_lcl
-				current_jacobians_1 += shear_tensors_lcl*(0.5*(chi+chi_prev))
-				current_jacobians = -current_jacobians_0 + current_jacobians_1/chi
+				if include_first_order:
+					density_lcl = 0.5*(shear_tensors_lcl[0]+shear_tensors_lcl[1])
 
+				#Update integrated quantities
+				if k<last_lens:
+					
+					if include_ll:
+						add_on = (0.5*kernel) * (shear_tensors_lcl*current_jacobians[b])[[0,1,2,2]].sum(0)
+						current_convergence[b] += add_on
+						if callback is not None:
+							callback(add_on,self,k,"ll",**kwargs)
+
+					if include_gp:
+						add_on = kernel * (density_grad_lcl*current_deflections[b]).decompose().value.sum(0)
+						current_convergence[b] += add_on
+						if callback is not None:
+							callback(add_on,self,k,"gp",**kwargs)
+					
+					if include_first_order:
+						add_on = kernel * density_lcl
+						current_convergence[b] += add_on
+						if callback is not None:
+							callback(add_on,self,k,"born",**kwargs)
+
+					current_deflections_0[b] += deflections_lcl
+					current_deflections_1[b] += deflections_lcl*(0.5*(chi+chi_prev))
+					current_deflections[b] = -current_deflections_0[b] + current_deflections_1[b]/chi
+
+					current_jacobians_0[b] += shear_tensors_lcl
+					current_jacobians_1[b] += shear_tensors_lcl*(0.5*(chi+chi_prev))
+					current_jacobians[b] = -current_jacobians_0[b] + current_jacobians_1[b]/chi
 
-			else:
 
-				if include_ll:
-					add_on = (0.5 * kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])) * (shear_tensors_lcl*current_jacobians)[[0,1,2,2]].sum(0)
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"ll",**kwargs)
-
-				if include_gp:
-					add_on = (kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])) * (density_grad_lcl*current_deflections).decompose().value.sum(0)
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"gp",**kwargs)
+				else:
+
+					if include_ll:
+						add_on = (0.5 * kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])) * (shear_tensors_lcl*current_jacobians[b])[[0,1,2,2]].sum(0)
+						current_convergence[b] += add_on
+						if callback is not None:
+							callback(add_on,self,k,"ll",**kwargs)
+
+					if include_gp:
+						add_on = (kernel * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])) * (density_grad_lcl*current_deflections[b]).decompose().value.sum(0)
+						current_convergence[b] += add_on
+						if callback is not None:
+							callback(add_on,self,k,"gp",**kwargs)
+					
+					if include_first_order:
+						add_on = kernel * density_lcl * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
+						current_convergence[b] += add_on
+						if callback is not None:
+							callback(add_on,self,k,"born",**kwargs)
 				
-				if include_first_order:
-					add_on = kernel * density_lcl * (z - redshift[k+1]) / (redshift[k+2] - redshift[k+1])
-					current_convergence += add_on
-					if callback is not None:
-						callback(add_on,self,k,"born",**kwargs)
-			
-			#Timestamp
-			now = time.time()
-			logray.debug("Field values extracted in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+				#Timestamp
+				now = time.time()
+				logray.debug("Field values extracted in {0:.3f}s".format(now-last_timestamp))
+				self.profiler.record("accumulation",now-accumulation_start)
+				last_timestamp = now
+
+				#Save the intermediate convergence values if option is enabled
+				if save_intermediate:
+					all_convergence[b][k] = current_convergence[b].copy()
+
+			#Restore the lens rolls (lenses kept in memory are shared between calls)
+			for current_lens,base_shift in loaded:
+				current_lens._pixel_shift = base_shift
 
 			now = time.time()
 			logray.debug("Lens {0} crossed in {1:.3f}s".format(k,now-start))
 			last_timestamp = now
 
-			#Save the intermediate convergence values if option is enabled
-			if save_intermediate:
-				all_convergence[k] = current_convergence.copy()
+			#Checkpoint the accumulators
+			if (checkpoint is not None) and (k<last_lens) and ((k+1)%checkpoint_every==0):
+				
+				state = dict(batch_size=len(batch_positions),**checkpoint_specs)
+				for name in accumulators:
+					for b in range(len(batch_positions)):
+						state["{0}{1}".format(name,b)] = accumulators[name][b]
+
+				with self.profiler.phase("checkpoint"):
+					self._saveCheckpoint(checkpoint,k,state,generators)
+
+		#The integration is complete, the checkpoint is not needed anymore
+		if (checkpoint is not None) and os.path.exists(checkpoint):
+			os.remove(checkpoint)
 
 		#Return to the user
 		if save_intermediate:
-			return all_convergence
+			result = all_convergence
 		else:
-			return current_convergence
+			result = current_convergence
+
+		if batch_mode:
+			return result
+		else:
+			return result[0]
 
 	########################################################################
 	###########Calculation of omega at second post-Born order###############
@@ -1672,7 +2447,6 @@ class RayTracer(object):
 		#Ordered references to the lenses
 		distance = np.array([ d.to(Mpc).value for d in [0.0*Mpc] + self.distance ])
 		redshift = np.array([0.0] + self.redshift)
-		lens = self.lens
 
 		#Initial positions
 		current_positions = initial_positions
@@ -1693,6 +2467,7 @@ class RayTracer(object):
 			start = time.time()
 
 			#Load in the lens
+			self.profiler.lens = k
 			current_lens = self.loadLens(lens[k])
 			np.testing.assert_approx_equal(current_lens.redshift,self.redshift[k],significant=4,err_msg="Loaded lens ({0}) redshift does not match info file specifications {1} neq {2}!".format(k,current_lens.redshift,self.redshift[k]))
 
@@ -1711,7 +2486,10 @@ class RayTracer(object):
 			last_timestamp = now
 
 			#Update local quantities
-			shear_tensors_lcl = current_lens.shearMatrix(current_positions[0],current_positions[1])
+			with self.profiler.phase("shear"):
+				shear_tensors_lcl = current_lens.shearMatrix(current_positions[0],current_positions[1])
+
+			accumulation_start = time.time()
 
 			#Update integrated quantities
 			if k<last_lens:
@@ -1726,6 +2504,7 @@ class RayTracer(object):
 			#Timestamp
 			now = time.time()
 			logray.debug("Field values extracted in {0:.3f}s".format(now-last_timestamp))
+			self.profiler.record("accumulation",now-accumulation_start)
 			last_timestamp = now
 
 			now = time.time()
@@ -1746,91 +2525,131 @@ class RayTracer(object):
 	############Forward ray tracing##########################
 	#########################################################
 
-	def shootForward(self,source_positions,z=2.0,save_intermediate=False,grid_resolution=512,interpolation="nearest"):
+	def inverseMapping(self,z,corner,grid_resolution=512,save_intermediate=False,interpolation="nearest",neighbors=4,workers=1):
 
 		"""
-		Shoots a bucket of light rays from the source at redshift z to the observer at redshift 0 (forward ray tracing) and computes the according deflections using backward ray tracing plus a suitable interpolation scheme (KD Tree based)
-
-		:param source_positions: angular positions of the unlensed sources
-		:type source_positions: numpy array or quantity
+		Traces a regular grid of light rays backwards and builds the interpolation structure that maps source positions onto apparent positions; the structure can be reused on any number of source catalogs
 
 		:param z: redshift of the sources
 		:type z: float.
 
-		:param save_intermediate: if True computes and saves the apparent image distortions after each lens is crossed (can be computationally expensive) 
-		:type save_intermediate: bool.
+		:param corner: upper right corner (x,y) of the regular grid, whose lower left corner is the origin
+		:type corner: quantity
 
 		:param grid_resolution: the number of points on a side of the interpolation grid (must be choosen big enough according to the number of sources to resolve)
-		:type grid_resolution: int. 
+		:type grid_resolution: int.
 
-		:param interpolation: only "nearest" implemented so far
+		:param save_intermediate: if True builds a mapping for each lens crossed
+		:type save_intermediate: bool.
+
+		:param interpolation: interpolation scheme, see :py:class:`InverseMapping`
 		:type interpolation: str.
 
-		:returns: apparent positions of the sources as seen from the observer
+		:param neighbors: number of nearest neighbors used in the "inverse_distance" interpolation
+		:type neighbors: int.
+
+		:param workers: number of threads used to trace the grid and to query the KD trees
+		:type workers: int.
+
+		:returns: :py:class:`InverseMapping` instance (list of instances, one for each lens, if save_intermediate is True)
 
 		"""
 
-		#First allocate the regular grid to use (must be fine enough to resolve the single ray distortions, since we use nearest neighbors interpolation for now)
-		corner = source_positions.max(axis=tuple(range(1,len(source_positions.shape))))
-		initial_grid = np.array(np.meshgrid(np.linspace(0.0,corner[0].value,grid_resolution),np.linspace(0.0,corner[1].value,grid_resolution))) * corner.unit
+		#Allocate the regular grid to use
+		initial_grid = np.array(np.meshgrid(np.linspace(0.0,corner[0].value,grid_resolution),np.linspace(0.0,corner[1].to(corner.unit).value,grid_resolution))) * corner.unit
 		initial_grid = initial_grid.reshape((2,)+(reduce(mul,initial_grid.shape[1:]),))
 
 		now = time.time()
 		last_timestamp = now
 		
 		#Perform the backwards ray tracing
-		final_grid = self.shoot(initial_grid,z=z,save_intermediate=save_intermediate)
+		final_grid = self.shoot(initial_grid,z=z,save_intermediate=save_intermediate,workers=workers)
 
 		now = time.time()
 		logray.debug("Ray tracing in {0:.3f}s".format(now-last_timestamp))
 		last_timestamp = now
 
+		#Build the interpolation structures
 		if save_intermediate:
+			mapping = [ InverseMapping(initial_grid,final_grid[n],interpolation=interpolation,neighbors=neighbors,workers=workers) for n in range(final_grid.shape[0]) ]
+		else:
+			mapping = InverseMapping(initial_grid,final_grid,interpolation=interpolation,neighbors=neighbors,workers=workers)
 
-			#If this option is enabled the full evolution of the distortions (after each lens is crossed) is computed
+		now = time.time()
+		logray.debug("Inverse mapping built in {0:.3f}s".format(now-last_timestamp))
+		last_timestamp = now
 
-			#Allocate space for the apparent positions
-			apparent_positions = np.zeros((final_grid.shape[0],) + source_positions.shape) * corner.unit
+		return mapping
 
-			for n in range(final_grid.shape[0]):
 
-				#Next build the KD tree for nearest neighbors interpolation
-				tree = KDTree(final_grid[n].transpose())
+	def shootForward(self,source_positions,z=2.0,save_intermediate=False,grid_resolution=512,interpolation="nearest",neighbors=4,workers=1):
 
-				now = time.time()
-				logray.debug("KDTree built in {0:.3f}s".format(now-last_timestamp))
-				last_timestamp = now
+		"""
+		Shoots a bucket of light rays from the source at redshift z to the observer at redshift 0 (forward ray tracing) and computes the according deflections using backward ray tracing plus a suitable interpolation scheme (KD Tree or triangulation based)
 
-				#Query the tree and retrieve the apparent positions
-				distances,apparent_position_index = tree.query(source_positions.reshape((2,)+(reduce(mul,source_positions.shape[1:]),)).transpose())
+		:param source_positions: angular positions of the unlensed sources; if a list of catalogs is passed, the interpolation structure is built once and used on all of them
+		:type source_positions: numpy array or quantity, or list
 
-				now = time.time()
-				logray.debug("Tree query completed in {0:.3f}s".format(now-last_timestamp))
-				last_timestamp = now
+		:param z: redshift of the sources
+		:type z: float.
+
+		:param save_intermediate: if True computes and saves the apparent image distortions after each lens is crossed (can be computationally expensive) 
+		:type save_intermediate: bool.
+
+		:param grid_resolution: the number of points on a side of the interpolation grid (must be choosen big enough according to the number of sources to resolve)
+		:type grid_resolution: int. 
+
+		:param interpolation: "nearest" (nearest grid ray), "inverse_distance" (inverse distance weighting of the nearest neighbors) or "linear" (barycentric interpolation on the Delaunay triangulation of the distorted grid)
+		:type interpolation: str.
+
+		:param neighbors: number of nearest neighbors used in the "inverse_distance" interpolation
+		:type neighbors: int.
+
+		:param workers: number of threads used to trace the grid and to query the KD trees
+		:type workers: int.
 
-				apparent_positions[n] = initial_grid[:,apparent_position_index].reshape(source_positions.shape).copy()
+		:returns: apparent positions of the sources as seen from the observer (list of those if a list of catalogs is passed)
 
+		"""
 
+		#Catalogs to process
+		if type(source_positions) in [list,tuple]:
+			catalogs = source_positions
 		else:
+			catalogs = [source_positions]
 
-			#Next build the KD tree for nearest neighbors interpolation
-			tree = KDTree(final_grid.transpose())
+		#The regular grid must cover all the sources
+		unit = catalogs[0].unit
+		corner = np.array([ c.reshape((2,)+(reduce(mul,c.shape[1:]),)).to(unit).value.max(axis=1) for c in catalogs ]).max(axis=0) * unit
 
-			now = time.time()
-			logray.debug("KDTree built in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+		#Build the interpolation structure once
+		mapping = self.inverseMapping(z,corner,grid_resolution=grid_resolution,save_intermediate=save_intermediate,interpolation=interpolation,neighbors=neighbors,workers=workers)
 
-			#Query the tree and retrieve the apparent positions
-			distances,apparent_position_index = tree.query(source_positions.reshape((2,)+(reduce(mul,source_positions.shape[1:]),)).transpose())
+		now = time.time()
+		last_timestamp = now
 
-			now = time.time()
-			logray.debug("Tree query completed in {0:.3f}s".format(now-last_timestamp))
-			last_timestamp = now
+		#Interpolate the apparent positions
+		apparent_positions = list()
+		for c in catalogs:
 
-			apparent_positions = initial_grid[:,apparent_position_index].reshape(source_positions.shape)
+			if save_intermediate:
+				apparent = np.zeros((len(mapping),) + c.shape) * unit
+				for n,m in enumerate(mapping):
+					apparent[n] = m(c)
+			else:
+				apparent = mapping(c)
+
+			apparent_positions.append(apparent)
+
+		now = time.time()
+		logray.debug("Inverse mapping of {0} catalogs completed in {1:.3f}s".format(len(catalogs),now-last_timestamp))
+		last_timestamp = now
 
 		#Return the measured apparent distances
-		return apparent_positions
+		if type(source_positions) in [list,tuple]:
+			return apparent_positions
+		else:
+			return apparent_positions[0]
 
 
 
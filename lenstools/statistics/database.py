@@ -236,7 +236,7 @@ def chi2database(db_name,parameters,specs,table_name="scores",pool=None,nchunks=
  	:param table_name: table name to populate in the database
  	:type table_name: str.
 
- 	:param pool: MPIPool to spread the calculations over (pass None for automatic pool handling)
+ 	:param pool: MPIPool or LocalPool to spread the calculations over (pass None for automatic pool handling)
  	:type pool: MPIPool
 
  	:param nchunks: number of chunks to split the parameter score calculations in (one chunk per processor ideally) 
@@ -290,7 +290,7 @@ class Ensemble(pd.DataFrame):
 		:param callback_loader: This function gets executed on each of the files in the list and populates the ensemble. If None provided, it performs a numpy.load on the specified files. Must return a numpy array with the loaded data
 		:type callback_loader: function
 
-		:param pool: MPI pool for multiprocessing (imported from emcee https://github.com/dfm/emcee)
+		:param pool: MPI pool for multiprocessing (imported from emcee https://github.com/dfm/emcee), or LocalPool to use the local cores
 		:type pool: MPI pool object
 
 		:param index: index of the Ensemble
@@ -664,7 +664,7 @@ class Ensemble(pd.DataFrame):
 		:param resample: number of times the Ensemble is resampled
 		:type resample: int.
 
-		:param pool: MPI pool for multiprocessing (imported from emcee https://github.com/dfm/emcee)
+		:param pool: MPI pool for multiprocessing (imported from emcee https://github.com/dfm/emcee), or LocalPool to use the local cores
 		:type pool: MPI pool object
 
 		:returns: Covariance matrix, has shape (self.data[1],self.data[1]) 
@@ -698,7 +698,7 @@ class Ensemble(pd.DataFrame):
 		:param assemble: method that gets called on the resampled statistic list to make it into an Ensemble
 		:type assemble: callable
 
-		:param pool: MPI pool for multiprocessing (imported from emcee https://github.com/dfm/emcee)
+		:param pool: MPI pool for multiprocessing (imported from emcee https://github.com/dfm/emcee), or LocalPool to use the local cores
 		:type pool: MPI pool object
 
 		:param kwargs: passed to the callback function
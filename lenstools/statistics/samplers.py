@@ -79,7 +79,7 @@ def emcee_sampler(emulator,observed_feature,features_covariance,correct=None,psl
 	:param nchain: length of the MCMC chain
 	:type nchain: int.
 
-	:param pool: MPI Pool for parallelization of computations
+	:param pool: MPI Pool (or LocalPool) for parallelization of computations
 	:type pool: MPIPool
 
 	:returns: ensemble of samples from the posterior probability distribution
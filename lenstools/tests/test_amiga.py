@@ -0,0 +1,105 @@
+import os
+
+from ..simulations.amiga import AmigaHalos
+
+import numpy as np
+import astropy.units as u
+
+#Write a small synthetic AHF catalog (with its log file) in the amiga directory
+def amigaCatalog(num_halos=300,seed=0):
+
+	if not os.path.isdir("amiga"):
+		os.mkdir("amiga")
+
+	catalog = os.path.join("amiga","halos.0000.z0.500.AHF_halos")
+	if os.path.exists(catalog+".columns.npy"):
+		os.remove(catalog+".columns.npy")
+
+	#Mass, position, virial radius (kpc/h) and concentration columns
+	np.random.seed(seed)
+	columns = np.zeros((num_halos,45))
+	columns[:,0] = np.arange(num_halos)
+	columns[:,3] = 10**(12 + 2*np.random.rand(num_halos))
+	columns[:,5:8] = np.random.rand(num_halos,3)*240000.
+	columns[:,11] = 300. + 700.*np.random.rand(num_halos)
+	columns[:,42] = 3. + 10.*np.random.rand(num_halos)
+
+	with open(catalog,"w") as fp:
+		fp.write("#ID(1) " + " ".join([ "c({0})".format(n) for n in range(2,46) ]) + "\n")
+		np.savetxt(fp,columns,fmt="%.6e")
+
+	with open(os.path.join("amiga","halos.00.log"),"w") as fp:
+		fp.write("simu.omega0 : 0.3\nsimu.lambda0 : 0.7\nsimu.boxsize : 240.0\n")
+
+	return catalog,columns
+
+def test_stream_halos():
+
+	#Cut the same halo plane reading all the halos at once, and streaming them from the catalog in chunks
+	catalog,columns = amigaCatalog()
+	kwargs = dict(normal=2,center=120.0e3*u.kpc,thickness=20.0e3*u.kpc,plane_resolution=64,thickness_resolution=4,smooth=None,kind="density",left_corner=np.zeros(3)*u.kpc)
+
+	halos = AmigaHalos.open(catalog)
+	halos.getPositions()
+	plane,resolution,num_part = halos.cutPlaneGaussianGrid(**kwargs)
+	density,resolution = halos.massDensity(resolution=16,left_corner=kwargs["left_corner"])
+	halos.close()
+
+	halos = AmigaHalos.open(catalog)
+	plane_stream,resolution,num_part_stream = halos.cutPlaneGaussianGrid(chunk_size=37,**kwargs)
+	density_stream,resolution = halos.massDensity(resolution=16,left_corner=kwargs["left_corner"],chunk_size=37)
+	assert not hasattr(halos,"positions")
+	halos.close()
+
+	assert np.allclose(num_part,num_part_stream)
+	assert np.allclose(plane,plane_stream)
+	assert np.allclose(density,density_stream)
+
+def test_cut_halo_planes():
+
+	#Cutting all the halo planes at once should give the same planes as cutting them one at a time
+	catalog,columns = amigaCatalog()
+	slabs = [(2,60.0e3*u.kpc,20.0e3*u.kpc),(0,150.0e3*u.kpc,30.0e3*u.kpc)]
+	kwargs = dict(plane_resolution=64,thickness_resolution=4,smooth=1,kind="potential",assignment="CIC",left_corner=np.zeros(3)*u.kpc)
+
+	halos = AmigaHalos.open(catalog)
+	halos.getPositions()
+	planes = halos.cutPlanes(slabs,**kwargs)
+
+	for (normal,center,thickness),(plane,resolution,num_part) in zip(slabs,planes):
+		plane_single,resolution_single,num_part_single = halos.cutPlaneGaussianGrid(normal=normal,center=center,thickness=thickness,**kwargs)
+		assert np.allclose(num_part,num_part_single)
+		assert np.allclose(plane.value,plane_single.value,atol=1.0e-6*np.abs(plane_single.value).max())
+
+	halos.close()
+
+def test_column_cache():
+
+	#Only the needed columns of the catalog are parsed, and they are cached in a binary file next to it
+	catalog,columns = amigaCatalog()
+	cache_file = catalog+".columns.npy"
+
+	halos = AmigaHalos.open(catalog)
+	parsed = np.array(halos._readColumns())
+	assert np.allclose(parsed,np.loadtxt(catalog,usecols=AmigaHalos._columns).T)
+	assert np.allclose(halos.getPositions(first=10,last=20).value,columns[10:20,5:8])
+	assert np.allclose(halos.concentration,columns[10:20,42])
+	halos.close()
+	assert os.path.exists(cache_file)
+
+	#The cache is read instead of the catalog, as long as it is more recent
+	np.save(cache_file,2*parsed)
+	halos = AmigaHalos.open(catalog)
+	assert isinstance(halos._readColumns(),np.memmap)
+	assert np.allclose(halos._readColumns(),2*parsed)
+	halos.close()
+
+	#Touching the catalog makes the cache stale: the catalog is parsed again and the cache rebuilt
+	mtime = os.path.getmtime(cache_file) - 10
+	os.utime(cache_file,(mtime,mtime))
+	os.utime(catalog,None)
+	halos = AmigaHalos.open(catalog)
+	assert np.allclose(halos._readColumns(),parsed)
+	halos.close()
+	assert os.path.getmtime(cache_file)>=os.path.getmtime(catalog)
+	assert np.allclose(np.load(cache_file),parsed)
@@ -1,6 +1,7 @@
 import os
+from collections import OrderedDict
 
-from ..simulations.camb import CAMBTransferFunction
+from ..simulations.camb import CAMBTransferFunction,TransferFunction,TestTransferFunction
 from ..simulations.raytracing import PotentialPlane
 
 from .. import dataExtern
@@ -61,4 +62,74 @@ def test_plane_scaling():
 
 	#Save 
 	fig.tight_layout()
-	fig.savefig("plane_scaling_tfr.png")
\ No newline at end of file
+	fig.savefig("plane_scaling_tfr.png")
+
+def test_cached_scaling():
+
+	#Load the transfer function, load the lens plane
+	tfr = CAMBTransferFunction.read(os.path.join(dataExtern(),"camb","camb_tfr.pkl"))
+	k = np.logspace(-3,1,100) / u.Mpc
+
+	#The vectorized (z,k) interpolator agrees with the tabulated values
+	z,kt,t = tfr[1.]
+	assert np.allclose(tfr.interpolate(z,kt),t)
+	assert np.allclose(tfr.interpolate(np.array([[0.5],[1.0]]),k,z_interpolation="nearest"),np.array([tfr(0.5,k),tfr(1.0,k)]))
+
+	#Scaling factors computed once are reused on a second plane with the same specifications
+	cache = dict()
+	plane = PotentialPlane.load(os.path.join(dataExtern(),"plane.fits"))
+	plane_cached = PotentialPlane.load(os.path.join(dataExtern(),"plane.fits"))
+	plane.scaleWithTransfer(1.5,tfr,scaling_method="uniform",cache=cache)
+	plane_cached.scaleWithTransfer(1.5,tfr,scaling_method="uniform",cache=cache)
+
+	assert len(cache)==1
+	assert np.allclose(plane.data,plane_cached.data)
+
+def test_cached_scaling_fft():
+
+	#Synthetic transfer function that depends on both z and k
+	k = np.logspace(-3,1,100) / u.Mpc
+	tfr = TransferFunction(k)
+	for z in (0.,0.5,1.,1.5,2.,2.5):
+		tfr.add(z,1./((1.+z)*(1.+(k.value/(1.+z))**2)))
+
+	np.random.seed(0)
+	data = np.random.randn(64,64)
+	lx,ly = np.meshgrid(np.fft.rfftfreq(64),np.fft.fftfreq(64))
+	kmesh = np.sqrt(lx**2+ly**2) * 2.*np.pi*64 / (100.*u.Mpc)
+	plane = lambda angle=1.0*u.deg: PotentialPlane(data.copy(),angle=angle,redshift=1.0,comoving_distance=3000.0*u.Mpc,unit=u.rad**2)
+
+	#Cache misses give the same scaling as no cache at all, and hits reuse the factors computed already
+	cache = dict()
+	for z,with_scale_factor in ((1.5,False),(1.5,True),(2.0,False),(1.5,False)):
+		plane_reference,plane_cached = plane(),plane()
+		plane_reference.scaleWithTransfer(z,tfr,with_scale_factor=with_scale_factor,kmesh=kmesh,scaling_method="FFT")
+		plane_cached.scaleWithTransfer(z,tfr,with_scale_factor=with_scale_factor,kmesh=kmesh,scaling_method="FFT",cache=cache)
+		assert np.allclose(plane_reference.data,plane_cached.data)
+
+	assert len(cache)==3
+
+	#A different plane size or transfer function misses the cache
+	plane_cached = plane(2.0*u.deg)
+	plane_cached.scaleWithTransfer(1.5,tfr,kmesh=kmesh,scaling_method="FFT",cache=cache)
+	assert len(cache)==4
+
+	plane_cached = plane()
+	plane_cached.scaleWithTransfer(1.5,TestTransferFunction(k),kmesh=kmesh,scaling_method="FFT",cache=cache)
+	assert len(cache)==5
+	assert np.allclose(plane_cached.data,data*2.0/2.5)
+
+	#The entries keep their mesh alive, so that a new mesh cannot take the id of a collected one and hit its entries
+	cache = dict()
+	plane().scaleWithTransfer(1.5,tfr,kmesh=kmesh.copy(),scaling_method="FFT",cache=cache)
+	plane_reference,plane_cached = plane(),plane()
+	plane_reference.scaleWithTransfer(1.5,tfr,kmesh=2.*kmesh,scaling_method="FFT")
+	plane_cached.scaleWithTransfer(1.5,tfr,kmesh=2.*kmesh,scaling_method="FFT",cache=cache)
+	assert len(cache)==2
+	assert np.allclose(plane_reference.data,plane_cached.data)
+
+	#The cache is bounded, the oldest entries are evicted first
+	cache = OrderedDict()
+	for z in (1.5,2.0,2.5):
+		plane().scaleWithTransfer(z,tfr,kmesh=kmesh,scaling_method="FFT",cache=cache,cache_size=2)
+	assert [ key[1] for key in cache ]==[2.0,2.5]
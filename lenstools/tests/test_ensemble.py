@@ -2,6 +2,7 @@ import sys,os
 	
 from .. import Ensemble
 from ..utils.defaults import measure_power_spectrum,peaks_loader
+from ..utils.pools import LocalPool,defaultPool
 
 try:
 
@@ -59,6 +60,35 @@ def test_shape():
 	assert conv_ensemble.nobs==len(map_list)
 	assert conv_ensemble.shape==(len(map_list),len(l_edges)-1)
 
+def test_local_pool():
+
+	#The same ensemble, computed on local processes and threads
+	for kind in ["process","thread"]:
+		with LocalPool(processes=2,kind=kind) as local_pool:
+			local_ensemble = Ensemble.compute(file_list=map_list,callback_loader=measure_power_spectrum,pool=local_pool,l_edges=l_edges,columns=pd.Index(l,name="ell"))
+
+		assert np.allclose(local_ensemble.values,conv_ensemble.values)
+
+def test_default_pool():
+
+	#Outside of MPI the work is spread on the local processes, unless there is a single core
+	kind = os.environ.pop("LENSTOOLS_POOL",None)
+	try:
+		with defaultPool(processes=2) as local_pool:
+			assert isinstance(local_pool,LocalPool) and local_pool.kind=="process"
+		assert defaultPool(processes=1) is None
+
+		#The environment overrides the automatic choice
+		os.environ["LENSTOOLS_POOL"] = "thread"
+		with defaultPool(processes=2) as local_pool:
+			assert isinstance(local_pool,LocalPool) and local_pool.kind=="thread"
+		os.environ["LENSTOOLS_POOL"] = "serial"
+		assert defaultPool(processes=2) is None
+	finally:
+		os.environ.pop("LENSTOOLS_POOL",None)
+		if kind is not None:
+			os.environ["LENSTOOLS_POOL"] = kind
+
 def test_power_plot():
 
 	fig,ax = plt.subplots()
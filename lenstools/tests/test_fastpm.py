@@ -0,0 +1,62 @@
+import os
+import shutil
+
+from ..simulations import FastPMSnapshot
+
+import numpy as np
+import astropy.units as u
+
+import bigfile
+
+#Write a small synthetic FastPM snapshot in the bigfile format
+def fastpmSnapshot(nc=8,box_size=10.,seed=0):
+
+	snapshot_file = "fastpm_snapshot"
+	num_particles = nc**3
+	if os.path.isdir(snapshot_file):
+		shutil.rmtree(snapshot_file)
+
+	#Positions in Mpc/h inside the box, velocities in km/s
+	np.random.seed(seed)
+	columns = dict()
+	columns["Position"] = (np.random.rand(num_particles,3)*box_size).astype(np.float32)
+	columns["Velocity"] = (np.random.randn(num_particles,3)*300.).astype(np.float32)
+	columns["ID"] = np.random.permutation(num_particles).astype(np.uint64)
+	columns["Aemit"] = (0.5 + 0.5*np.random.rand(num_particles)).astype(np.float32)
+
+	with bigfile.BigFile(snapshot_file,create=True) as bf:
+		for name in columns:
+			bf.create_from_array(name,columns[name])
+
+		attrs = bf["."].attrs
+		attrs["NC"] = np.array([nc])
+		attrs["OmegaM"] = np.array([0.3])
+		attrs["BoxSize"] = np.array([box_size])
+		attrs["M0"] = np.array([1.0])
+
+	return snapshot_file,columns
+
+def test_fastpm_chunks():
+
+	snapshot_file,columns = fastpmSnapshot()
+	snapshot = FastPMSnapshot.open(snapshot_file)
+
+	#Values and units of a full read
+	positions = snapshot.getPositions(save=False)
+	velocities = snapshot.getVelocities(save=False)
+	ids = snapshot.getID(save=False)
+
+	assert positions.unit==snapshot.Mpc_over_h
+	assert np.allclose(positions.value,columns["Position"])
+	assert velocities.unit==u.km/u.s
+	assert np.allclose(velocities.value,columns["Velocity"])
+	assert (ids==columns["ID"]).all()
+
+	#Chunked reads and partial reads give the same particles as a full read
+	for quantity,full in (("positions",positions),("velocities",velocities),("id",ids)):
+		chunks = list(snapshot.chunks(100,quantity))
+		assert [ (first,last) for first,last,chunk in chunks ]==[ (n,min(n+100,len(full))) for n in range(0,len(full),100) ]
+		assert (np.concatenate([ np.array(chunk) for first,last,chunk in chunks ])==np.array(full)).all()
+
+	assert (snapshot.getPositions(first=100,save=False)==positions[100:]).all()
+	assert (snapshot.getID(last=100,save=False)==ids[:100]).all()
@@ -1,9 +1,17 @@
-import os
+import sys,os
+import subprocess
+import logging
 
-from ..simulations import Gadget2SnapshotDE
+try:
+	from shutil import which
+except ImportError:
+	from distutils.spawn import find_executable as which
+
+from ..simulations import Gadget2SnapshotDE,Gadget2SnapshotPipe
 from ..pipeline.settings import Gadget2Settings
 
 from .. import dataExtern
+from .. import extern as ext
 
 import numpy as np
 from astropy.units import Mpc,m,s
@@ -18,6 +26,11 @@ def test_read():
 	pos = snapshot.getPositions()
 	assert np.all(pospart==pos[500:1000])
 
+	#Map the positions instead of reading them: no copies are made, the units are the file ones
+	posmap = snapshot.getPositions(first=500,last=1000,mmap=True,save=False)
+	assert not posmap.value.flags.writeable
+	assert np.allclose(posmap.to(pos.unit),pos[500:1000])
+
 	#Visualize the snapshot
 	snapshot.visualize(s=1)
 
@@ -82,3 +95,284 @@ def test_paramfile():
 	a = 1.0 / (1 + z)
 	np.savetxt("outputs.txt",a)
 
+
+def test_stream():
+
+	#Cut the same plane reading all the particles at once, and streaming them from the file in chunks
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	snapshot.getPositions()
+	left_corner = snapshot.positions.min(axis=0)
+	plane,resolution,num_part = snapshot.cutPlaneGaussianGrid(normal=2,center=7.0*Mpc,thickness=5.0*Mpc,plane_resolution=64,thickness_resolution=1,smooth=None,kind="density",left_corner=left_corner)
+	snapshot.close()
+
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	plane_stream,resolution,num_part_stream = snapshot.cutPlaneGaussianGrid(normal=2,center=7.0*Mpc,thickness=5.0*Mpc,plane_resolution=64,thickness_resolution=1,smooth=None,kind="density",left_corner=left_corner,chunk_size=1000)
+	assert not hasattr(snapshot,"positions")
+	snapshot.close()
+
+	assert num_part==num_part_stream
+	assert np.allclose(plane,plane_stream)
+
+def test_stream_handler():
+
+	from ..scripts.cutplanes import _snapshotReader
+
+	#The default pipeline handler reads all the positions when opening the snapshot: the plane cutting driver must open it lazily when streaming
+	assert _snapshotReader(Gadget2SnapshotPipe,None) is Gadget2SnapshotPipe
+	reader = _snapshotReader(Gadget2SnapshotPipe,1000)
+
+	snapshot = reader.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	assert not hasattr(snapshot,"positions")
+
+	slabs = [(2,7.0*Mpc,5.0*Mpc)]
+	planes_stream = snapshot.cutPlanes(slabs,plane_resolution=64,smooth=None,left_corner=np.zeros(3)*Mpc,chunk_size=1000)
+	assert not hasattr(snapshot,"positions")
+	snapshot.close()
+
+	snapshot = Gadget2SnapshotPipe.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	assert hasattr(snapshot,"positions")
+	planes = snapshot.cutPlanes(slabs,plane_resolution=64,smooth=None,left_corner=np.zeros(3)*Mpc)
+	snapshot.close()
+
+	assert np.isclose(planes[0][2],planes_stream[0][2])
+	assert np.allclose(planes[0][0],planes_stream[0][0])
+
+def test_slabs():
+
+	#Cut many planes with a single pass over the particles, and one at a time
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	snapshot.getPositions()
+
+	slabs = [ (normal,center*Mpc,2.5*Mpc) for center in (5.0,7.0,9.0) for normal in range(3) ]
+	planes = snapshot.cutPlanes(slabs,plane_resolution=64,left_corner=np.zeros(3)*Mpc,kind="potential")
+
+	for (normal,center,thickness),(plane,resolution,num_part) in zip(slabs,planes):
+		plane_single,resolution_single,num_part_single = snapshot.cutPlaneGaussianGrid(normal=normal,center=center,thickness=thickness,plane_resolution=64,left_corner=np.zeros(3)*Mpc,kind="potential")
+		assert num_part==num_part_single
+		assert np.allclose(plane,plane_single)
+
+	snapshot.close()
+
+def test_assignment():
+
+	#Cloud in cell and triangular shaped cloud mass assignment
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	snapshot.getPositions()
+
+	density_ngp,resolution = snapshot.massDensity(resolution=32)
+	slabs = [ (normal,7.0*Mpc,2.5*Mpc) for normal in range(3) ]
+
+	for assignment in ["CIC","TSC"]:
+
+		#The mass is conserved
+		density,resolution = snapshot.massDensity(resolution=32,assignment=assignment)
+		assert np.isclose(density.sum(),density_ngp.sum())
+
+		#The planes match the ones cut one at a time
+		planes = snapshot.cutPlanes(slabs,plane_resolution=64,left_corner=np.zeros(3)*Mpc,kind="potential",assignment=assignment)
+		for (normal,center,thickness),(plane,resolution,num_part) in zip(slabs,planes):
+			plane_single,resolution_single,num_part_single = snapshot.cutPlaneGaussianGrid(normal=normal,center=center,thickness=thickness,plane_resolution=64,left_corner=np.zeros(3)*Mpc,kind="potential",assignment=assignment)
+			assert np.allclose(plane,plane_single)
+
+	#Power spectrum with deconvolution and interlacing
+	k_edges = np.arange(1.0,10.0,0.5) * (1/Mpc)
+	k,power,num_modes = snapshot.powerSpectrum(k_edges,resolution=64,return_num_modes=True,assignment="CIC",interlacing=True)
+	assert np.isfinite(power[num_modes>0].value).all()
+
+	snapshot.close()
+
+def test_threads():
+
+	#Grid the particles with many threads
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	snapshot.getPositions()
+	density,resolution = snapshot.massDensity(resolution=32)
+
+	ext._nbody.set_num_threads(4)
+	assert ext._nbody.get_num_threads()==4
+	
+	try:
+		density_threads,resolution = snapshot.massDensity(resolution=32)
+		assert np.allclose(density,density_threads)
+	finally:
+		ext._nbody.set_num_threads(1)
+
+	snapshot.close()
+
+def test_neighbors():
+
+	#Parallel nearest neighbor distances, computed only once for each neighbor order
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	snapshot.getPositions()
+
+	distances = snapshot.neighborDistances(16,workers=2)
+	assert distances.unit==snapshot.positions.unit
+	assert (distances.value>0).all()
+	assert snapshot.neighborDistances(16) is distances
+
+	snapshot.close()
+
+def test_neighbors_sidecar():
+
+	#The neighbor distances of a range of particles are saved next to the snapshot file
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	num_particles = snapshot.header["num_particles_file"]//2
+	snapshot._first,snapshot._last = 0,num_particles
+
+	distances = snapshot.neighborDistances(8,sidecar=True)
+	sidecar_file = snapshot._neighborsSidecar(8)
+	assert len(distances)==num_particles
+	assert os.path.exists(sidecar_file)
+
+	#The sidecar is reused as long as it is more recent than the snapshot file, without reading the positions of the particles
+	np.save(sidecar_file,np.ones(num_particles))
+	snapshot._neighbor_distances = dict()
+	
+	particles_read = list()
+	getPositions = snapshot.getPositions
+	def countingGetPositions(first=None,last=None,**kwargs):
+		particles_read.append(last-first)
+		return getPositions(first=first,last=last,**kwargs)
+
+	snapshot.getPositions = countingGetPositions
+	assert (snapshot.neighborDistances(8,sidecar=True).value==1).all()
+	assert max(particles_read)<=1
+	del snapshot.getPositions
+
+	os.utime(sidecar_file,(0,0))
+	snapshot._neighbor_distances = dict()
+	assert np.allclose(snapshot.neighborDistances(8,sidecar=True),distances)
+
+	snapshot.close()
+	os.remove(sidecar_file)
+
+def test_distributed_power():
+
+	#Power spectrum with the slab decomposed density (a single slab in series)
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	snapshot.getPositions()
+
+	k_edges = np.arange(1.0,10.0,0.5) * (1/Mpc)
+	k,power,num_modes = snapshot.powerSpectrum(k_edges,resolution=32,return_num_modes=True)
+	k,power_slab,num_modes_slab = snapshot.powerSpectrum(k_edges,resolution=32,return_num_modes=True,distributed=True)
+
+	assert (num_modes==num_modes_slab).all()
+	assert np.allclose(power[num_modes>0],power_slab[num_modes>0])
+
+	snapshot.close()
+
+def test_sorted_sidecar():
+
+	#Cut a plane reading only the particles in the slab from the spatially sorted copy of the positions
+	snapshot = Gadget2SnapshotDE.open(os.path.join(dataExtern(),"gadget/snapshot_001"))
+	box_size = snapshot.header["box_size"]
+	positions_file,index_file = snapshot.writeSortedSidecar(num_cells=8,chunk_size=10000)
+
+	kwargs = dict(normal=2,thickness=box_size/8,center=box_size/2,plane_resolution=64,left_corner=np.zeros(3)*box_size.unit,smooth=None,kind="density")
+	plane,resolution,num_particles = snapshot.cutPlaneGaussianGrid(**kwargs)
+	plane_sorted,resolution,num_particles_sorted = snapshot.cutPlaneGaussianGrid(sorted_sidecar=True,**kwargs)
+
+	assert num_particles==num_particles_sorted
+	assert np.allclose(plane,plane_sorted)
+	assert len(snapshot.slabPositions(2,box_size*0.4,box_size*0.6))<snapshot.header["num_particles_file"]
+
+	#A range of particles gets its own sorted copy, which leaves the one of the whole file untouched
+	num_particles_file = snapshot.header["num_particles_file"]
+	snapshot._first,snapshot._last = 0,num_particles_file//2
+	positions_file_range,index_file_range = snapshot.writeSortedSidecar(num_cells=8)
+	assert positions_file_range!=positions_file
+	assert len(np.load(positions_file_range,mmap_mode="r"))==num_particles_file//2
+	assert len(np.load(positions_file,mmap_mode="r"))==num_particles_file
+	assert len(snapshot.slabPositions(2,box_size*0.4,box_size*0.6))<num_particles_file//2
+
+	snapshot.close()
+	for sidecar_file in (positions_file,index_file,positions_file_range,index_file_range):
+		os.remove(sidecar_file)
+
+def test_nbodysort():
+
+	from ..scripts.nbodysort import main
+
+	#The command line script streams the particles through the default handler
+	filename = os.path.join(dataExtern(),"gadget/snapshot_001")
+	main(["-n","8","-c","10000",filename])
+	
+	snapshot = Gadget2SnapshotPipe.open(filename)
+	positions_file,index_file = snapshot._sortedSidecar()
+	positions_stream = np.load(positions_file)
+	offsets_stream = np.load(index_file)["offsets"]
+
+	#The positions in memory are sorted without reading the snapshot file again
+	snapshot.close()
+	snapshot.writeSortedSidecar(num_cells=8)
+	assert np.allclose(np.load(positions_file),positions_stream)
+	assert (np.load(index_file)["offsets"]==offsets_stream).all()
+
+	for sidecar_file in (positions_file,index_file):
+		os.remove(sidecar_file)
+
+#Run by test_slabs_mpi in each MPI task: the tasks grid different particles, the planes are reduced with a reduce-scatter and collected on the master
+slabs_mpi_script = """
+import sys
+import numpy as np
+from astropy.units import Mpc
+from lenstools.utils.mpi import MPIWhirlPool
+from lenstools.simulations import Gadget2SnapshotDE
+
+pool = MPIWhirlPool()
+rank,num_tasks = pool.comm.Get_rank(),pool.comm.Get_size()
+
+#Reductions in many chunks
+pool.max_message_bytes = 64
+data = np.random.RandomState(0).rand(5,13,7)
+slab = pool.reduceScatter(data*(rank+1))
+slab_edges = pool.slabEdges(len(data))
+assert np.allclose(slab,data[slab_edges[rank]:slab_edges[rank+1]]*num_tasks*(num_tasks+1)/2)
+gathered = pool.gatherSlabs(slab,len(data))
+assert (rank>0) or np.allclose(gathered,data*num_tasks*(num_tasks+1)/2)
+del pool.max_message_bytes
+
+snapshot = Gadget2SnapshotDE.open(sys.argv[1])
+num_particles = snapshot.header["num_particles_file"]
+first,last = rank*num_particles//num_tasks,(rank+1)*num_particles//num_tasks
+
+slabs = [ (normal,center*Mpc,2.5*Mpc) for center in (5.0,7.0) for normal in range(3) ]
+kwargs = dict(plane_resolution=64,left_corner=np.zeros(3)*Mpc,kind="potential",assignment="CIC",interlacing=True)
+planes = snapshot.cutPlanes(slabs,**kwargs)
+
+#Positions in memory, and streamed from the file
+snapshot.pool = pool
+snapshot._first,snapshot._last = first,last
+planes_stream = snapshot.cutPlanes(slabs,chunk_size=1000,**kwargs)
+snapshot.positions = snapshot.getPositions(first=first,last=last,save=False)
+planes_memory = snapshot.cutPlanes(slabs,**kwargs)
+
+if pool.is_master():
+	for distributed in (planes_stream,planes_memory):
+		for (plane,resolution,num_part),(plane_mpi,resolution_mpi,num_part_mpi) in zip(planes,distributed):
+			assert np.isclose(num_part,num_part_mpi)
+			assert np.allclose(plane,plane_mpi,rtol=1.0e-5,atol=1.0e-5*np.abs(plane).max())
+else:
+	assert planes_stream[0][0] is None
+
+snapshot.close()
+pool.comm.Barrier()
+"""
+
+def test_slabs_mpi():
+
+	try:
+		import mpi4py
+	except ImportError:
+		logging.warning("You need to install mpi4py in order to test the distributed plane cutting!!")
+		return
+
+	if which("mpiexec") is None:
+		logging.warning("You need mpiexec in order to test the distributed plane cutting!!")
+		return
+
+	with open("slabs_mpi.py","w") as scriptfile:
+		scriptfile.write(slabs_mpi_script)
+
+	#Launch the tasks with the environment this process started with (importing mpi4py adds the MPI singleton variables, which confuse mpiexec)
+	assert subprocess.call(["mpiexec","-n","3",sys.executable,"slabs_mpi.py",os.path.join(dataExtern(),"gadget/snapshot_001")],env=dict(os.environ))==0
@@ -1,12 +1,13 @@
 import os
 
 from ..simulations import Gadget2Snapshot
-from ..simulations.raytracing import PotentialPlane
+from ..simulations.raytracing import RayTracer,PotentialPlane
 
 from .. import dataExtern
 
 import numpy as np
 import astropy.units as u
+from astropy.cosmology import w0waCDM
 
 
 def test_nfw():
@@ -29,4 +30,101 @@ def test_nfw():
 	#Build a PotentialPlane
 	pln = PotentialPlane(p/p.max(),snap.header["box_size"],comoving_distance=snap.header["comoving_distance"],unit=None,num_particles=n)
 	pln.visualize(colorbar=True)
-	pln.savefig("nfw.png")
\ No newline at end of file
+	pln.savefig("nfw.png")
+
+def test_nfw_projected():
+
+	#Create a Gadget2Snapshot with a halo that crosses a thin slab and one that does not reach it
+	snap = Gadget2Snapshot()
+	snap.setPositions(np.array([[120.0,120.0,121.0],[60.0,60.0,200.0]],dtype=np.float32)*u.Mpc)
+	snap.weights = np.ones(2,dtype=np.float32)
+	snap.virial_radius = np.array([10.0,10.0]) * u.Mpc
+	snap.concentration = np.array([5.0,5.0])
+	snap.setHeaderInfo(box_size=240.0*u.Mpc)
+
+	kwargs = dict(center=120.0*u.Mpc,thickness=4.0*u.Mpc,plane_resolution=128,left_corner=np.zeros(3)*u.Mpc,kind="density",smooth=None)
+
+	#The profile averaged across the slab must match a finely sampled slab
+	p,b,n = snap.cutPlaneGaussianGrid(thickness_resolution=1,project_halos=True,**kwargs)
+	p_fine,b,n = snap.cutPlaneGaussianGrid(thickness_resolution=128,**kwargs)
+	assert np.abs(p-p_fine).max()<1.0e-2*np.abs(p_fine).max()
+
+	#The halo outside the slab does not contribute
+	assert np.abs(p[32,32])<1.0e-6*np.abs(p).max()
+
+def test_mmap():
+
+	#Load a plane and save it in the memory mappable format
+	pln = PotentialPlane.load(os.path.join(dataExtern(),"lensing/planes/snap11_potentialPlane0_normal0.fits"))
+	pln.save("potential_plane.npy")
+	assert PotentialPlane.readHeader("potential_plane.npy")["Z"]==pln.redshift
+
+	#Map the plane: rolling it must not touch the data, only the lookups
+	pln_mmap = PotentialPlane.load("potential_plane.npy",mmap=True)
+	assert not pln_mmap.data.flags.writeable
+
+	np.random.seed(1)
+	pln.randomRoll()
+	np.random.seed(1)
+	pln_mmap.randomRoll()
+
+	x,y = np.random.rand(2,1000) * pln.side_angle
+	assert np.allclose(pln.deflectionAngles(x,y),pln_mmap.deflectionAngles(x,y))
+	assert np.allclose(pln.shearMatrix(x,y),pln_mmap.shearMatrix(x,y))
+
+def test_mmap_whole_plane():
+
+	#Memory map a plane and roll it: the whole plane operations must see the rolled data
+	np.random.seed(0)
+	pln = PotentialPlane(np.random.randn(64,64),angle=1.0*u.deg,redshift=1.0,cosmology=w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74),unit=u.rad**2)
+	pln.save("potential_plane_roll.npy")
+	pln_mmap = PotentialPlane.load("potential_plane_roll.npy",mmap=True)
+
+	np.random.seed(1)
+	pln.randomRoll()
+	np.random.seed(1)
+	pln_mmap.randomRoll()
+
+	l_edges = np.linspace(500.0,5000.0,10)
+	assert np.allclose(pln.powerSpectrum(l_edges)[1],pln_mmap.powerSpectrum(l_edges)[1])
+	assert np.allclose(pln.smooth(2.0*u.arcmin).data,pln_mmap.smooth(2.0*u.arcmin).data)
+
+def test_compact():
+
+	#Save the plane in the compact Fourier format
+	pln = PotentialPlane.load(os.path.join(dataExtern(),"lensing/planes/snap11_potentialPlane0_normal0.fits"))
+	pln.save("potential_plane.npz",compress=True)
+	assert PotentialPlane.readHeader("potential_plane.npz")["Z"]==pln.redshift
+
+	#The plane is loaded in Fourier space, with single precision accuracy
+	pln_compact = PotentialPlane.load("potential_plane.npz")
+	assert pln_compact.space=="fourier"
+	pln_compact.toReal()
+	assert np.abs(pln.data-pln_compact.data).max() < 1.0e-5*np.abs(pln.data).max()
+
+	#Cut the modes above lmax: the ones below are untouched
+	pln.save("potential_plane_lmax.npz",lmax=5000.0)
+	pln_compact = PotentialPlane.load("potential_plane_lmax.npz")
+
+	lx,ly = np.meshgrid(np.fft.rfftfreq(pln.data.shape[0]),np.fft.fftfreq(pln.data.shape[0]))
+	l = 2.0*np.pi*np.sqrt(lx**2 + ly**2) / pln.resolution.to(u.rad).value
+	ft = np.fft.rfft2(pln.data)
+	assert np.allclose(pln_compact.data[l<5000.0],ft[l<5000.0],rtol=1.0e-5,atol=1.0e-5*np.abs(ft).max())
+	assert (pln_compact.data[l>5000.0*np.sqrt(2.0)]==0).all()
+
+def test_load_fourier():
+
+	#A plane saved in Fourier space stays there when a RayTracer reads it, unless it is in the compact format
+	np.random.seed(0)
+	pln = PotentialPlane(np.random.randn(64,64),angle=1.0*u.deg,redshift=1.0,cosmology=w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74),unit=u.rad**2)
+	pln.save("potential_plane_real.fits")
+	pln.save("potential_plane_real.npz",compress=True)
+	pln.toFourier()
+	pln.save("potential_plane_fourier.fits")
+
+	tracer = RayTracer()
+	assert tracer.loadLens("potential_plane_fourier.fits",roll=False).space=="fourier"
+	assert tracer.loadLens("potential_plane_real.npz",roll=False).space=="real"
+
+	#The deflections of the Fourier plane are computed with FFTs, as before saving it
+	assert np.allclose(tracer.loadLens("potential_plane_fourier.fits",roll=False).deflectionAngles().data,pln.deflectionAngles().data)
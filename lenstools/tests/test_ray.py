@@ -1,4 +1,11 @@
-import os
+import sys,os
+import threading
+import subprocess
+
+try:
+	from shutil import which
+except ImportError:
+	from distutils.spawn import find_executable as which
 
 from ..simulations.raytracing import RayTracer,PotentialPlane,DeflectionPlane
 from .. import ConvergenceMap,OmegaMap,ShearMap
@@ -8,6 +15,7 @@ from .. import dataExtern
 import numpy as np
 import matplotlib.pyplot as plt
 from astropy.units import deg,rad,arcmin
+from astropy.cosmology import w0waCDM
 
 import logging
 import time
@@ -146,6 +154,51 @@ def test_callback():
 	fin = tracer.shoot(pos,z=z_final,callback=save_callback,pos=pos)
 
 
+def test_workers():
+
+	z_final = 2.0
+	b = np.linspace(0.0,tracer.lens[0].side_angle.to(deg).value,512)
+	xx,yy = np.meshgrid(b,b)
+	pos = np.array([xx,yy]) * deg
+
+	#Splitting the rays among threads must not change the result
+	conv_serial = tracer.shoot(pos,z=z_final,kind="convergence")
+	conv_threads = tracer.shoot(pos,z=z_final,kind="convergence",workers=4)
+	assert np.allclose(conv_serial,conv_threads)
+
+	#The threads are released when the ray tracing is interrupted
+	def interrupt(positions,tracer,k):
+		raise KeyboardInterrupt
+
+	num_threads = threading.active_count()
+	try:
+		tracer.shoot(pos,z=z_final,workers=4,callback=interrupt)
+	except KeyboardInterrupt:
+		assert threading.active_count()==num_threads
+
+
+def test_multiple_redshifts():
+
+	b = np.linspace(0.0,tracer.lens[0].side_angle.to(deg).value,512)
+	xx,yy = np.meshgrid(b,b)
+	pos = np.array([xx,yy]) * deg
+
+	#One pass through the lenses must give the same maps as one pass per source redshift
+	z_sources = [0.5,1.0,1.5,2.0]
+	conv_all = tracer.shoot(pos,z=z_sources,kind="convergence")
+	for n,z in enumerate(z_sources):
+		assert np.allclose(conv_all[n],tracer.shoot(pos,z=z,kind="convergence"))
+
+	#Sources in front of the first lens are not lensed
+	z_front = 0.5*tracer.redshift[0]
+	conv_front,conv_back = tracer.shoot(pos,z=[z_front,1.0],kind="convergence")
+	assert np.allclose(conv_front,0.0)
+	assert np.allclose(conv_back,conv_all[1])
+
+	pos_front, = tracer.shoot(pos,z=[z_front],kind="positions")
+	assert np.allclose(pos_front,pos)
+
+
 
 def test_convergence_born():
 
@@ -202,6 +255,71 @@ def test_post_born2():
 	omega_pb2.visualize(colorbar=True)
 	omega_pb2.savefig("omega_pb2.png")
 
+def test_los_batch():
+
+	z_final = 2.0
+
+	b = np.linspace(0.0,tracer.lens[0].side_angle.to(deg).value,512)
+	xx,yy = np.meshgrid(b,b)
+	pos = np.array([xx,yy]) * deg
+
+	#A batch of maps with no additional rolls must reproduce the single map integration
+	conv_born = tracer.convergenceBorn([pos,pos],z=z_final)
+	conv_pb2 = tracer.convergencePostBorn2([pos,pos],z=z_final,rolls=[None,1])
+	assert np.allclose(conv_born[0],tracer.convergenceBorn(pos,z=z_final))
+	assert np.allclose(conv_born[1],conv_born[0])
+	assert np.allclose(conv_pb2[0],tracer.convergencePostBorn2(pos,z=z_final))
+	assert not np.allclose(conv_pb2[1],conv_pb2[0])
+
+def test_los_batch_sequential():
+
+	#Two memory mappable candidate planes at each lens redshift
+	cosmology = tracer.lens[0].cosmology
+	redshifts = [0.5,1.0,1.5,2.0]
+	planes = dict()
+
+	for z in redshifts:
+		planes[z] = list()
+		for n in range(2):
+			plane_name = "batch_plane_z{0:.1f}_{1}.npy".format(z,n)
+			PotentialPlane(np.random.randn(64,64)*1.0e-8,angle=1.0*deg,redshift=z,cosmology=cosmology,unit=rad**2).save(plane_name)
+			planes[z].append(plane_name)
+
+	#Draw the lenses of each realization as the line of sight integration driver does
+	def drawLenses(generator):
+		realization_tracer = RayTracer()
+		for z in redshifts[::-1]:
+			realization_tracer.addLens((planes[z][generator.randint(0,2)],cosmology.comoving_distance(z),z))
+		realization_tracer.reorderLenses()
+		return realization_tracer
+
+	b = np.linspace(0.0,1.0,64)
+	xx,yy = np.meshgrid(b,b)
+	pos = np.array([xx,yy]) * deg
+
+	#Maps integrated one at a time, with the global generator seeded for each realization
+	seed,realizations = 3,range(4)
+	conv_born,conv_pb2 = list(),list()
+	
+	for r in realizations:
+		np.random.seed(seed+r)
+		conv_born.append(drawLenses(np.random).convergenceBorn(pos,z=1.8))
+		np.random.seed(seed+r)
+		conv_pb2.append(drawLenses(np.random).convergencePostBorn2(pos,z=1.8,transpose_up_to=1))
+
+	#The same maps integrated in a batch that shares the plane loads, each realization with its own generator
+	generators = [ np.random.RandomState(seed+r) for r in realizations ]
+	tracers = [ drawLenses(generator) for generator in generators ]
+	conv_born_batch = tracers[0].convergenceBorn([pos]*len(tracers),z=1.8,rolls=generators,lenses=[ t.lens for t in tracers ])
+
+	generators = [ np.random.RandomState(seed+r) for r in realizations ]
+	tracers = [ drawLenses(generator) for generator in generators ]
+	conv_pb2_batch = tracers[0].convergencePostBorn2([pos]*len(tracers),z=1.8,transpose_up_to=1,rolls=generators,lenses=[ t.lens for t in tracers ])
+
+	for r in realizations:
+		assert np.allclose(conv_born[r],conv_born_batch[r])
+		assert np.allclose(conv_pb2[r],conv_pb2_batch[r])
+
 
 def test_distortion():
 
@@ -233,6 +351,36 @@ def test_distortion():
 	fig.savefig("lens_distortion.png")
 
 
+def test_distortion_interpolated():
+
+	#load unlensed image from png file
+	image_unlensed = plt.imread(os.path.join(dataExtern(),"lensing/lens.png"))[:,:,0]
+	pos_original = (np.array(np.where(image_unlensed>0)) * 2.0/image_unlensed.shape[0]) * deg
+	pos_original = np.roll(pos_original,1,axis=0)
+	pos_original[1] *= -1
+	pos_original[1] += 2.0*deg
+
+	#Build the inverse mapping once and use it on two catalogs
+	pos_linear,pos_half = tracer.shootForward([pos_original,pos_original[:,::2]],z=2.0,interpolation="linear",workers=4)
+	assert np.allclose(pos_linear[:,::2],pos_half)
+
+	pos_idw = tracer.shootForward(pos_original,z=2.0,interpolation="inverse_distance",neighbors=4,workers=4)
+
+	#Inverse distance weighting with a single neighbor is the nearest grid ray
+	pos_nearest = tracer.shootForward(pos_original,z=2.0,interpolation="nearest")
+	assert np.allclose(tracer.shootForward(pos_original,z=2.0,interpolation="inverse_distance",neighbors=1),pos_nearest)
+
+	#Plot the distorted images
+	fig,ax = plt.subplots(1,2,figsize=(16,8))
+	for n,(pos,title) in enumerate([(pos_linear,"Linear"),(pos_idw,"Inverse distance")]):
+		ax[n].scatter(pos[0],pos[1])
+		ax[n].set_xlabel(r"$x$({0})".format(pos_original.unit.to_string()))
+		ax[n].set_ylabel(r"$y$({0})".format(pos_original.unit.to_string()))
+		ax[n].set_title(title)
+
+	fig.savefig("lens_distortion_interpolated.png")
+
+
 def test_continuous_distortion():
 
 	#load unlensed image from png file
@@ -269,3 +417,162 @@ def test_continuous_distortion():
 		ax.set_title("z={:.2f}".format(tracer.redshift[n]))	
 		fig.savefig("distortion{0}.png".format(n))	 
 
+
+
+def test_profile():
+
+	#Profile the crossing of lenses read from disk
+	profiled = RayTracer(profile=True)
+	for i in range(11,20):
+		plane_file = os.path.join(dataExtern(),"lensing/planes/snap{0}_potentialPlane0_normal0.fits").format(i)
+		plane = PotentialPlane.load(plane_file)
+		profiled.addLens((plane_file,plane.comoving_distance,plane.redshift))
+	profiled.reorderLenses()
+
+	b = np.linspace(0.0,tracer.lens[0].side_angle.to(deg).value,128)
+	xx,yy = np.meshgrid(b,b)
+	pos = np.array([xx,yy]) * deg
+	profiled.shoot(pos,z=profiled.redshift[-2],kind="convergence")
+
+	#One row for each phase of each lens crossed
+	profile = profiled.profile
+	assert set(profile["phase"])==set(["load","roll","deflection","shear","accumulation"])
+	assert (profile.groupby("lens").size()==5).all()
+	assert (profile.query("phase=='load'")["bytes_read"]>0).all()
+	profile.to_csv("ray_profile.csv",index=False)
+
+
+def test_checkpoint():
+
+	z_final = 2.0
+	b = np.linspace(0.0,tracer.lens[0].side_angle.to(deg).value,512)
+	xx,yy = np.meshgrid(b,b)
+	pos = np.array([xx,yy]) * deg
+
+	#Interrupt the ray tracing after a few lenses
+	def interrupt(jacobians,tracer,k):
+		if k==10:
+			raise KeyboardInterrupt
+
+	try:
+		tracer.shoot(pos,z=z_final,kind="jacobians",callback=interrupt,checkpoint="ray_checkpoint.npz",checkpoint_every=3)
+	except KeyboardInterrupt:
+		assert os.path.exists("ray_checkpoint.npz")
+
+	#The checkpoint cannot be resumed with a different source redshift
+	try:
+		tracer.shoot(pos,z=z_final-0.5,kind="jacobians",checkpoint="ray_checkpoint.npz")
+	except AssertionError:
+		assert os.path.exists("ray_checkpoint.npz")
+	else:
+		raise AssertionError("The checkpoint should not match the source redshift!")
+
+	#Resuming from the checkpoint must give the same result as an uninterrupted run
+	jacobians_resumed = tracer.shoot(pos,z=z_final,kind="jacobians",checkpoint="ray_checkpoint.npz")
+	assert not os.path.exists("ray_checkpoint.npz")
+	assert np.allclose(jacobians_resumed,tracer.shoot(pos,z=z_final,kind="jacobians"))
+
+
+#Run by test_shared_planes in each MPI task: the tasks cross different combinations of the same planes, sharing them or reading them privately must give the same result
+shared_planes_script = """
+import sys
+import numpy as np
+from astropy.units import deg
+from lenstools.utils.mpi import MPIWhirlPool
+from lenstools.simulations.raytracing import RayTracer,PotentialPlane
+
+pool = MPIWhirlPool()
+rank = pool.comm.Get_rank()
+
+b = np.linspace(0.0,1.0,32)
+pos = np.array(np.meshgrid(b,b)) * deg
+
+results = list()
+for shared in (None,pool):
+
+	tracer = RayTracer(pool=shared)
+	for n in range(3):
+		plane_file = sys.argv[1].format(n,(rank if n==0 else 0)%2)
+		plane = PotentialPlane.load(plane_file)
+		tracer.addLens((plane_file,plane.comoving_distance,plane.redshift))
+	tracer.reorderLenses()
+
+	np.random.seed(rank)
+	results.append(tracer.shoot(pos,z=1.2,kind="jacobians"))
+	np.random.seed(rank)
+	results.append(tracer.convergenceBorn([pos,pos],z=1.2,rolls=[rank,rank+10],lenses=[tracer.lens,tracer.lens]))
+
+	if shared is not None:
+		tracer.closeSharedPlanes()
+
+for private,shared in zip(results[:2],results[2:]):
+	assert np.allclose(private,shared)
+
+pool.comm.Barrier()
+"""
+
+def test_shared_planes():
+
+	try:
+		import mpi4py
+	except ImportError:
+		logging.warning("You need to install mpi4py in order to test the shared lens planes!!")
+		return
+
+	if which("mpiexec") is None:
+		logging.warning("You need mpiexec in order to test the shared lens planes!!")
+		return
+
+	#Two planes at each redshift
+	np.random.seed(0)
+	cosmology = w0waCDM(H0=72.0,Om0=0.26,Ode0=0.74)
+	for n,z in enumerate((0.5,1.0,1.5)):
+		for c in range(2):
+			PotentialPlane(1.0e-5*np.random.randn(64,64),angle=1.0*deg,redshift=z,comoving_distance=cosmology.comoving_distance(z),cosmology=cosmology,unit=rad**2).save("shared_plane{0}_{1}.fits".format(n,c))
+
+	with open("shared_planes.py","w") as scriptfile:
+		scriptfile.write(shared_planes_script)
+
+	#Launch the tasks with the environment this process started with (importing mpi4py adds the MPI singleton variables, which confuse mpiexec)
+	assert subprocess.call(["mpiexec","-n","2",sys.executable,"shared_planes.py","shared_plane{0}_{1}.fits"],env=dict(os.environ))==0
+
+
+#Run by test_work_queue in each MPI task: every item that is not skipped is processed exactly once, by the workers and (with a thread safe MPI library) by the master too
+work_queue_script = """
+import time
+from mpi4py import MPI
+from lenstools.utils.mpi import MPIWhirlPool
+
+pool = MPIWhirlPool()
+
+processed = list()
+for item in pool.workQueue(range(30),skip=lambda item:item%7==3):
+	time.sleep(0.01*(1+pool.rank))
+	processed.append(item)
+
+processed = pool.comm.gather(processed,root=0)
+if pool.is_master():
+	assert sorted(sum(processed,[]))==[ item for item in range(30) if item%7!=3 ]
+	assert len(pool.queue_log)==30
+	if MPI.Query_thread()==MPI.THREAD_MULTIPLE:
+		assert len(processed[0])>0
+
+pool.comm.Barrier()
+"""
+
+def test_work_queue():
+
+	try:
+		import mpi4py
+	except ImportError:
+		logging.warning("You need to install mpi4py in order to test the dynamic work queue!!")
+		return
+
+	if which("mpiexec") is None:
+		logging.warning("You need mpiexec in order to test the dynamic work queue!!")
+		return
+
+	with open("work_queue.py","w") as scriptfile:
+		scriptfile.write(work_queue_script)
+
+	assert subprocess.call(["mpiexec","-n","3",sys.executable,"work_queue.py"],env=dict(os.environ))==0
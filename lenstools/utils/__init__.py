@@ -1,4 +1,5 @@
 from .algorithms import *
 from .misc import *
 from .mpi import *
+from .pools import *
 from .fft import *
\ No newline at end of file
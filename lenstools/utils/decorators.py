@@ -1,5 +1,6 @@
 import sys
 from .mpi import MPIWhirlPool
+from .pools import defaultPool
 
 try:
 	from mpi4py import MPI
@@ -13,13 +14,11 @@ class Parallelize(object):
 
 		def spreaded_func(*args,**kwargs):
 
-			#MPI Pool
-			try:
-				pool = MPIWhirlPool()
-			except ValueError:
-				pool = None
+			#MPI Pool if the job runs on more than one MPI task, pool of local processes otherwise (the LENSTOOLS_POOL environment variable overrides the choice)
+			pool = defaultPool()
+			is_mpi = isinstance(pool,MPIWhirlPool)
 
-			if (pool is not None) and (not pool.is_master()):
+			if is_mpi and (not pool.is_master()):
 				pool.wait()
 				pool.comm.Barrier()
 				MPI.Finalize()
@@ -35,12 +34,13 @@ class Parallelize(object):
 			#Finish
 			if pool is not None:
 				pool.close()
+
+			if is_mpi:
 				pool.comm.Barrier()
 				MPI.Finalize()
 
 			#Return the result
-			if pool is None or pool.is_master():
-				return result
+			return result
 		
 		#Restore the documentation
 		spreaded_func.__doc__ = func.__doc__
@@ -1,5 +1,11 @@
 from __future__ import division
 import sys,warnings
+import time
+import threading
+import logging
+
+from operator import mul
+from functools import reduce
 
 try:
 	
@@ -17,6 +23,10 @@ except ImportError:
 from emcee.utils import MPIPool
 import numpy as np
 
+#Same loggers as the pipeline drivers
+logdriver = logging.getLogger("lenstools.driver")
+logstderr = logging.getLogger("lenstools.stderr")
+
 #################################################################################################
 ###################MPIWhirlPool: should handle one sided communications too######################
 #################################################################################################
@@ -28,9 +38,12 @@ class MPIWhirlPool(MPIPool):
 
 	"""
 
+	#Maximum size (in bytes) of a single message in collective reductions: larger arrays are reduced in chunks, since MPI counts are 32 bit integers
+	max_message_bytes = 2**31 - 1
+
 	#######################################################################################################################
 	
-	def openWindow(self,memory,window_type="sendrecv"):
+	def openWindow(self,memory,window_type="collective"):
 
 		"""
 		Create a RMA window that looks from the master process onto all the other workers
@@ -38,6 +51,9 @@ class MPIWhirlPool(MPIPool):
 		:param memory: memory buffer on which to open the window
 		:type memory: numpy nd array
 
+		:param window_type: how the window data is accumulated on the master: "collective" (MPI Reduce), "sendrecv" (pairwise Send/Recv tree) or "RMA" (one sided Accumulate)
+		:type window_type: str.
+
 		"""
 
 		self._window_type = window_type
@@ -55,6 +71,9 @@ class MPIWhirlPool(MPIPool):
 		elif window_type=="sendrecv":
 			self._buffer = np.zeros_like(memory)
 
+		elif window_type=="collective":
+			assert memory.flags["C_CONTIGUOUS"],"The window memory must be contiguous!"
+
 		else:
 			raise NotImplementedError("Window of type {0} not implemented!".format(window_type))
 
@@ -80,20 +99,31 @@ class MPIWhirlPool(MPIPool):
 
 			return read_buffer
 
-		elif self._window_type=="sendrecv":
+		else:
 			raise NotImplementedError
 
 	#######################################################################################################################
 
-	def accumulate(self,op=default_op):
+	def accumulate(self,op=default_op,blocking=True):
 
 		"""
 		Accumulates the all the window data on the master, performing a custom operation (default is sum)
 
+		:param op: reduction operation
+		:type op: MPI.Op
+
+		:param blocking: if False, the reduction is only started (collective windows only): call wait() before touching the window memory
+		:type blocking: bool.
+
 		"""
 
+		if self._window_type=="collective":
+			return self.reduceArray(self.memory,op=op,root=0,blocking=blocking)
+
+		assert blocking,"Non blocking accumulation is supported only on collective windows!"
+
 		#All the tasks that participate in the communication
-		tasks = range(self.size+1)
+		tasks = list(range(self.size+1))
 
 		#Cycle until only master is left
 		while len(tasks)>1:
@@ -118,6 +148,10 @@ class MPIWhirlPool(MPIPool):
 
 						if op==default_op:
 							self.memory += self._buffer
+						elif op==MPI.MAX:
+							np.maximum(self.memory,self._buffer,out=self.memory)
+						elif op==MPI.MIN:
+							np.minimum(self.memory,self._buffer,out=self.memory)
 						else:
 							raise NotImplementedError
 
@@ -144,6 +178,289 @@ class MPIWhirlPool(MPIPool):
 				self.comm.Barrier()
 				
 	
+	#######################################################################################################################
+	##################Collective reductions################################################################################
+	#######################################################################################################################
+
+	def _chunks(self,memory):
+
+		#Split the flattened array in chunks that fit in a single message
+		flat = memory.reshape(-1)
+		chunk_size = max(self.max_message_bytes // memory.dtype.itemsize,1)
+		return [ flat[n:n+chunk_size] for n in range(0,len(flat),chunk_size) ]
+
+	def reduceArray(self,memory,op=default_op,root=0,blocking=True):
+
+		"""
+		Reduce an array from all the tasks onto the root task, in place (collective call); arrays larger than max_message_bytes are reduced in chunks
+
+		:param memory: array to reduce: on the root it is overwritten with the result
+		:type memory: numpy nd array
+
+		:param op: reduction operation
+		:type op: MPI.Op
+
+		:param root: rank of the task that receives the result
+		:type root: int.
+
+		:param blocking: if False, use non blocking reductions (Ireduce) and return immediately: call wait() before touching memory again
+		:type blocking: bool.
+
+		:returns: list of pending requests if non blocking, None otherwise
+
+		"""
+
+		assert memory.flags["C_CONTIGUOUS"],"Only contiguous arrays can be reduced in place!"
+		requests = list()
+
+		for chunk in self._chunks(memory):
+
+			if self.rank==root:
+				sendbuf,recvbuf = MPI.IN_PLACE,chunk
+			else:
+				sendbuf,recvbuf = chunk,None
+
+			if blocking:
+				self.comm.Reduce(sendbuf,recvbuf,op=op,root=root)
+			else:
+				requests.append(self.comm.Ireduce(sendbuf,recvbuf,op=op,root=root))
+
+		if blocking:
+			return None
+
+		#Remember the pending requests, so that wait() can complete them
+		self._pending = getattr(self,"_pending",list()) + requests
+		return requests
+
+	def wait(self,requests=None):
+
+		"""
+		Complete non blocking reductions
+
+		:param requests: requests to complete (default is all the pending ones)
+		:type requests: list.
+
+		"""
+
+		pending = getattr(self,"_pending",list())
+
+		if requests is None:
+			requests = pending
+
+		if len(requests):
+			MPI.Request.Waitall(requests)
+
+		self._pending = [ r for r in pending if all(r is not q for q in requests) ]
+
+	#######################################################################################################################
+
+	def slabEdges(self,num_rows):
+
+		"""
+		Split the rows of an array between all the tasks, in contiguous slabs as even as possible (task t owns the rows edges[t]<=n<edges[t+1])
+
+		:param num_rows: number of rows
+		:type num_rows: int.
+
+		:returns: numpy array with the slab edges
+
+		"""
+
+		return np.linspace(0,num_rows,self.comm.size+1).astype(int)
+
+	def _slabChunks(self,slab_edges,row_size,itemsize):
+
+		#Split the slab of each task in the same number of chunks, so that the chunks of all the tasks fit in a single message: returns, for each chunk, the range of flattened elements of each task
+		num_chunks = max(int(np.ceil(slab_edges[-1]*row_size*itemsize / self.max_message_bytes)),1)
+		chunk_edges = [ np.linspace(slab_edges[t]*row_size,slab_edges[t+1]*row_size,num_chunks+1).astype(np.int64) for t in range(self.comm.size) ]
+		return [ [ (chunk_edges[t][c],chunk_edges[t][c+1]) for t in range(self.comm.size) ] for c in range(num_chunks) ]
+
+	def reduceScatter(self,memory,op=default_op):
+
+		"""
+		Reduce an array from all the tasks and scatter the result in slabs along its first axis (see slabEdges) with MPI Reduce_scatter (collective call); arrays larger than max_message_bytes are reduced in chunks
+
+		:param memory: array to reduce, with the same shape on all the tasks
+		:type memory: numpy nd array
+
+		:param op: reduction operation
+		:type op: MPI.Op
+
+		:returns: numpy nd array with the slab of the reduced array that belongs to this task
+
+		"""
+
+		memory = np.ascontiguousarray(memory)
+		flat = memory.reshape(-1)
+		row_size = reduce(mul,memory.shape[1:],1)
+
+		slab_edges = self.slabEdges(memory.shape[0])
+		slab = np.empty((slab_edges[self.comm.rank+1]-slab_edges[self.comm.rank],)+memory.shape[1:],dtype=memory.dtype)
+		slab_flat = slab.reshape(-1)
+		offset = slab_edges[self.comm.rank]*row_size
+
+		for elements in self._slabChunks(slab_edges,row_size,memory.dtype.itemsize):
+
+			sendbuf = np.concatenate([ flat[first:last] for (first,last) in elements ])
+			first,last = elements[self.comm.rank]
+			self.comm.Reduce_scatter(sendbuf,slab_flat[first-offset:last-offset],[ int(l-f) for (f,l) in elements ],op=op)
+
+		return slab
+
+	def gatherSlabs(self,slab,num_rows,root=0):
+
+		"""
+		Collect on the root task the slabs of an array scattered along its first axis (see slabEdges), for example by reduceScatter (collective call); arrays larger than max_message_bytes are collected in chunks
+
+		:param slab: slab of the array that belongs to this task
+		:type slab: numpy nd array
+
+		:param num_rows: number of rows of the whole array
+		:type num_rows: int.
+
+		:param root: rank of the task that receives the array
+		:type root: int.
+
+		:returns: numpy nd array with all the rows on the root, None on the other tasks
+
+		"""
+
+		slab = np.ascontiguousarray(slab)
+		slab_flat = slab.reshape(-1)
+		row_size = reduce(mul,slab.shape[1:],1)
+
+		slab_edges = self.slabEdges(num_rows)
+		offset = slab_edges[self.comm.rank]*row_size
+
+		if self.comm.rank==root:
+			memory = np.empty((num_rows,)+slab.shape[1:],dtype=slab.dtype)
+			flat = memory.reshape(-1)
+		else:
+			memory = None
+
+		for elements in self._slabChunks(slab_edges,row_size,slab.dtype.itemsize):
+
+			first,last = elements[self.comm.rank]
+			sendbuf = slab_flat[first-offset:last-offset]
+
+			if self.comm.rank==root:
+				counts = np.array([ l-f for (f,l) in elements ],dtype=np.int64)
+				recvbuf = np.empty(counts.sum(),dtype=slab.dtype)
+				self.comm.Gatherv(sendbuf,[recvbuf,(counts.astype(np.int32),np.concatenate(([0],np.cumsum(counts)[:-1])).astype(np.int32))],root=root)
+
+				#Put the received elements in place
+				n = 0
+				for (f,l) in elements:
+					flat[f:l] = recvbuf[n:n+l-f]
+					n += l-f
+
+			else:
+				self.comm.Gatherv(sendbuf,None,root=root)
+
+		return memory
+
+	#######################################################################################################################
+	##################All to all communications############################################################################
+	#######################################################################################################################
+
+	def exchange(self,data,counts):
+
+		"""
+		Exchange the rows of an array between all the tasks (collective call): the rows must be sorted by destination task; exchanges larger than max_message_bytes are split in rounds, since MPI counts and displacements are 32 bit integers
+
+		:param data: rows to send, sorted by destination task
+		:type data: numpy nd array
+
+		:param counts: number of rows to send to each task
+		:type counts: array of int.
+
+		:returns: numpy nd array with the rows received from all the tasks, sorted by source task
+
+		"""
+
+		data = np.ascontiguousarray(data)
+		row_size = reduce(mul,data.shape[1:],1)
+		num_tasks = self.comm.size
+
+		#Tell each task how many rows it is going to receive
+		send_counts = np.asarray(counts,dtype=np.int64)
+		recv_counts = np.zeros_like(send_counts)
+		self.comm.Alltoall(send_counts,recv_counts)
+
+		#Number of rounds, so that the rows sent and received by each task in a round fit in a single message (the rounding of the splits adds at most one row per task)
+		round_rows = max(self.max_message_bytes//max(row_size*data.dtype.itemsize,1) - num_tasks,1)
+		num_rounds = int(np.ceil(max(send_counts.sum(),recv_counts.sum()) / round_rows))
+		num_rounds = max(self.comm.allreduce(num_rounds,op=MPI.MAX),1)
+
+		#Each block of rows is split evenly between the rounds: the receiver computes the same splits from the counts
+		send_offsets = np.concatenate(([0],np.cumsum(send_counts)))
+		recv_offsets = np.concatenate(([0],np.cumsum(recv_counts)))
+		send_splits = [ np.linspace(0,c,num_rounds+1).astype(np.int64) for c in send_counts ]
+		recv_splits = [ np.linspace(0,c,num_rounds+1).astype(np.int64) for c in recv_counts ]
+
+		received = np.empty((recv_counts.sum(),)+data.shape[1:],dtype=data.dtype)
+
+		for r in range(num_rounds):
+
+			send_rows = [ (send_offsets[t]+send_splits[t][r],send_offsets[t]+send_splits[t][r+1]) for t in range(num_tasks) ]
+			recv_rows = [ (recv_offsets[t]+recv_splits[t][r],recv_offsets[t]+recv_splits[t][r+1]) for t in range(num_tasks) ]
+
+			#With a single round the rows are already contiguous
+			if num_rounds==1:
+				sendbuf,recvbuf = data,received
+			else:
+				sendbuf = np.concatenate([ data[first:last] for (first,last) in send_rows ])
+				recvbuf = np.empty((sum(last-first for (first,last) in recv_rows),)+data.shape[1:],dtype=data.dtype)
+
+			#Exchange the rows
+			round_send = np.array([ last-first for (first,last) in send_rows ],dtype=np.int64)*row_size
+			round_recv = np.array([ last-first for (first,last) in recv_rows ],dtype=np.int64)*row_size
+			send_displ = np.concatenate(([0],np.cumsum(round_send)[:-1]))
+			recv_displ = np.concatenate(([0],np.cumsum(round_recv)[:-1]))
+			self.comm.Alltoallv([sendbuf,(round_send.astype(np.int32),send_displ.astype(np.int32))],[recvbuf,(round_recv.astype(np.int32),recv_displ.astype(np.int32))])
+
+			#Put the received rows in place
+			if num_rounds>1:
+				n = 0
+				for (first,last) in recv_rows:
+					received[first:last] = recvbuf[n:n+last-first]
+					n += last-first
+
+		return received
+
+	#######################################################################################################################
+
+	def transposeSlabs(self,slab):
+
+		"""
+		Transpose an array distributed between the tasks in slabs along its first axis, so that it is distributed in slabs along its second axis (collective call); all the tasks must own slabs of the same shape, and the second axis must be divisible by the number of tasks. Slabs larger than max_message_bytes per task are transposed in chunks along the first axis
+
+		:param slab: slab of the array owned by this task, shape (n0,n1,...)
+		:type slab: numpy nd array
+
+		:returns: numpy nd array with shape (number of tasks*n0,n1/number of tasks,...)
+
+		"""
+
+		num_tasks = self.comm.size
+		n0,n1 = slab.shape[:2]
+		assert n1%num_tasks==0,"The second axis ({0}) must be divisible by the number of tasks ({1})!".format(n1,num_tasks)
+
+		#Split the rows in chunks, so that the block sent to each task fits in a single message (all the tasks compute the same chunks)
+		num_chunks = min(max(int(np.ceil(slab.nbytes / (num_tasks*self.max_message_bytes))),1),max(n0,1))
+		chunk_edges = np.linspace(0,n0,num_chunks+1).astype(int)
+		received = np.empty((num_tasks,n0,n1//num_tasks)+slab.shape[2:],dtype=slab.dtype)
+
+		for first,last in zip(chunk_edges[:-1],chunk_edges[1:]):
+
+			#Block that goes to task t: slab[first:last,t*n1/num_tasks:(t+1)*n1/num_tasks]
+			send = np.ascontiguousarray(slab[first:last].reshape((last-first,num_tasks,n1//num_tasks)+slab.shape[2:]).swapaxes(0,1))
+			recv = np.empty_like(send)
+			self.comm.Alltoall(send,recv)
+			received[:,first:last] = recv
+
+		return received.reshape((num_tasks*n0,n1//num_tasks)+slab.shape[2:])
+
 	#######################################################################################################################
 
 	def closeWindow(self):
@@ -158,4 +475,241 @@ class MPIWhirlPool(MPIPool):
 			self.win.Free()
 		
 		elif self._window_type=="sendrecv":
-			pass
\ No newline at end of file
+			pass
+
+		elif self._window_type=="collective":
+			self.wait()
+
+	#######################################################################################################################
+	##################Node level shared memory (MPI-3)#####################################################################
+	#######################################################################################################################
+
+	@property
+	def node_comm(self):
+
+		"""
+		Communicator that groups the tasks running on the same node
+
+		"""
+
+		if getattr(self,"_node_comm",None) is None:
+			self._node_comm = self.comm.Split_type(MPI.COMM_TYPE_SHARED)
+
+		return self._node_comm
+
+	def openSharedWindow(self,nbytes):
+
+		"""
+		Allocate memory that is shared by all the tasks on the same node (collective call on the node communicator): each task contributes nbytes to the window (possibly 0), and every task on the node can then read and write the memory contributed by any other
+
+		:param nbytes: number of bytes contributed by this task
+		:type nbytes: int.
+
+		:returns: MPI shared memory window
+
+		"""
+
+		return MPI.Win.Allocate_shared(nbytes,1,comm=self.node_comm)
+
+	def sharedArray(self,win,task,shape,dtype,offset=0):
+
+		"""
+		Wrap in a numpy array the memory contributed to a shared window by one of the tasks on the node
+
+		:param win: shared memory window (see openSharedWindow)
+		:type win: MPI.Win
+
+		:param task: rank, in the node communicator, of the task that contributed the memory
+		:type task: int.
+
+		:param shape: shape of the array
+		:type shape: tuple.
+
+		:param dtype: data type of the array
+		:type dtype: numpy dtype
+
+		:param offset: offset (in bytes) of the array in the memory contributed by the task
+		:type offset: int.
+
+		:returns: numpy nd array (no copies are made)
+
+		"""
+
+		buf,disp_unit = win.Shared_query(task)
+		return np.ndarray(buffer=buf,dtype=dtype,shape=shape,offset=offset)
+
+	def closeSharedWindow(self,win):
+
+		"""
+		Free a shared memory window (collective call on the node communicator): no task on the node may access the arrays that wrap it afterwards
+
+		:param win: shared memory window (see openSharedWindow)
+		:type win: MPI.Win
+
+		"""
+
+		self.node_comm.Barrier()
+		win.Free()
+
+	#######################################################################################################################
+	##################Dynamic work queue###################################################################################
+	#######################################################################################################################
+
+	#Message tags used by the work queue
+	_queue_request_tag = 101
+	_queue_item_tag = 102
+
+	def workQueue(self,items,skip=None,straggler_factor=3.0,check_every=10.0):
+
+		"""
+		Distribute work items dynamically (collective call): the workers ask the master for one item at a time, so that faster tasks process more items and the number of items does not need to be a multiple of the number of tasks. The master keeps track of the progress and of the tasks that are taking too long; if the MPI library is thread safe (MPI_THREAD_MULTIPLE) it hands out the items from a background thread and processes items itself in the meantime, otherwise it only hands out the items
+
+		:param items: items to distribute (e.g. realization indices), in the order in which they should be handed out
+		:type items: list.
+
+		:param skip: the items for which skip(item) is True are skipped (e.g. the realizations that are already on disk)
+		:type skip: callable
+
+		:param straggler_factor: items that take longer than this factor times the median time per item are reported as stragglers
+		:type straggler_factor: float.
+
+		:param check_every: time interval (in seconds) between two straggler checks on the master
+		:type check_every: float.
+
+		:returns: generator over the items this task should process
+
+		"""
+
+		items = list(items)
+
+		#Only one task: process all the items in series
+		if self.size==0:
+			for item in items:
+				if (skip is None) or not(skip(item)):
+					yield item
+			return
+
+		#Workers: ask for an item until there are none left, reporting on the previous one
+		if not self.is_master():
+
+			report = None
+			
+			while True:
+
+				self.comm.send(report,dest=0,tag=self._queue_request_tag)
+				has_item,item = self.comm.recv(source=0,tag=self._queue_item_tag)
+				if not has_item:
+					break
+
+				start = time.time()
+				skipped = (skip is not None) and skip(item)
+				if not skipped:
+					yield item
+
+				report = (item,time.time()-start,skipped)
+
+			return
+
+		#Master: the queue, the items being processed by each task and the log of the processed ones are shared with the thread that serves the workers
+		queue = list(items)
+		running = dict()
+		lock = threading.Lock()
+		self.queue_log = list()
+
+		if MPI.Query_thread()==MPI.THREAD_MULTIPLE:
+			dispatcher = threading.Thread(target=self._dispatch,args=(queue,running,lock,len(items),straggler_factor,check_every))
+			dispatcher.daemon = True
+			dispatcher.start()
+		else:
+			logdriver.warning("The MPI library is not thread safe: the master task only hands out the items to the workers")
+			self._dispatch(queue,running,lock,len(items),straggler_factor,check_every)
+			dispatcher = None
+
+		#Process the items that are left in between (if any)
+		while True:
+
+			with lock:
+				if not len(queue):
+					break
+				item = queue.pop(0)
+				running[0] = (item,time.time())
+
+			start = time.time()
+			skipped = (skip is not None) and skip(item)
+			if not skipped:
+				yield item
+
+			self._queueReport(0,(item,time.time()-start,skipped),running,lock,len(items))
+
+		if dispatcher is not None:
+			dispatcher.join()
+
+		#Summary of the time spent by each task
+		for task in range(self.size+1):
+			task_log = [ l for l in self.queue_log if l[0]==task ]
+			logdriver.info("Task {0} processed {1} items ({2} skipped) in {3:.3f}s".format(task,len(task_log),sum([ l[3] for l in task_log ]),sum([ l[2] for l in task_log ])))
+
+	#Record the report of a task on the item it processed, and log the progress on all the items
+	def _queueReport(self,task,report,running,lock,num_items):
+
+		item,elapsed,skipped = report
+
+		with lock:
+			running.pop(task,None)
+			self.queue_log.append((task,item,elapsed,skipped))
+			completed = len(self.queue_log)
+
+		logstderr.info("Progress: {0:.2f}%, item {1} {2} by task {3} in {4:.3f}s".format(100.*completed/num_items,item,("skipped" if skipped else "completed"),task,elapsed))
+
+	def _dispatch(self,queue,running,lock,num_items,straggler_factor,check_every):
+
+		active = self.size
+		reported = set()
+		status = MPI.Status()
+		last_check = time.time()
+
+		while active>0:
+
+			#Look for stragglers while waiting for the next request
+			while not self.comm.Iprobe(source=MPI.ANY_SOURCE,tag=self._queue_request_tag):
+				
+				time.sleep(0.01)
+				now = time.time()
+
+				if now-last_check<check_every:
+					continue
+
+				with lock:
+					item_times = [ l[2] for l in self.queue_log if not l[3] ]
+					running_items = list(running.items())
+
+				if not len(item_times):
+					continue
+
+				median = np.median(item_times)
+				for task,(item,start) in running_items:
+					if (now-start>straggler_factor*median) and ((task,item) not in reported):
+						logdriver.warning("Task {0} is taking {1:.1f}s on item {2}, more than {3:.1f} times the median time per item ({4:.1f}s)".format(task,now-start,item,straggler_factor,median))
+						reported.add((task,item))
+
+				last_check = now
+
+			#Receive the report on the previous item
+			report = self.comm.recv(source=MPI.ANY_SOURCE,tag=self._queue_request_tag,status=status)
+			worker = status.Get_source()
+
+			if report is not None:
+				self._queueReport(worker,report,running,lock,num_items)
+
+			#Hand out the next item, or tell the worker to stop
+			with lock:
+				has_item = len(queue)>0
+				if has_item:
+					item = queue.pop(0)
+					running[worker] = (item,time.time())
+
+			if has_item:
+				self.comm.send((True,item),dest=worker,tag=self._queue_item_tag)
+			else:
+				self.comm.send((False,None),dest=worker,tag=self._queue_item_tag)
+				active -= 1
@@ -0,0 +1,154 @@
+from __future__ import division
+import os
+import multiprocessing
+
+try:
+	from concurrent.futures import ProcessPoolExecutor,ThreadPoolExecutor
+except ImportError:
+	ProcessPoolExecutor = None
+	ThreadPoolExecutor = None
+
+from .mpi import MPI,MPIWhirlPool
+
+#################################################################################################
+###################LocalPool: same interface as MPIPool, runs on the local cores#################
+#################################################################################################
+
+class LocalPool(object):
+
+	"""
+	Pool of local worker processes (or threads) with the same map/is_master/size/rank/close interface as the emcee MPIPool, so that it can be passed wherever an MPIPool is expected (Ensemble.compute, Ensemble.bootstrap, Emulator.chi2, emcee_sampler...)
+
+	:param processes: number of workers (default is the number of cores)
+	:type processes: int.
+
+	:param kind: "process" for a pool of processes (the mapped functions and their arguments must be pickleable), "thread" for a pool of threads (useful if the mapped functions release the GIL)
+	:type kind: str.
+
+	"""
+
+	def __init__(self,processes=None,kind="process"):
+
+		assert ProcessPoolExecutor is not None,"You need concurrent.futures (the futures package on python 2) to use a LocalPool!"
+
+		if processes is None:
+			processes = multiprocessing.cpu_count()
+		assert processes>=1,"The pool must have at least one worker!"
+
+		if kind=="process":
+			self.executor = ProcessPoolExecutor(max_workers=processes)
+		elif kind=="thread":
+			self.executor = ThreadPoolExecutor(max_workers=processes)
+		else:
+			raise NotImplementedError("Local pool of kind {0} not implemented!".format(kind))
+
+		self.kind = kind
+
+		#Mimic the MPIPool attributes: the master hands out the tasks to size workers
+		self.rank = 0
+		self.size = processes
+
+	def __repr__(self):
+		return "<LocalPool: {0} {1} workers>".format(self.size,self.kind)
+
+	#######################################################################################################################
+
+	def is_master(self):
+
+		"""
+		The calling process is always the master in a local pool
+
+		"""
+
+		return True
+
+	def wait(self):
+
+		"""
+		Workers of a local pool never need to wait for tasks (here only for interface compatibility)
+
+		"""
+
+		pass
+
+	def map(self,function,tasks):
+
+		"""
+		Apply a function to each task in a list, spreading the calls over the workers
+
+		:param function: function to apply
+		:type function: callable
+
+		:param tasks: arguments of each function call
+		:type tasks: list.
+
+		:returns: list with the results, in the same order as the tasks
+
+		"""
+
+		tasks = list(tasks)
+
+		#Hand out the tasks to the processes in chunks, to amortize the pickling overhead
+		if self.kind=="process":
+			return list(self.executor.map(function,tasks,chunksize=max(len(tasks)//(4*self.size),1)))
+
+		return list(self.executor.map(function,tasks))
+
+	def close(self):
+
+		"""
+		Shut down the workers
+
+		"""
+
+		self.executor.shutdown(wait=True)
+
+	def __enter__(self):
+		return self
+
+	def __exit__(self,exc_type,exc_value,traceback):
+		self.close()
+
+#################################################################################################
+###################Pool selection################################################################
+#################################################################################################
+
+def defaultPool(kind=None,processes=None):
+
+	"""
+	Select the pool to run on: an MPIWhirlPool if the job is running on more than one MPI task, a LocalPool of processes on the local cores otherwise (mpi4py is not installed, or the job runs on a single MPI task); the run is serial if there is a single core. The kind of pool can be forced with the kind argument or with the LENSTOOLS_POOL environment variable
+
+	:param kind: "mpi", "process" (LocalPool of processes), "thread" (LocalPool of threads), "serial" (no pool) or None (automatic)
+	:type kind: str.
+
+	:param processes: number of workers of the local pool (default is the number of cores)
+	:type processes: int.
+
+	:returns: MPIWhirlPool, LocalPool or None
+
+	"""
+
+	if kind is None:
+		kind = os.environ.get("LENSTOOLS_POOL",None)
+
+	if kind=="serial":
+		return None
+
+	#Use MPI if it is available and there is more than one task
+	if kind in [None,"mpi"]:
+
+		if (MPI is not None) and (MPI.COMM_WORLD.Get_size()>1):
+			return MPIWhirlPool()
+
+		assert kind is None,"MPI pool requested, but the job is not running on more than one MPI task!"
+
+		#Single task: spread the work on the local cores, if there is more than one
+		if processes is None:
+			processes = multiprocessing.cpu_count()
+
+		if (processes<2) or (ProcessPoolExecutor is None):
+			return None
+
+		kind = "process"
+
+	return LocalPool(processes=processes,kind=kind)
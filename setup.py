@@ -213,11 +213,11 @@ gsl_location = check_gsl(conf)
 if gsl_location is not None:
 	print(green("[OK] Checked GSL installation, the Design feature will be installed"))
 	lenstools_includes.append(os.path.join(gsl_location,"include")) 
-	lenstools_link = ["-lm","-L{0}".format(os.path.join(gsl_location,"lib")),"-lgsl","-lgslcblas"]
+	lenstools_link = ["-lm","-lpthread","-L{0}".format(os.path.join(gsl_location,"lib")),"-lgsl","-lgslcblas"]
 	external_sources["_design"] = ["_design.c","design.c"] 
 else:
 	print(red("[FAIL] GSL installation not found, the Design feature will not be installed"))
-	lenstools_link = ["-lm"]
+	lenstools_link = ["-lm","-lpthread"]
 
 
 ######################################################################################################################################